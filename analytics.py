@@ -0,0 +1,216 @@
+from collections import Counter
+
+from sqlalchemy import event, func, select, update, insert, delete, inspect
+from models import db, Project, Image, Label, ProjectStats, ProjectLabelCount
+
+
+def analyze(project_id, cursor=0, limit=None):
+    """Project totals plus per-image labels for one keyset page of images.
+
+    Totals come from the maintained summary; ``next_cursor`` is the last
+    image id of the page, or None once the listing is complete.
+    """
+    images = select(Image.id).where(Image.project_id == project_id, Image.id > cursor).order_by(Image.id)
+    if limit is not None:
+        images = images.limit(limit + 1)
+    image_ids = db.session.scalars(images).all()
+    has_more = limit is not None and len(image_ids) > limit
+    image_ids = image_ids[:limit] if has_more else image_ids
+
+    # One joined statement instead of a label query per image
+    rows = db.session.execute(
+        select(Image.id, Image.filename, Label.class_name)
+        .outerjoin(Label, Label.image_id == Image.id)
+        .where(Image.project_id == project_id, Image.id.in_(image_ids))
+        .order_by(Image.id, Label.id)
+    ).all() if image_ids else []
+
+    details = []
+    current = None
+    for image_id, filename, class_name in rows:
+        if current is None or current['image_id'] != image_id:
+            current = {'image_id': image_id, 'filename': filename, 'labels': []}
+            details.append(current)
+        if class_name is not None:
+            current['labels'].append(class_name)
+
+    summary = project_summaries([project_id])[project_id]
+    summary['details'] = details
+    summary['next_cursor'] = image_ids[-1] if has_more else None
+    return summary
+
+
+def project_version(project_id):
+    version = db.session.scalar(select(ProjectStats.version).where(ProjectStats.project_id == project_id))
+    if version is None:
+        project_summaries([project_id])
+        version = db.session.scalar(select(ProjectStats.version).where(ProjectStats.project_id == project_id))
+    return version
+
+
+def user_projects_version(user_id):
+    # Changes whenever one of the user's projects is created, deleted or changed
+    count, last_id, versions = db.session.execute(
+        select(func.count(Project.id), func.max(Project.id), func.sum(func.coalesce(ProjectStats.version, 0)))
+        .outerjoin(ProjectStats, ProjectStats.project_id == Project.id)
+        .where(Project.user_id == user_id)
+    ).one()
+    return f'{count}-{last_id or 0}-{versions or 0}'
+
+
+def project_summaries(project_ids):
+    project_ids = list(project_ids)
+    if not project_ids:
+        return {}
+
+    stats = {s.project_id: s for s in ProjectStats.query.filter(ProjectStats.project_id.in_(project_ids))}
+    missing = [pid for pid in project_ids if pid not in stats]
+    if missing:
+        # Projects created before summaries existed are built once on demand
+        rebuild_project_stats(db.session.connection(), missing)
+        db.session.commit()
+        stats = {s.project_id: s for s in ProjectStats.query.filter(ProjectStats.project_id.in_(project_ids))}
+
+    distributions = {pid: {} for pid in project_ids}
+    for row in ProjectLabelCount.query.filter(ProjectLabelCount.project_id.in_(project_ids)):
+        distributions[row.project_id][row.label] = row.count
+
+    return {
+        pid: {
+            'total_images': stats[pid].image_count,
+            'total_labels': stats[pid].label_count,
+            'label_distribution': distributions[pid],
+        }
+        for pid in project_ids
+    }
+
+
+def rebuild_project_stats(connection, project_ids):
+    project_ids = list(project_ids)
+    # Keep versions increasing across rebuilds so old ETags never match again
+    versions = dict(connection.execute(
+        select(ProjectStats.project_id, ProjectStats.version).where(ProjectStats.project_id.in_(project_ids))
+    ).all())
+    connection.execute(delete(ProjectLabelCount).where(ProjectLabelCount.project_id.in_(project_ids)))
+    connection.execute(delete(ProjectStats).where(ProjectStats.project_id.in_(project_ids)))
+
+    image_counts = dict(connection.execute(
+        select(Image.project_id, func.count(Image.id))
+        .where(Image.project_id.in_(project_ids))
+        .group_by(Image.project_id)
+    ).all())
+    label_rows = connection.execute(
+        select(Label.project_id, Label.class_name, func.count(Label.id))
+        .where(Label.project_id.in_(project_ids))
+        .group_by(Label.project_id, Label.class_name)
+    ).all()
+
+    label_counts = Counter()
+    for project_id, _, count in label_rows:
+        label_counts[project_id] += count
+
+    connection.execute(insert(ProjectStats), [
+        {'project_id': pid, 'image_count': image_counts.get(pid, 0), 'label_count': label_counts[pid],
+         'version': versions.get(pid, 0) + 1}
+        for pid in project_ids
+    ])
+    if label_rows:
+        connection.execute(insert(ProjectLabelCount), [
+            {'project_id': pid, 'label': label, 'count': count} for pid, label, count in label_rows
+        ])
+
+
+def _apply_delta(connection, project_id, images=0, labels=None):
+    if project_id is None:
+        return
+    labels = labels or {}
+    result = connection.execute(
+        update(ProjectStats)
+        .where(ProjectStats.project_id == project_id)
+        .values(image_count=ProjectStats.image_count + images,
+                label_count=ProjectStats.label_count + sum(labels.values()),
+                version=ProjectStats.version + 1)
+    )
+    if result.rowcount == 0:
+        # No summary yet; project_summaries() builds it from the tables on first read
+        return
+    for label, delta in labels.items():
+        result = connection.execute(
+            update(ProjectLabelCount)
+            .where(ProjectLabelCount.project_id == project_id, ProjectLabelCount.label == label)
+            .values(count=ProjectLabelCount.count + delta)
+        )
+        if result.rowcount == 0 and delta > 0:
+            connection.execute(insert(ProjectLabelCount).values(project_id=project_id, label=label, count=delta))
+    if any(delta < 0 for delta in labels.values()):
+        connection.execute(
+            delete(ProjectLabelCount)
+            .where(ProjectLabelCount.project_id == project_id, ProjectLabelCount.count <= 0)
+        )
+
+
+def images_added(connection, project_id, count):
+    # For bulk inserts that bypass the ORM and therefore the listeners below
+    _apply_delta(connection, project_id, images=count)
+
+
+def labels_added(connection, project_id, class_counts):
+    _apply_delta(connection, project_id, labels=dict(class_counts))
+
+
+def _label_project_id(connection, label):
+    if label.project_id is not None:
+        return label.project_id
+    return connection.execute(select(Image.project_id).where(Image.id == label.image_id)).scalar()
+
+
+def _touch(connection, project_id):
+    connection.execute(
+        update(ProjectStats).where(ProjectStats.project_id == project_id).values(version=ProjectStats.version + 1))
+
+
+@event.listens_for(Project, 'after_insert')
+def _project_inserted(mapper, connection, target):
+    connection.execute(insert(ProjectStats).values(project_id=target.id, image_count=0, label_count=0, version=0))
+
+
+@event.listens_for(Image, 'after_insert')
+def _image_inserted(mapper, connection, target):
+    _apply_delta(connection, target.project_id, images=1)
+
+
+@event.listens_for(Image, 'after_delete')
+def _image_deleted(mapper, connection, target):
+    # Its labels are removed by the delete cascade and counted by _label_deleted
+    _apply_delta(connection, target.project_id, images=-1)
+
+
+@event.listens_for(Label, 'after_insert')
+def _label_inserted(mapper, connection, target):
+    _apply_delta(connection, _label_project_id(connection, target), labels={target.class_name: 1})
+
+
+@event.listens_for(Label, 'after_delete')
+def _label_deleted(mapper, connection, target):
+    _apply_delta(connection, _label_project_id(connection, target), labels={target.class_name: -1})
+
+
+@event.listens_for(Project, 'after_update')
+def _project_updated(mapper, connection, target):
+    _touch(connection, target.id)
+
+
+@event.listens_for(Image, 'after_update')
+def _image_updated(mapper, connection, target):
+    _touch(connection, target.project_id)
+
+
+@event.listens_for(Label, 'after_update')
+def _label_updated(mapper, connection, target):
+    # A renamed label moves from its old class to its new one
+    history = inspect(target).attrs.class_name.history
+    if history.deleted and history.added and history.deleted[0] != history.added[0]:
+        _apply_delta(connection, _label_project_id(connection, target),
+                     labels={history.deleted[0]: -1, history.added[0]: 1})
+    else:
+        _touch(connection, _label_project_id(connection, target))
@@ -1,25 +1,50 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from sqlalchemy.orm import make_transient_to_detached
 from flask_migrate import Migrate
-from config import DevelopmentConfig
+from config import Config, DevelopmentConfig
 from routes import main as main_routes
 from models import db, User
+from extensions import model_registry, inference_batchers, inference_pool, tensor_cache, prediction_cache, storage, feature_store, embedding_index, api_key_cache, user_cache, metrics
+from ml import start_warmup
+from commands import register_commands
+from jobs import training_engine
+from garbage import garbage_collector
 
 login_manager = LoginManager()
 
 def create_app(config_class=DevelopmentConfig):
     app = Flask(__name__)
-    app.config.from_object(config_class)
+    # A plain dict (as used by the tests) is layered on top of the base config
+    overrides = config_class if isinstance(config_class, dict) else {}
+    app.config.from_object(Config if overrides else config_class)
     app.config['UPLOAD_FOLDER'] = 'uploads'
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///db.sqlite'
     app.config['SECRET_KEY'] = 'your-secret-key'
+    app.config.update(overrides)
 
     db.init_app(app)
+    storage.init_app(app)
+    model_registry.init_app(app)
+    inference_batchers.init_app(app)
+    inference_pool.init_app(app)
+    tensor_cache.init_app(app)
+    prediction_cache.init_app(app)
+    feature_store.init_app(app)
+    embedding_index.init_app(app)
+    api_key_cache.init_app(app)
+    user_cache.init_app(app)
+    metrics.init_app(app)
+    for name, cache in (('prediction', prediction_cache), ('api_key', api_key_cache), ('user', user_cache),
+                        ('model_registry', model_registry)):
+        metrics.watch_cache(name, cache)
+    model_registry.on_load = metrics.observe_model_load
     login_manager.init_app(app)
     login_manager.login_view = 'main.login'
 
     app.register_blueprint(main_routes)
+    register_commands(app)
 
     # Setup Flask-Migrate
     migrate = Migrate(app, db)  # Initialize Flask-Migrate
@@ -27,13 +52,33 @@ def create_app(config_class=DevelopmentConfig):
     with app.app_context():
         db.create_all()
 
+    # Resumes queued jobs and requeues ones orphaned by a restart
+    training_engine.init_app(app)
+    # Reclaims files of deleted rows and periodically sweeps for orphans
+    garbage_collector.init_app(app)
+
+    # Build and warm the default model in the background instead of on first request
+    if app.config.get('EAGER_MODEL_WARMUP'):
+        start_warmup()
+
     return app
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Runs on every authenticated request; cached column values are attached
+    # to the session without a SELECT
+    user_id = int(user_id)
+    values = user_cache.get(user_id)
+    if values is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            user_cache.put(user_id, {'id': user.id, 'username': user.username, 'password_hash': user.password_hash})
+        return user
+    user = User(**values)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
 
 if __name__ == '__main__':
+    # Development server; use serve.py for production
     app = create_app()
-    app.run(debug=True)
-    app.run(host='0.0.0.0', port=5000)
+    app.run(host='0.0.0.0', port=5000, debug=app.config.get('DEBUG', False))
@@ -0,0 +1,71 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sqlalchemy import select
+
+from extensions import storage
+from models import db, Image
+from ml import load_image_tensor
+
+
+def iter_image_rows(project_id, image_ids=None, chunk_size=1000):
+    # Keyset-paginate so 100k+ image projects are never loaded at once
+    last_id = 0
+    while True:
+        query = select(Image.id, Image.filename, Image.digest).where(Image.project_id == project_id, Image.id > last_id)
+        if image_ids is not None:
+            query = query.where(Image.id.in_(image_ids))
+        rows = db.session.execute(query.order_by(Image.id).limit(chunk_size)).all()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1].id
+
+
+def decode_image(project_id, row, target_size):
+    with storage.image_source(row) as source:
+        return load_image_tensor(project_id, row.id, source, target_size)
+
+
+def predict_stream(rows, decode, predict_fn, batch_size=32, workers=4):
+    """Yield ``(row, prediction, error)`` for every row.
+
+    Decoding runs on a thread pool that stays up to two batches ahead of the
+    model, so preprocessing overlaps the forward pass while memory stays bounded.
+    """
+    window = batch_size * 2
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='decode') as executor:
+        pending = deque()
+        rows = iter(rows)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < window:
+                row = next(rows, None)
+                if row is None:
+                    exhausted = True
+                    break
+                pending.append((row, executor.submit(decode, row)))
+            if not pending:
+                return
+
+            batch = [pending.popleft() for _ in range(min(batch_size, len(pending)))]
+            decoded, failed = [], []
+            for row, future in batch:
+                try:
+                    decoded.append((row, future.result()))
+                except Exception as e:
+                    failed.append((row, e))
+
+            for row, error in failed:
+                yield row, None, error
+            if not decoded:
+                continue
+            try:
+                predictions = predict_fn(np.stack([x for _, x in decoded]))
+            except Exception as e:
+                for row, _ in decoded:
+                    yield row, None, e
+                continue
+            for (row, _), prediction in zip(decoded, predictions):
+                yield row, prediction, None
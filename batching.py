@@ -0,0 +1,185 @@
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class _Request:
+    __slots__ = ('inputs', 'future')
+
+    def __init__(self, inputs, future):
+        self.inputs = inputs
+        self.future = future
+
+
+class MicroBatcher:
+    """Merges concurrent requests into a single batched forward pass.
+
+    Requests are queued and drained by one worker thread which waits at most
+    ``max_wait_ms`` after the first request for more to arrive, up to
+    ``max_batch_size`` samples, before calling ``predict_fn`` once.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=32, max_wait_ms=5, name='batcher'):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batch_sizes = Counter()
+        self.queue_depths = Counter()
+        self.requests = 0
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._closed = False
+        # Serialises submit() against close() so nothing is queued behind the sentinel
+        self._close_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, inputs):
+        """Queue ``inputs`` (shape ``(n, ...)``) and return a Future of the outputs."""
+        future = Future()
+        request = _Request(np.asarray(inputs), future)
+        with self._close_lock:
+            if self._closed:
+                raise RuntimeError('Batcher is closed')
+            self._queue.put(request)
+        return future
+
+    def predict(self, inputs, timeout=None):
+        return self.submit(inputs).result(timeout=timeout)
+
+    def close(self, wait=True):
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        if wait:
+            self._thread.join()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'queue_depth': self.queue_depth,
+                'requests': self.requests,
+                'batches': self.batches,
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'batch_size_histogram': _histogram(self.batch_sizes),
+                'queue_depth_histogram': _histogram(self.queue_depths),
+            }
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                self._fail_pending()
+                return
+            batch, stop = self._collect(first)
+            self._execute(batch)
+            if stop:
+                self._fail_pending()
+                return
+
+    def _collect(self, first):
+        batch = [first]
+        size = len(first.inputs)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+            size += len(item.inputs)
+        return batch, False
+
+    def _execute(self, batch):
+        counts = [len(item.inputs) for item in batch]
+        with self._stats_lock:
+            self.requests += len(batch)
+            self.batches += 1
+            self.batch_sizes[sum(counts)] += 1
+            self.queue_depths[self.queue_depth] += 1
+
+        try:
+            inputs = batch[0].inputs if len(batch) == 1 else np.concatenate([item.inputs for item in batch])
+            outputs = np.asarray(self.predict_fn(inputs))
+        except Exception as e:
+            for item in batch:
+                item.future.set_exception(e)
+            return
+
+        offset = 0
+        for item, count in zip(batch, counts):
+            item.future.set_result(outputs[offset:offset + count])
+            offset += count
+
+    def _fail_pending(self):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                item.future.set_exception(RuntimeError('Batcher is closed'))
+
+
+class BatcherPool:
+    """One MicroBatcher per active deployment."""
+
+    def __init__(self, app=None):
+        self.max_batch_size = 32
+        self.max_wait_ms = 5
+        self._batchers = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_batch_size = app.config.get('INFERENCE_MAX_BATCH_SIZE', self.max_batch_size)
+        self.max_wait_ms = app.config.get('INFERENCE_MAX_WAIT_MS', self.max_wait_ms)
+        app.extensions['inference_batchers'] = self
+
+    def get(self, deployment_id, predict_fn):
+        with self._lock:
+            batcher = self._batchers.get(deployment_id)
+            if batcher is None:
+                batcher = MicroBatcher(predict_fn, self.max_batch_size, self.max_wait_ms,
+                                       name=f'batcher-{deployment_id}')
+                self._batchers[deployment_id] = batcher
+            return batcher
+
+    def stats(self, deployment_id):
+        with self._lock:
+            batcher = self._batchers.get(deployment_id)
+        return batcher.stats() if batcher is not None else None
+
+    def close(self, deployment_id, wait=False):
+        with self._lock:
+            batcher = self._batchers.pop(deployment_id, None)
+        if batcher is not None:
+            batcher.close(wait=wait)
+
+    def close_all(self):
+        with self._lock:
+            batchers, self._batchers = list(self._batchers.values()), {}
+        for batcher in batchers:
+            batcher.close()
+
+
+def _histogram(counter):
+    return {str(key): counter[key] for key in sorted(counter)}
@@ -0,0 +1,282 @@
+"""Seed a throwaway database and measure the app's hot endpoints under concurrent load.
+
+    python -m benchmarks.run --requests 200 --concurrency 8 --output results.json
+    python -m benchmarks.run --baseline benchmarks/baseline.json --threshold 0.2
+
+Requests go through the WSGI app in-process (one test client per load
+thread), so results exclude network and server overhead and are comparable
+across runs on the same machine.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sqlalchemy import event
+
+from benchmarks.seed import PASSWORD, seed_database, synthetic_png
+
+ENDPOINTS = ('inference', 'predict', 'dashboard', 'analyze_project')
+# The seeded images repeat after one pass, so these run with the prediction cache off to measure the model
+UNCACHED_ENDPOINTS = ('predict',)
+
+
+class QueryCounter:
+    """Counts SQL statements executed by the current thread."""
+
+    def __init__(self, engine):
+        self._local = threading.local()
+        self.engine = engine
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self._local.count = getattr(self._local, 'count', 0) + 1
+
+    def reset(self):
+        self._local.count = 0
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+    def close(self):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+def build_requests(name, seeded, count, rng):
+    """``count`` request specs for an endpoint, prepared before the clock starts."""
+    project_id = seeded['deployed_project']
+    if name == 'inference':
+        # Fresh image bytes per request, so the prediction cache does not short-circuit the model
+        return [('POST', '/inference', {
+            'headers': {'API-Key': seeded['api_key']},
+            'data': {'image': synthetic_png(rng)},
+        }) for _ in range(count)]
+    if name == 'predict':
+        image_ids = seeded['image_ids'][project_id]
+        return [('POST', f'/projects/{project_id}/predict', {
+            'data': {'image_id': image_ids[i % len(image_ids)]},
+        }) for i in range(count)]
+    if name == 'dashboard':
+        return [('GET', '/dashboard', {}) for _ in range(count)]
+    if name == 'analyze_project':
+        project_ids = seeded['project_ids']
+        return [('GET', f'/projects/{project_ids[i % len(project_ids)]}/analyze', {}) for i in range(count)]
+    raise ValueError(f'Unknown endpoint: {name}')
+
+
+def send(client, method, path, options):
+    options = dict(options)
+    if 'data' in options and 'image' in options['data']:
+        # Streams are single-use, so the upload is wrapped at send time
+        options['data'] = dict(options['data'], image=(io.BytesIO(options['data']['image']), 'bench.png'))
+        options['content_type'] = 'multipart/form-data'
+    return client.open(path, method=method, **options)
+
+
+def summarize(latencies, queries, errors, elapsed, cache_hits=0, cache_lookups=0):
+    latencies = np.asarray(latencies) * 1000
+    return {
+        'requests': int(len(latencies)),
+        'errors': errors,
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'latency_ms': {
+            'mean': float(latencies.mean()),
+            'p50': float(np.percentile(latencies, 50)),
+            'p95': float(np.percentile(latencies, 95)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max()),
+        },
+        'queries_per_request': {
+            'mean': float(np.mean(queries)),
+            'max': int(np.max(queries)),
+        },
+        # None when the endpoint never consulted the prediction cache
+        'prediction_cache_hit_rate': cache_hits / cache_lookups if cache_lookups else None,
+    }
+
+
+def run_load(app, seeded, endpoints=ENDPOINTS, requests=100, concurrency=4, warmup=5, seed=0):
+    """Drive each endpoint with ``requests`` calls from ``concurrency`` threads and return per-endpoint stats."""
+    from models import db
+    from extensions import prediction_cache
+
+    rng = np.random.default_rng(seed)
+    local = threading.local()
+    clients = []
+    clients_lock = threading.Lock()
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+
+    def client_for_thread():
+        # Each load thread logs in once, as one of the seeded users in turn
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+            with clients_lock:
+                clients.append(local.client)
+                username = seeded['usernames'][(len(clients) - 1) % len(seeded['usernames'])]
+            local.client.post('/login', data={'username': username, 'password': PASSWORD})
+        return local.client
+
+    def timed(spec):
+        client = client_for_thread()
+        counter.reset()
+        started = time.perf_counter()
+        response = send(client, *spec)
+        latency = time.perf_counter() - started
+        return latency, counter.count, response.status_code
+
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='bench') as executor:
+            for name in endpoints:
+                max_entries = prediction_cache.max_entries
+                if name in UNCACHED_ENDPOINTS:
+                    prediction_cache.max_entries = 0
+                try:
+                    list(executor.map(timed, build_requests(name, seeded, warmup, rng)))
+                    specs = build_requests(name, seeded, requests, rng)
+                    before = prediction_cache.stats()
+                    started = time.perf_counter()
+                    samples = list(executor.map(timed, specs))
+                    elapsed = time.perf_counter() - started
+                    after = prediction_cache.stats()
+                finally:
+                    prediction_cache.max_entries = max_entries
+                latencies, queries, statuses = zip(*samples)
+                errors = sum(1 for status in statuses if status != 200)
+                hits = after['hits'] - before['hits']
+                results[name] = summarize(latencies, queries, errors, elapsed,
+                                          hits, hits + after['misses'] - before['misses'])
+    finally:
+        counter.close()
+    return results
+
+
+def compare(results, baseline, threshold=0.1):
+    """Regressions of ``results`` against ``baseline``, as human-readable strings.
+
+    Latency (p95) and throughput are allowed to drift by ``threshold``
+    (a fraction); query counts are deterministic, so any increase of more
+    than half a query per request is reported.
+    """
+    regressions = []
+    for name, current in results['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(name)
+        if previous is None:
+            continue
+        p95, old_p95 = current['latency_ms']['p95'], previous['latency_ms']['p95']
+        if p95 > old_p95 * (1 + threshold):
+            regressions.append(f'{name}: p95 latency {p95:.1f}ms vs baseline {old_p95:.1f}ms')
+        rps, old_rps = current['throughput_rps'], previous['throughput_rps']
+        if rps < old_rps * (1 - threshold):
+            regressions.append(f'{name}: throughput {rps:.1f} req/s vs baseline {old_rps:.1f} req/s')
+        queries, old_queries = current['queries_per_request']['mean'], previous['queries_per_request']['mean']
+        if queries > old_queries + 0.5:
+            regressions.append(f'{name}: {queries:.1f} queries/request vs baseline {old_queries:.1f}')
+        if current['errors'] > previous['errors']:
+            regressions.append(f'{name}: {current["errors"]} errors vs baseline {previous["errors"]}')
+    return regressions
+
+
+def format_table(results):
+    lines = [f'{"endpoint":<16}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"queries":>9}{"errors":>8}'
+             f'{"cache hits":>12}']
+    for name, stats in results['endpoints'].items():
+        latency = stats['latency_ms']
+        hit_rate = stats.get('prediction_cache_hit_rate')
+        lines.append(f'{name:<16}{stats["throughput_rps"]:>9.1f}{latency["p50"]:>9.1f}{latency["p95"]:>9.1f}'
+                     f'{latency["p99"]:>9.1f}{stats["queries_per_request"]["mean"]:>9.1f}{stats["errors"]:>8}'
+                     f'{"-" if hit_rate is None else f"{hit_rate:.0%}":>12}')
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--projects-per-user', type=int, default=2)
+    parser.add_argument('--images-per-project', type=int, default=50)
+    parser.add_argument('--labels-per-image', type=int, default=1)
+    parser.add_argument('--classes', type=int, default=10)
+    parser.add_argument('--model', choices=('tiny', 'default'), default='tiny',
+                        help='tiny: small offline Keras model; default: MobileNetV2 (downloads weights)')
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument('--requests', type=int, default=100, help='measured requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=5, help='unmeasured requests per endpoint')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='keep the seeded database and files here instead of a temp dir')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--baseline', help='compare with a previous results file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed relative latency/throughput regression (default 0.1 = 10%%)')
+    parser.add_argument('--save-baseline', action='store_true', help='also write results to --baseline')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+    from app import create_app
+    from models import db
+
+    args = parse_args(argv)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='diy-ml-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(os.path.abspath(workdir), "bench.sqlite")}',
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'STORAGE_FOLDER': os.path.join(workdir, 'storage'),
+        'TENSOR_CACHE_FOLDER': os.path.join(workdir, 'tensor_cache'),
+        'FEATURE_STORE_FOLDER': os.path.join(workdir, 'features'),
+        'MODEL_FOLDER': os.path.join(workdir, 'models'),
+        'WTF_CSRF_ENABLED': False,
+    })
+    try:
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            started = time.perf_counter()
+            seeded = seed_database(args.users, args.projects_per_user, args.images_per_project,
+                                   args.labels_per_image, args.classes, args.seed, args.model,
+                                   app.config['MODEL_FOLDER'])
+            seed_seconds = time.perf_counter() - started
+        endpoints = run_load(app, seeded, args.endpoints, args.requests, args.concurrency, args.warmup, args.seed)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        'config': {key: value for key, value in vars(args).items()
+                   if key not in ('workdir', 'output', 'baseline', 'save_baseline')},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count()},
+        'seed_seconds': seed_seconds,
+        'endpoints': endpoints,
+    }
+    print(format_table(results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    regressions = []
+    if args.baseline and os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+import io
+import os
+
+import numpy as np
+from PIL import Image as PILImage
+from werkzeug.datastructures import FileStorage
+
+from models import db, User, Project, Iteration, Deployment
+from ingest import ingest_images
+from labels import import_labels
+
+PASSWORD = 'benchmark'
+
+
+def synthetic_png(rng, size=64):
+    """PNG bytes of a random RGB image, reproducible from ``rng``."""
+    pixels = rng.integers(0, 256, size=(size, size, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    PILImage.fromarray(pixels).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def build_tiny_model(path, classes, seed):
+    """Save a small convolutional classifier so /inference and predict run a real forward pass offline."""
+    import tensorflow as tf
+
+    tf.keras.utils.set_random_seed(seed)
+    inputs = tf.keras.Input((224, 224, 3))
+    x = tf.keras.layers.Conv2D(8, 3, strides=4, activation='relu')(inputs)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    outputs = tf.keras.layers.Dense(classes, activation='softmax')(x)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tf.keras.Model(inputs, outputs).save(path)
+    return path
+
+
+def seed_database(users=4, projects_per_user=2, images_per_project=50, labels_per_image=1, classes=10,
+                  seed=0, model='tiny', model_folder=None):
+    """Create users, projects, images, labels and one deployment; return what the load generator needs.
+
+    Everything derives from ``seed``, so two runs with the same arguments
+    produce the same rows and image bytes. ``model='tiny'`` deploys a small
+    freshly built Keras model; ``model='default'`` deploys the MobileNetV2
+    default model (its ImageNet weights must be downloadable or cached).
+    """
+    rng = np.random.default_rng(seed)
+    usernames = []
+    project_ids = []
+    for u in range(users):
+        user = User(username=f'bench_user_{u}')
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        for p in range(projects_per_user):
+            db.session.add(Project(name=f'bench_project_{u}_{p}', description='benchmark',
+                                   project_type='classification', user=user))
+        db.session.commit()
+        usernames.append(user.username)
+        project_ids.extend(project.id for project in Project.query.filter_by(user_id=user.id).order_by(Project.id))
+
+    image_ids = {}
+    for project_id in project_ids:
+        files = [FileStorage(io.BytesIO(synthetic_png(rng)), filename=f'img_{i}.png')
+                 for i in range(images_per_project)]
+        report = ingest_images(project_id, files)
+        image_ids[project_id] = [entry['image_id'] for entry in report['files'] if entry.get('status') == 'created']
+        records = (
+            (f'image {image_id}', {'image_id': image_id, 'class_name': f'class_{int(rng.integers(classes))}'})
+            for image_id in image_ids[project_id] for _ in range(labels_per_image)
+        )
+        import_labels(project_id, records, source='manual')
+
+    deployed_project = project_ids[0]
+    iteration_id = None
+    if model == 'tiny':
+        path = build_tiny_model(os.path.join(model_folder, 'benchmark_tiny.keras'), classes, seed)
+        iteration = Iteration(project_id=deployed_project, status='completed', model_path=path)
+        db.session.add(iteration)
+        db.session.commit()
+        iteration_id = iteration.id
+    deployment = Deployment(project_id=deployed_project, iteration_id=iteration_id,
+                            api_key=f'bench-{seed}', active=True)
+    db.session.add(deployment)
+    db.session.commit()
+
+    return {
+        'usernames': usernames,
+        'project_ids': project_ids,
+        'image_ids': image_ids,
+        'deployed_project': deployed_project,
+        'api_key': deployment.api_key,
+    }
@@ -0,0 +1,165 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import select
+
+from extensions import tensor_cache, storage
+from storage import LocalStorage
+from models import db, Project, Image, Iteration
+from ml import INPUT_SIZE, cache_image_tensor
+from runtimes import RUNTIMES, ensure_exported
+from garbage import garbage_collector
+
+tensor_cache_cli = AppGroup('tensor-cache', help='Manage the preprocessed image tensor cache.')
+storage_cli = AppGroup('storage', help='Manage content-addressed upload storage.')
+models_cli = AppGroup('models', help='Convert trained models to optimized runtimes.')
+gc_cli = AppGroup('gc', help='Reclaim files and rows left behind by deletes.')
+
+
+def _parse_size(value):
+    height, _, width = value.partition('x')
+    return (int(height), int(width or height))
+
+
+@tensor_cache_cli.command('backfill')
+@click.option('--project-id', type=int, default=None, help='Only backfill this project.')
+@click.option('--size', default=f'{INPUT_SIZE[0]}x{INPUT_SIZE[1]}', show_default=True, help='Model input size, HxW.')
+@click.option('--workers', type=int, default=4, show_default=True)
+@click.option('--prune/--no-prune', default=True, show_default=True, help='Remove shards built for other sizes.')
+def backfill(project_id, size, workers, prune):
+    """Cache tensors for existing images that do not have one yet."""
+    size = _parse_size(size)
+    query = select(Image.id, Image.filename, Image.digest, Image.project_id).order_by(Image.id)
+    if project_id is not None:
+        query = query.where(Image.project_id == project_id)
+    rows = [row for row in db.session.execute(query)
+            if not tensor_cache.contains(row.project_id, row.id, size)]
+
+    def cache(row):
+        try:
+            with storage.image_source(row) as source:
+                cache_image_tensor(row.project_id, row.id, source, size)
+            return None
+        except Exception as e:
+            return f'image {row.id} ({row.filename}): {e}'
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        errors = [error for error in executor.map(cache, rows) if error]
+    for error in errors:
+        click.echo(f'Skipped {error}', err=True)
+    click.echo(f'Cached {len(rows) - len(errors)} image tensors at {size[0]}x{size[1]}.')
+
+    if prune:
+        project_ids = [project_id] if project_id is not None else [p.id for p in Project.query.all()]
+        for pid in project_ids:
+            for removed in tensor_cache.prune_sizes(pid, size):
+                click.echo(f'Removed {removed[0]}x{removed[1]} shards for project {pid}.')
+
+
+@storage_cli.command('migrate')
+@click.option('--batch-size', type=int, default=500, show_default=True)
+@click.option('--delete-originals', is_flag=True, help='Remove flat upload files once no image row needs them.')
+def migrate_storage(batch_size, delete_originals):
+    """Move flat uploads into content-addressed storage and record their digests.
+
+    Blobs still sharded directly under the upload folder, where older
+    versions kept them, are moved into the blob folder first.
+    """
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    moved_blobs = _move_legacy_blobs(upload_folder)
+    if moved_blobs:
+        click.echo(f'Moved {moved_blobs} blobs into {storage.backend.root}.')
+    migrated, missing = 0, []
+    moved_files = set()
+    last_id = 0
+    while True:
+        images = (Image.query.filter(Image.digest.is_(None), Image.id > last_id)
+                  .order_by(Image.id).limit(batch_size).all())
+        if not images:
+            break
+        for image in images:
+            path = os.path.join(upload_folder, image.filename)
+            if not os.path.isfile(path):
+                missing.append(image)
+                continue
+            with open(path, 'rb') as f:
+                image.digest, _, _ = storage.save_stream(f)
+            moved_files.add(image.filename)
+            migrated += 1
+        db.session.commit()
+        last_id = images[-1].id
+
+    for image in missing:
+        click.echo(f'Missing file for image {image.id}: {image.filename}', err=True)
+    click.echo(f'Migrated {migrated} images into content-addressed storage.')
+
+    if delete_originals:
+        still_needed = {filename for (filename,) in db.session.execute(
+            select(Image.filename).where(Image.digest.is_(None)))}
+        removed = 0
+        for filename in moved_files - still_needed:
+            os.unlink(os.path.join(upload_folder, filename))
+            removed += 1
+        click.echo(f'Removed {removed} original files.')
+
+
+def _move_legacy_blobs(upload_folder):
+    if not isinstance(storage.backend, LocalStorage):
+        return 0
+    legacy = LocalStorage(upload_folder)
+    if os.path.abspath(legacy.root) == os.path.abspath(storage.backend.root):
+        return 0
+    moved = 0
+    for digest in list(legacy.iter_digests()):
+        target = storage.backend.local_path(digest)
+        if os.path.exists(target):
+            os.unlink(legacy.local_path(digest))
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(legacy.local_path(digest), target)
+        moved += 1
+    return moved
+
+
+@models_cli.command('export')
+@click.option('--project-id', type=int, required=True, help='Project whose images form the calibration set.')
+@click.option('--iteration-id', type=int, default=None, help='Iteration to convert; the default model if omitted.')
+@click.option('--runtime', type=click.Choice([r for r in RUNTIMES if r != 'keras']), default='tflite-int8',
+              show_default=True)
+@click.option('--calibration-size', type=int, default=100, show_default=True)
+@click.option('--force', is_flag=True, help='Convert again even if an up-to-date artifact exists.')
+def export_model(project_id, iteration_id, runtime, calibration_size, force):
+    """Convert a model to TFLite and print its agreement and latency report."""
+    iteration = None
+    if iteration_id is not None:
+        iteration = db.session.get(Iteration, iteration_id)
+        if iteration is None or not iteration.model_path:
+            raise click.BadParameter(f'Iteration {iteration_id} has no trained model', param_hint='--iteration-id')
+    path, report = ensure_exported(project_id, iteration, runtime, calibration_size, force=force)
+    click.echo(f'Wrote {path}')
+    click.echo(json.dumps(report, indent=2))
+
+
+@gc_cli.command('collect')
+@click.option('--sweep/--queued-only', default=True, show_default=True,
+              help='Also find orphans left by earlier deletes, not just what this process queued.')
+@click.option('--grace', type=float, default=None, help='Override GC_GRACE_SECONDS for this run.')
+@click.option('--uploads', is_flag=True,
+              help='Also delete every image file directly in UPLOAD_FOLDER that no image row references.')
+def collect_garbage(sweep, grace, uploads):
+    """Delete orphaned rows, unreferenced blobs, stale cache directories and model artifacts."""
+    if grace is not None:
+        current_app.config['GC_GRACE_SECONDS'] = grace
+    report = garbage_collector.collect(sweep=sweep, uploads=uploads)
+    click.echo(', '.join(f'{count} {name.replace("_", " ")}' for name, count in report.items()) + ' removed.')
+
+
+def register_commands(app):
+    app.cli.add_command(tensor_cache_cli)
+    app.cli.add_command(storage_cli)
+    app.cli.add_command(models_cli)
+    app.cli.add_command(gc_cli)
@@ -4,6 +4,64 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY', 'you-will-never-guess')
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    MODEL_REGISTRY_MAX_MODELS = int(os.environ.get('MODEL_REGISTRY_MAX_MODELS', 4))
+    MODEL_REGISTRY_MAX_BYTES = int(os.environ.get('MODEL_REGISTRY_MAX_BYTES', 2 * 1024 ** 3))
+    INFERENCE_MAX_BATCH_SIZE = int(os.environ.get('INFERENCE_MAX_BATCH_SIZE', 32))
+    INFERENCE_MAX_WAIT_MS = float(os.environ.get('INFERENCE_MAX_WAIT_MS', 5))
+    INFERENCE_TIMEOUT = float(os.environ.get('INFERENCE_TIMEOUT', 30))
+    INFERENCE_MAX_PAYLOAD_BYTES = int(os.environ.get('INFERENCE_MAX_PAYLOAD_BYTES', 10 * 1024 * 1024))
+    INFERENCE_MAX_IMAGE_PIXELS = int(os.environ.get('INFERENCE_MAX_IMAGE_PIXELS', 40_000_000))
+    INFERENCE_PERSIST_UPLOADS = os.environ.get('INFERENCE_PERSIST_UPLOADS', '').lower() in ('1', 'true', 'yes')
+    BATCH_PREDICT_BATCH_SIZE = int(os.environ.get('BATCH_PREDICT_BATCH_SIZE', 32))
+    BATCH_PREDICT_MAX_BATCH_SIZE = int(os.environ.get('BATCH_PREDICT_MAX_BATCH_SIZE', 256))
+    BATCH_PREDICT_WORKERS = int(os.environ.get('BATCH_PREDICT_WORKERS', 4))
+    TENSOR_CACHE_FOLDER = os.environ.get('TENSOR_CACHE_FOLDER')
+    TENSOR_CACHE_SHARD_SIZE = int(os.environ.get('TENSOR_CACHE_SHARD_SIZE', 1024))
+    TENSOR_CACHE_MAX_OPEN_SHARDS = int(os.environ.get('TENSOR_CACHE_MAX_OPEN_SHARDS', 64))
+    FEATURE_STORE_FOLDER = os.environ.get('FEATURE_STORE_FOLDER')
+    EMBEDDING_INDEX_DIM = int(os.environ.get('EMBEDDING_INDEX_DIM', 128))
+    EMBEDDING_INDEX_MAX_PROJECTS = int(os.environ.get('EMBEDDING_INDEX_MAX_PROJECTS', 4))
+    EMBEDDING_DUPLICATE_THRESHOLD = float(os.environ.get('EMBEDDING_DUPLICATE_THRESHOLD', 0.95))
+    PREDICTION_CACHE_MAX_ENTRIES = int(os.environ.get('PREDICTION_CACHE_MAX_ENTRIES', 10000))
+    PREDICTION_CACHE_SQLITE = os.environ.get('PREDICTION_CACHE_SQLITE')
+    INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 500))
+    INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', 4))
+    INGEST_MAX_FILE_BYTES = int(os.environ.get('INGEST_MAX_FILE_BYTES', 50 * 1024 * 1024))
+    LABEL_IMPORT_BATCH_SIZE = int(os.environ.get('LABEL_IMPORT_BATCH_SIZE', 5000))
+    LABEL_IMPORT_MAX_COCO_BYTES = int(os.environ.get('LABEL_IMPORT_MAX_COCO_BYTES', 100 * 1024 * 1024))
+    PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 1000))
+    MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 10000))
+    API_KEY_CACHE_TTL = float(os.environ.get('API_KEY_CACHE_TTL', 30))
+    API_KEY_CACHE_MISS_TTL = float(os.environ.get('API_KEY_CACHE_MISS_TTL', 1))
+    API_KEY_CACHE_MAX_ENTRIES = int(os.environ.get('API_KEY_CACHE_MAX_ENTRIES', 10000))
+    USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60))
+    USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', 10000))
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '').lower() in ('1', 'true', 'yes')
+    METRICS_SERVER_TIMING = os.environ.get('METRICS_SERVER_TIMING', '').lower() in ('1', 'true', 'yes')
+    RUNTIME_CALIBRATION_SIZE = int(os.environ.get('RUNTIME_CALIBRATION_SIZE', 100))
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+    STORAGE_FOLDER = os.environ.get('STORAGE_FOLDER')
+    STORAGE_ASYNC_WORKERS = int(os.environ.get('STORAGE_ASYNC_WORKERS', 2))
+    STORAGE_ASYNC_MAX_PENDING = int(os.environ.get('STORAGE_ASYNC_MAX_PENDING', 256))
+    GC_INTERVAL = float(os.environ.get('GC_INTERVAL', 3600))
+    GC_GRACE_SECONDS = float(os.environ.get('GC_GRACE_SECONDS', 300))
+    GC_DELETE_CHUNK_SIZE = int(os.environ.get('GC_DELETE_CHUNK_SIZE', 1000))
+    MODEL_FOLDER = os.environ.get('MODEL_FOLDER')
+    TRAINING_FUNCTION = os.environ.get('TRAINING_FUNCTION', 'training.train_classifier')
+    TRAINING_MAX_WORKERS = int(os.environ.get('TRAINING_MAX_WORKERS', 2))
+    TRAINING_MAX_JOBS_PER_USER = int(os.environ.get('TRAINING_MAX_JOBS_PER_USER', 1))
+    TRAINING_POLL_INTERVAL = float(os.environ.get('TRAINING_POLL_INTERVAL', 2))
+    TRAINING_HEARTBEAT_TIMEOUT = float(os.environ.get('TRAINING_HEARTBEAT_TIMEOUT', 60))
+    TRAINING_MAX_ATTEMPTS = int(os.environ.get('TRAINING_MAX_ATTEMPTS', 3))
+    TRAINING_DISPATCH = os.environ.get('TRAINING_DISPATCH', 'true').lower() in ('1', 'true', 'yes')
+    SERVE_HOST = os.environ.get('SERVE_HOST', '0.0.0.0')
+    SERVE_PORT = int(os.environ.get('SERVE_PORT', 5000))
+    SERVE_WEB_WORKERS = int(os.environ.get('SERVE_WEB_WORKERS', 4))
+    SERVE_INFERENCE_WORKERS = int(os.environ.get('SERVE_INFERENCE_WORKERS', 1))
+    SERVE_QUEUE_SLOTS = int(os.environ.get('SERVE_QUEUE_SLOTS', 32))
+    SERVE_SLOT_BYTES = int(os.environ.get('SERVE_SLOT_BYTES', 224 * 224 * 3 * 4))
+    SERVE_DRAIN_TIMEOUT = float(os.environ.get('SERVE_DRAIN_TIMEOUT', 30))
+    EAGER_MODEL_WARMUP = os.environ.get('EAGER_MODEL_WARMUP', '').lower() in ('1', 'true', 'yes')
 
 class DevelopmentConfig(Config):
     DEBUG = True
@@ -14,4 +72,4 @@ class TestingConfig(Config):
     WTF_CSRF_ENABLED = False
 
 class ProductionConfig(Config):
-    pass
+    EAGER_MODEL_WARMUP = True
@@ -0,0 +1,359 @@
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on the score block materialised at once (rows x columns), about 64 MB of float32
+SCORE_BLOCK_ELEMENTS = 16 * 1024 * 1024
+
+
+def _backbone_features(x):
+    from ml import get_feature_extractor
+    return np.asarray(get_feature_extractor().predict_on_batch(x))
+
+
+class ProjectIndex:
+    """Unit-length embeddings of one project's images in a contiguous float32 matrix.
+
+    Rows are ordered by image id, which new uploads keep by arriving with
+    increasing ids, and the matrix doubles its capacity when full. Removed
+    rows are masked out of queries until a quarter of the matrix is dead,
+    then compacted into fresh arrays so snapshots held by readers stay valid.
+    ``skipped`` holds ids of images that could not be decoded.
+    """
+
+    def __init__(self, ids, vectors, skipped=()):
+        self.skipped = set(skipped)
+        self._lock = threading.Lock()
+        self._reset(np.asarray(ids, dtype=np.int64), np.asarray(vectors, dtype=np.float32))
+
+    def __len__(self):
+        return self.size - self.removed
+
+    def add(self, ids, vectors):
+        ids = np.asarray(ids, dtype=np.int64)
+        order = np.argsort(ids, kind='stable')
+        ids, vectors = ids[order], np.asarray(vectors, dtype=np.float32)[order]
+        with self._lock:
+            self.skipped.difference_update(ids.tolist())
+            if self.size and len(ids) and ids[0] <= self.ids[self.size - 1]:
+                # SQLite can hand out a deleted row's id again, which lands out of order
+                live_ids, live_vectors = self._live()
+                keep = ~np.isin(live_ids, ids)
+                self._reset(np.concatenate([live_ids[keep], ids]), np.concatenate([live_vectors[keep], vectors]))
+                return
+            end = self.size + len(ids)
+            if end > len(self.ids):
+                self._grow(end)
+            self.ids[self.size:end] = ids
+            self.matrix[self.size:end] = vectors
+            self.live[self.size:end] = True
+            self.size = end
+
+    def remove(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        with self._lock:
+            self.skipped.difference_update(ids.tolist())
+            rows = self._rows(ids)
+            rows = rows[self.live[rows]]
+            self.live[rows] = False
+            self.removed += len(rows)
+            if self.removed * 4 > self.size:
+                self._reset(*self._live())
+
+    def vector(self, image_id):
+        with self._lock:
+            rows = self._rows(np.asarray([image_id], dtype=np.int64))
+            if not len(rows) or not self.live[rows[0]]:
+                raise KeyError(image_id)
+            return self.matrix[rows[0]].copy()
+
+    def known_ids(self):
+        """Ids of every indexed or skipped image."""
+        with self._lock:
+            ids = self._live()[0]
+        return np.union1d(ids, np.fromiter(self.skipped, dtype=np.int64, count=len(self.skipped)))
+
+    def signature(self):
+        """``(image count, highest image id)`` this index accounts for, comparable with the database's."""
+        known = self.known_ids()
+        return len(known), int(known[-1]) if len(known) else None
+
+    def search(self, queries, k, batch_size=256):
+        """Top-``k`` ``(ids, scores)`` by cosine similarity for each row of ``queries``."""
+        ids, matrix, dead = self._snapshot()
+        k = min(k, len(ids) - len(dead))
+        if k <= 0:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in queries]
+        results = []
+        # Query rows are scored in blocks so the score matrix stays bounded for large projects
+        batch_size = max(1, min(batch_size, SCORE_BLOCK_ELEMENTS // len(ids)))
+        for start in range(0, len(queries), batch_size):
+            scores = queries[start:start + batch_size] @ matrix.T
+            if len(dead):
+                scores[:, dead] = -np.inf
+            top = np.argpartition(scores, -k, axis=1)[:, -k:]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1)
+            top, top_scores = np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+            results.extend((ids[row], row_scores) for row, row_scores in zip(top, top_scores))
+        return results
+
+    def duplicates(self, threshold):
+        """Groups of image ids whose pairwise-linked similarity is at least ``threshold``.
+
+        Compares every pair once, in blocks of the upper triangle, and joins
+        pairs into groups with union-find; this is O(n^2) work and meant for
+        an occasional report, not per request.
+        """
+        ids, matrix, dead = self._snapshot()
+        if len(dead):
+            keep = np.ones(len(ids), dtype=bool)
+            keep[dead] = False
+            ids, matrix = ids[keep], matrix[keep]
+        n = len(ids)
+        parent = {}
+
+        def find(i):
+            root = i
+            while parent.get(root, root) != root:
+                root = parent[root]
+            while i != root:
+                parent[i], i = root, parent[i]
+            return root
+
+        block = max(1, min(1024, SCORE_BLOCK_ELEMENTS // max(n, 1)))
+        for start in range(0, n, block):
+            scores = matrix[start:start + block] @ matrix[start:].T
+            rows, columns = np.nonzero(scores >= threshold)
+            upper = columns > rows
+            for i, j in zip((rows[upper] + start).tolist(), (columns[upper] + start).tolist()):
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j:
+                    parent[max(root_i, root_j)] = min(root_i, root_j)
+
+        groups = {}
+        for i in list(parent):
+            root = find(i)
+            groups.setdefault(root, [root]).append(i)
+        groups = [sorted(ids[members].tolist()) for members in groups.values()]
+        return sorted(groups, key=lambda group: (-len(group), group[0]))
+
+    def _snapshot(self):
+        with self._lock:
+            dead = np.flatnonzero(~self.live[:self.size]) if self.removed else np.empty(0, dtype=np.int64)
+            return self.ids[:self.size], self.matrix[:self.size], dead
+
+    def _live(self):
+        live = self.live[:self.size]
+        return self.ids[:self.size][live], self.matrix[:self.size][live]
+
+    def _rows(self, ids):
+        rows = np.searchsorted(self.ids[:self.size], ids)
+        rows = rows[rows < self.size]
+        return rows[np.isin(self.ids[rows], ids)]
+
+    def _reset(self, ids, vectors):
+        order = np.argsort(ids, kind='stable')
+        self.size = len(ids)
+        self.removed = 0
+        self.ids = np.empty(max(self.size, 16), dtype=np.int64)
+        self.matrix = np.empty((len(self.ids), vectors.shape[1]), dtype=np.float32)
+        self.live = np.zeros(len(self.ids), dtype=bool)
+        self.ids[:self.size] = ids[order]
+        self.matrix[:self.size] = vectors[order]
+        self.live[:self.size] = True
+
+    def _grow(self, needed):
+        # New arrays rather than resizing in place, so outstanding snapshots are untouched
+        capacity = max(needed, 2 * len(self.ids))
+        ids = np.empty(capacity, dtype=np.int64)
+        matrix = np.empty((capacity, self.matrix.shape[1]), dtype=np.float32)
+        live = np.zeros(capacity, dtype=bool)
+        ids[:self.size], matrix[:self.size], live[:self.size] = \
+            self.ids[:self.size], self.matrix[:self.size], self.live[:self.size]
+        self.ids, self.matrix, self.live = ids, matrix, live
+
+
+class EmbeddingIndex:
+    """Cosine-similarity search over backbone embeddings, one in-memory index per project.
+
+    A project's index is built on first use from the feature store
+    (computing embeddings only for images not stored yet), reduced to
+    ``EMBEDDING_INDEX_DIM`` dimensions by a fixed random projection and
+    normalised, and kept current by add() and remove() as images are
+    uploaded and deleted. Indexes are per process: before each query the
+    image count and highest id are compared with the database, and a
+    mismatch (changes made by another worker) is reconciled first. At most
+    ``EMBEDDING_INDEX_MAX_PROJECTS`` indexes are kept, least recently used
+    first out.
+    """
+
+    def __init__(self, app=None):
+        self.dim = 128
+        self.max_projects = 4
+        self.embed_fn = _backbone_features
+        self._projects = OrderedDict()
+        self._building = {}
+        self._projections = {}
+        self._guard = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.dim = app.config.get('EMBEDDING_INDEX_DIM', self.dim)
+        self.max_projects = app.config.get('EMBEDDING_INDEX_MAX_PROJECTS', self.max_projects)
+        self.clear()
+        app.extensions['embedding_index'] = self
+
+    def clear(self):
+        with self._guard:
+            self._projects.clear()
+
+    def loaded(self, project_id):
+        return project_id in self._projects
+
+    def vectors(self, features):
+        """Unit-length index vectors for backbone ``features``, projected when they are wider than ``dim``."""
+        features = np.asarray(features, dtype=np.float32)
+        if self.dim and self.dim < features.shape[1]:
+            features = features @ self._projection(features.shape[1])
+        norms = np.linalg.norm(features, axis=1, keepdims=True)
+        return features / np.maximum(norms, 1e-12)
+
+    def embed(self, pixels):
+        """Index vectors for ``(N, H, W, 3)`` pixels in [0, 255] at the backbone input size."""
+        from ml import preprocess_input
+        return self.vectors(self.embed_fn(preprocess_input(pixels)))
+
+    def get(self, project_id):
+        """The project's index, built or reconciled with the database as needed."""
+        with self._guard:
+            index = self._projects.get(project_id)
+            if index is not None:
+                self._projects.move_to_end(project_id)
+            lock = self._building.setdefault(project_id, threading.Lock())
+        with lock:
+            signature = _database_signature(project_id)
+            index = self._projects.get(project_id)
+            if index is None:
+                index = self._build(project_id)
+                with self._guard:
+                    self._projects[project_id] = index
+                    while len(self._projects) > self.max_projects:
+                        self._projects.popitem(last=False)
+            if index.signature() != signature:
+                self._reconcile(project_id, index)
+        return index
+
+    def add(self, project_id, image_ids, pixels):
+        """Index newly stored images; a no-op for projects whose index is not loaded."""
+        index = self._projects.get(project_id)
+        if index is None or not len(image_ids):
+            return
+        index.add(image_ids, self.embed(np.stack(pixels)))
+
+    def remove(self, project_id, image_ids):
+        index = self._projects.get(project_id)
+        if index is not None:
+            index.remove(image_ids)
+
+    def drop(self, project_id):
+        with self._guard:
+            self._projects.pop(project_id, None)
+
+    def similar(self, project_id, k=10, image_id=None, pixels=None):
+        """``(image_id, score)`` pairs most similar to an indexed image or to new ``pixels``."""
+        index = self.get(project_id)
+        if image_id is not None:
+            ids, scores = index.search(index.vector(image_id)[None], k + 1)[0]
+            keep = ids != image_id
+            ids, scores = ids[keep][:k], scores[keep][:k]
+        else:
+            ids, scores = index.search(self.embed(np.asarray(pixels)[None]), k)[0]
+        return list(zip(ids.tolist(), scores.tolist()))
+
+    def duplicates(self, project_id, threshold):
+        index = self.get(project_id)
+        return index.duplicates(threshold), len(index)
+
+    def stats(self):
+        with self._guard:
+            return {str(project_id): {'images': len(index), 'dim': int(index.matrix.shape[1])}
+                    for project_id, index in self._projects.items()}
+
+    def _build(self, project_id):
+        from models import db, Image
+        rows = db.session.execute(db.select(Image.id, Image.filename, Image.digest)
+                                  .where(Image.project_id == project_id).order_by(Image.id)).all()
+        ids, features, skipped = self._features(project_id, rows)
+        dim = self.dim or features.shape[1]
+        vectors = self.vectors(features) if len(ids) else np.empty((0, dim), dtype=np.float32)
+        return ProjectIndex(ids, vectors, skipped)
+
+    def _reconcile(self, project_id, index):
+        from models import db, Image
+        rows = db.session.execute(db.select(Image.id, Image.filename, Image.digest)
+                                  .where(Image.project_id == project_id).order_by(Image.id)).all()
+        database_ids = np.asarray([row.id for row in rows], dtype=np.int64)
+        known = index.known_ids()
+        gone = np.setdiff1d(known, database_ids)
+        if len(gone):
+            index.remove(gone)
+        new = set(np.setdiff1d(database_ids, known).tolist())
+        if new:
+            ids, features, skipped = self._features(project_id, [row for row in rows if row.id in new])
+            if len(ids):
+                index.add(ids, self.vectors(features))
+            index.skipped.update(skipped)
+
+    def _features(self, project_id, rows):
+        """Backbone features for ``rows`` from the feature store, computing missing ones, plus undecodable ids."""
+        from extensions import feature_store, storage
+        from ml import BACKBONE_VERSION, load_image_tensor
+        sources = {row.id: row for row in rows}
+        stored, _ = feature_store.load(project_id, BACKBONE_VERSION)
+        skipped = set()
+        # Decoding first keeps images that cannot be read out of the feature store; the pixels are cached
+        for image_id in np.setdiff1d(list(sources), stored).tolist():
+            try:
+                with storage.image_source(sources[image_id]) as source:
+                    load_image_tensor(project_id, image_id, source)
+            except Exception as e:
+                logger.warning('Not indexing image %s: %s', image_id, e)
+                skipped.add(image_id)
+        ids = [image_id for image_id in sources if image_id not in skipped]
+
+        def load(image_id):
+            with storage.image_source(sources[image_id]) as source:
+                return load_image_tensor(project_id, image_id, source)
+
+        def compute(image_ids):
+            return self.embed_fn(np.stack([load(image_id) for image_id in image_ids]))
+
+        return np.asarray(ids, dtype=np.int64), feature_store.ensure(project_id, BACKBONE_VERSION, ids, compute), skipped
+
+    def _projection(self, input_dim):
+        # Seeded, so every process maps the same features to the same vectors
+        key = (input_dim, self.dim)
+        with self._guard:
+            if key not in self._projections:
+                rng = np.random.default_rng(0)
+                self._projections[key] = (rng.standard_normal((input_dim, self.dim))
+                                          / np.sqrt(self.dim)).astype(np.float32)
+            return self._projections[key]
+
+
+def _database_signature(project_id):
+    from sqlalchemy import func
+    from models import db, Image, ProjectStats
+    count, highest = db.session.execute(db.select(
+        db.select(ProjectStats.image_count).where(ProjectStats.project_id == project_id).scalar_subquery(),
+        db.select(func.max(Image.id)).where(Image.project_id == project_id).scalar_subquery(),
+    )).one()
+    if count is None:
+        count = db.session.scalar(db.select(func.count(Image.id)).where(Image.project_id == project_id))
+    return count, highest
@@ -1,3 +1,24 @@
 from flask_sqlalchemy import SQLAlchemy
+from model_registry import ModelRegistry
+from batching import BatcherPool
+from tensor_cache import TensorCache
+from prediction_cache import PredictionCache
+from storage import Storage
+from feature_store import FeatureStore
+from ttl_cache import TTLCache
+from metrics import Metrics
+from inference_pool import InferencePool
+from embedding_index import EmbeddingIndex
 
 db = SQLAlchemy()
+model_registry = ModelRegistry()
+inference_batchers = BatcherPool()
+inference_pool = InferencePool()
+tensor_cache = TensorCache()
+prediction_cache = PredictionCache()
+storage = Storage()
+feature_store = FeatureStore()
+embedding_index = EmbeddingIndex()
+api_key_cache = TTLCache('API_KEY_CACHE')
+user_cache = TTLCache('USER_CACHE')
+metrics = Metrics()
@@ -0,0 +1,156 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CURRENT_FILE = 'CURRENT'
+REMOVED_FILE = 'removed.txt'
+
+
+class FeatureStore:
+    """Backbone embeddings computed once per (image, backbone version).
+
+    Each project keeps one directory per backbone version. A generation
+    subdirectory holds ``ids.npy`` (sorted image ids) and ``features.npy``
+    (one float32 row per id), so a project's embeddings are a single
+    contiguous matrix that can be memory mapped. ``CURRENT`` names the live
+    generation and how much of the project's ``removed.txt`` it already
+    excludes; a rewrite builds a new generation and switches ``CURRENT``
+    with one rename, so a reader in any process sees both arrays of the same
+    generation. Deleting an image only appends its id to ``removed.txt``,
+    which is never truncated; rows are dropped the next time the arrays are
+    rewritten.
+    """
+
+    def __init__(self, app=None, root=None):
+        self.root = root
+        self._locks = {}
+        self._guard = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.root = app.config.get('FEATURE_STORE_FOLDER') or os.path.join(app.instance_path, 'features')
+        app.extensions['feature_store'] = self
+
+    def load(self, project_id, version):
+        """Return ``(ids, features)`` for every live image, memory-mapped where possible."""
+        ids, features, _, _ = self._read(project_id, version)
+        return ids, features
+
+    def ensure(self, project_id, version, image_ids, compute_fn, batch_size=64):
+        """Features for ``image_ids`` in order, computing only the ones not stored yet.
+
+        ``compute_fn`` receives a list of image ids and returns an array with
+        one feature row per id.
+        """
+        image_ids = np.asarray(image_ids, dtype=np.int64)
+        with self._lock(project_id, version):
+            ids, features, generation, applied = self._read(project_id, version)
+            missing = np.setdiff1d(image_ids, ids)
+            if len(missing) or applied < self._removed_size(project_id):
+                computed = [np.asarray(compute_fn(missing[i:i + batch_size].tolist()), dtype=np.float32)
+                            for i in range(0, len(missing), batch_size)]
+                ids, features = self._append(project_id, version, ids, features, missing, computed,
+                                             generation, applied)
+            if not len(image_ids):
+                return np.empty((0, features.shape[1] if features is not None else 0), dtype=np.float32)
+            return np.asarray(features[np.searchsorted(ids, image_ids)])
+
+    def remove(self, project_id, image_ids):
+        project_dir = self._project_dir(project_id)
+        if not os.path.isdir(project_dir):
+            return
+        with open(os.path.join(project_dir, REMOVED_FILE), 'a') as f:
+            f.writelines(f'{int(image_id)}\n' for image_id in image_ids)
+
+    def drop_project(self, project_id):
+        shutil.rmtree(self._project_dir(project_id), ignore_errors=True)
+
+    def _read(self, project_id, version):
+        # Returns (ids, features, generation, bytes of removed.txt applied); the retry
+        # covers a generation being replaced between reading CURRENT and opening it
+        version_dir = self._version_dir(project_id, version)
+        for _ in range(3):
+            try:
+                with open(os.path.join(version_dir, CURRENT_FILE)) as f:
+                    generation, applied = f.read().split()
+                applied = int(applied)
+                ids = np.load(os.path.join(version_dir, generation, 'ids.npy'))
+                features = np.load(os.path.join(version_dir, generation, 'features.npy'), mmap_mode='r')
+            except FileNotFoundError:
+                continue
+            break
+        else:
+            return np.empty(0, dtype=np.int64), None, None, 0
+        if len(ids) != len(features):
+            logger.warning('Feature store for project %s (%s) is inconsistent; rebuilding it', project_id, version)
+            return np.empty(0, dtype=np.int64), None, generation, 0
+        removed = self._removed(project_id, applied)
+        if removed:
+            keep = ~np.isin(ids, list(removed))
+            ids, features = ids[keep], features[keep]
+        return ids, features, generation, applied
+
+    def _append(self, project_id, version, ids, features, new_ids, new_features, previous, applied):
+        # Only removals read here are marked applied, so ones appended later still filter
+        start, applied = applied, self._removed_size(project_id)
+        removed = self._removed(project_id, start, applied)
+        if removed and features is not None:
+            keep = ~np.isin(ids, list(removed))
+            ids, features = ids[keep], features[keep]
+        if new_features:
+            new_features = np.concatenate(new_features)
+            features = new_features if features is None else np.concatenate([features, new_features])
+            ids = np.concatenate([ids, new_ids])
+        order = np.argsort(ids, kind='stable')
+        ids, features = ids[order], np.ascontiguousarray(features[order], dtype=np.float32)
+
+        version_dir = self._version_dir(project_id, version)
+        os.makedirs(version_dir, exist_ok=True)
+        generation_dir = tempfile.mkdtemp(prefix='gen_', dir=version_dir)
+        np.save(os.path.join(generation_dir, 'features.npy'), features)
+        np.save(os.path.join(generation_dir, 'ids.npy'), ids)
+        fd, tmp_path = tempfile.mkstemp(dir=version_dir)
+        with os.fdopen(fd, 'w') as f:
+            f.write(f'{os.path.basename(generation_dir)} {applied}\n')
+        os.replace(tmp_path, os.path.join(version_dir, CURRENT_FILE))
+        if previous is not None:
+            # Readers that already mapped the old arrays keep them until they let go
+            shutil.rmtree(os.path.join(version_dir, previous), ignore_errors=True)
+        return ids, features
+
+    def _removed(self, project_id, start, end=None):
+        # Ids appended to removed.txt between byte offsets ``start`` and ``end``
+        removed_path = os.path.join(self._project_dir(project_id), REMOVED_FILE)
+        if not os.path.exists(removed_path):
+            return set()
+        with open(removed_path, 'rb') as f:
+            f.seek(start)
+            data = f.read() if end is None else f.read(max(0, end - start))
+        # A line still being appended is left for the next read
+        return {int(line) for line in data[:data.rfind(b'\n') + 1].split()}
+
+    def _removed_size(self, project_id):
+        # Whole lines only, matching what _removed() consumes
+        removed_path = os.path.join(self._project_dir(project_id), REMOVED_FILE)
+        if not os.path.exists(removed_path):
+            return 0
+        with open(removed_path, 'rb') as f:
+            data = f.read()
+        return data.rfind(b'\n') + 1
+
+    def _lock(self, project_id, version):
+        with self._guard:
+            return self._locks.setdefault((project_id, version), threading.Lock())
+
+    def _project_dir(self, project_id):
+        return os.path.join(self.root, str(project_id))
+
+    def _version_dir(self, project_id, version):
+        return os.path.join(self._project_dir(project_id), version)
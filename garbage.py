@@ -0,0 +1,409 @@
+import itertools
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from collections import Counter
+
+from sqlalchemy import delete, select
+
+from models import db, Project, Image, Label, TrainingConfig, Iteration, Deployment, ProjectStats, ProjectLabelCount
+from extensions import (model_registry, inference_batchers, tensor_cache, prediction_cache, storage, feature_store,
+                        embedding_index, api_key_cache)
+from analytics import images_added, labels_added
+from prediction_cache import iteration_model_id
+from ingest import is_image_filename
+from runtimes import RUNTIMES, model_folder
+
+TRASH_DIR = '.trash'
+# Table columns rather than ORM attributes keep row loading cheap for large chunks
+IMAGE_COLUMNS = (Image.__table__.c.id, Image.__table__.c.project_id, Image.__table__.c.digest, Image.__table__.c.filename)
+MODEL_FILE = re.compile(r'^(?:iteration_(\d+)\.|project_(\d+)_default_)')
+
+
+def delete_images(image_ids, chunk_size=1000):
+    """Delete images and their labels with set-based statements, ``chunk_size`` images per transaction.
+
+    Project stats are adjusted in the same transaction; stored files are
+    queued for the garbage collector. Returns deleted row counts.
+    """
+    deleted = Counter()
+    image_ids = sorted(set(image_ids))
+    for start in range(0, len(image_ids), chunk_size):
+        rows = db.session.execute(select(*IMAGE_COLUMNS).where(Image.id.in_(image_ids[start:start + chunk_size]))).all()
+        if rows:
+            deleted += _delete_image_rows(rows, Image.id.in_([row.id for row in rows]), update_stats=True)
+            db.session.commit()
+            _forget_images(rows)
+            garbage_collector.enqueue(*_stored_files(rows))
+    return dict(deleted)
+
+
+def delete_projects(project_ids, chunk_size=1000):
+    """Delete projects and every row that belongs to them without loading any of it.
+
+    Images and labels go first, ``chunk_size`` images per transaction so a
+    large project never holds the database lock for long, then the
+    project's deployments, iterations, configs and stats in one final
+    transaction. Cache directories are moved aside at once (a reused
+    project id starts clean); files are reclaimed by the garbage collector.
+    Returns deleted row counts.
+    """
+    project_ids = sorted(set(project_ids))
+    if not project_ids:
+        return {}
+    deleted = Counter()
+    deployments = db.session.execute(select(Deployment.id, Deployment.api_key, Deployment.project_id,
+                                            Deployment.iteration_id, Deployment.runtime)
+                                     .where(Deployment.project_id.in_(project_ids))).all()
+    iteration_ids = db.session.scalars(select(Iteration.id).where(Iteration.project_id.in_(project_ids))).all()
+    digests, filenames = [], []
+    while True:
+        rows = db.session.execute(select(*IMAGE_COLUMNS).where(Image.project_id.in_(project_ids))
+                                  .order_by(Image.id).limit(chunk_size)).all()
+        if not rows:
+            break
+        # Rows come in id order, so the chunk is an id range rather than a long IN list
+        chunk = db.and_(Image.project_id.in_(project_ids), Image.id <= rows[-1].id)
+        deleted += _delete_image_rows(rows, chunk, update_stats=False)
+        db.session.commit()
+        # The project's caches are retired as a whole below; the collector starts once every chunk is done
+        chunk_digests, chunk_filenames = _stored_files(rows)
+        digests.extend(chunk_digests)
+        filenames.extend(chunk_filenames)
+
+    for name, statement in (
+        ('labels', delete(Label.__table__).where(Label.project_id.in_(project_ids))),
+        ('deployments', delete(Deployment.__table__).where(Deployment.project_id.in_(project_ids))),
+        ('iterations', delete(Iteration.__table__).where(Iteration.project_id.in_(project_ids))),
+        ('training_configs', delete(TrainingConfig.__table__).where(TrainingConfig.project_id.in_(project_ids))),
+        ('project_label_counts', delete(ProjectLabelCount.__table__).where(ProjectLabelCount.project_id.in_(project_ids))),
+        ('project_stats', delete(ProjectStats.__table__).where(ProjectStats.project_id.in_(project_ids))),
+        ('projects', delete(Project.__table__).where(Project.id.in_(project_ids))),
+    ):
+        deleted[name] += db.session.execute(statement).rowcount
+    db.session.commit()
+
+    # Bulk statements skip the ORM listeners, so in-process caches are invalidated here
+    for deployment in deployments:
+        api_key_cache.pop(deployment.api_key)
+        model_registry.invalidate_deployment(deployment)
+        inference_batchers.close(deployment.id)
+    _forget_iterations(iteration_ids)
+    for project_id in project_ids:
+        embedding_index.drop(project_id)
+        tensor_cache.forget(project_id)
+        for root in (tensor_cache.root, feature_store.root):
+            _retire(root, project_id)
+    garbage_collector.enqueue(digests, filenames, projects=project_ids, iterations=iteration_ids)
+    return dict(deleted)
+
+
+def forget_iteration(iteration_id):
+    """Invalidate caches of a deleted iteration and queue its model artifacts."""
+    _forget_iterations([iteration_id])
+    garbage_collector.enqueue(iterations=[iteration_id])
+
+
+def orphan_project_ids():
+    """Project ids still referenced by rows whose project no longer exists."""
+    orphans = set()
+    for column in (Image.project_id, Label.project_id, Iteration.project_id, TrainingConfig.project_id,
+                   Deployment.project_id, ProjectStats.project_id, ProjectLabelCount.project_id):
+        orphans.update(db.session.scalars(
+            select(column).distinct().where(column.is_not(None), column.not_in(select(Project.id)))))
+    return sorted(orphans)
+
+
+def delete_orphan_labels(chunk_size=1000):
+    """Delete labels whose image no longer exists, ``chunk_size`` per transaction; returns how many.
+
+    orphan_project_ids() only finds rows whose whole project is gone, so
+    this covers images deleted one at a time by code that left their labels.
+    """
+    orphaned = db.and_(Label.image_id.is_not(None), Label.image_id.not_in(select(Image.id)))
+    removed = 0
+    while True:
+        label_ids = db.session.scalars(select(Label.id).where(orphaned).order_by(Label.id).limit(chunk_size)).all()
+        if not label_ids:
+            return removed
+        label_counts = db.session.execute(
+            select(Label.project_id, Label.class_name, db.func.count(Label.id))
+            .where(Label.id.in_(label_ids)).group_by(Label.project_id, Label.class_name)).all()
+        removed += db.session.execute(delete(Label.__table__).where(Label.id.in_(label_ids))).rowcount
+        # They were counted when inserted, so the project stats still include them
+        per_project = {}
+        for project_id, class_name, count in label_counts:
+            per_project.setdefault(project_id, {})[class_name] = -count
+        connection = db.session.connection()
+        for project_id, deltas in per_project.items():
+            labels_added(connection, project_id, deltas)
+        db.session.commit()
+
+
+def _delete_image_rows(rows, criterion, update_stats):
+    # Core table statements: the ORM's bulk-delete bookkeeping costs more than the delete itself
+    label_counts = []
+    if update_stats:
+        label_counts = db.session.execute(
+            select(Image.project_id, Label.class_name, db.func.count(Label.id))
+            .join(Image, Image.id == Label.image_id).where(criterion)
+            .group_by(Image.project_id, Label.class_name)).all()
+    deleted = Counter()
+    deleted['labels'] = db.session.execute(
+        delete(Label.__table__).where(Label.image_id.in_(select(Image.id).where(criterion)))).rowcount
+    deleted['images'] = db.session.execute(delete(Image.__table__).where(criterion)).rowcount
+    if update_stats:
+        connection = db.session.connection()
+        for project_id, count in Counter(row.project_id for row in rows).items():
+            images_added(connection, project_id, -count)
+        per_project = {}
+        for project_id, class_name, count in label_counts:
+            per_project.setdefault(project_id, {})[class_name] = -count
+        for project_id, deltas in per_project.items():
+            labels_added(connection, project_id, deltas)
+    return deleted
+
+
+def _forget_images(rows):
+    by_project = {}
+    for row in rows:
+        by_project.setdefault(row.project_id, []).append(row.id)
+    for project_id, image_ids in by_project.items():
+        embedding_index.remove(project_id, image_ids)
+        feature_store.remove(project_id, image_ids)
+        for image_id in image_ids:
+            tensor_cache.invalidate(project_id, image_id)
+
+
+def _stored_files(rows):
+    # Content-addressed blobs by digest, and pre-digest uploads by their flat filename
+    return [row.digest for row in rows if row.digest], [row.filename for row in rows if not row.digest]
+
+
+def _forget_iterations(iteration_ids):
+    for iteration_id in iteration_ids:
+        prediction_cache.invalidate_model(iteration_model_id(iteration_id))
+        for runtime in RUNTIMES:
+            model_registry.invalidate(model_registry.iteration_key(iteration_id, runtime))
+
+
+def _retire(root, project_id):
+    # A rename is instant however large the directory; the collector deletes the trash
+    path = os.path.join(root, str(project_id))
+    if not os.path.isdir(path):
+        return
+    trash = os.path.join(root, TRASH_DIR)
+    os.makedirs(trash, exist_ok=True)
+    os.rename(path, os.path.join(trash, f'{project_id}-{uuid.uuid4().hex}'))
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _empty_queue():
+    return {'digests': set(), 'filenames': set(), 'projects': set(), 'iterations': set()}
+
+
+class GarbageCollector:
+    """Reclaims files whose rows are gone, on a background thread.
+
+    Deletes queue what they removed and wake the collector. Once started
+    with ``sweep`` (by serve.py's background process), every
+    ``GC_INTERVAL`` seconds it also sweeps for orphans, whether left by
+    earlier one-row deletes, a crash or a queue lost on restart: rows of
+    projects that no longer exist, labels of images that no longer exist,
+    blobs no image
+    references, cache directories of missing projects and model artifacts
+    of missing iterations or projects. Files younger than
+    ``GC_GRACE_SECONDS`` are left alone so an upload whose row is not
+    committed yet is never collected.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._queue = _empty_queue()
+        self._lock = threading.Lock()
+        self._collect_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._sweeping = False
+        self._last_sweep = time.monotonic()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['garbage_collector'] = self
+
+    def enqueue(self, digests=(), filenames=(), projects=(), iterations=()):
+        with self._lock:
+            self._queue['digests'].update(digests)
+            self._queue['filenames'].update(filenames)
+            self._queue['projects'].update(projects)
+            self._queue['iterations'].update(iterations)
+        self.start()
+
+    def start(self, sweep=False):
+        """Run the collector thread; with ``sweep`` it also sweeps every ``GC_INTERVAL`` seconds."""
+        with self._lock:
+            self._sweeping = self._sweeping or sweep
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='garbage-collector', daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def shutdown(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def collect(self, sweep=False, uploads=False):
+        """Reclaim queued files now and, with ``sweep``, every orphan; returns counts of what was removed.
+
+        Flat files in the upload folder are only considered when queued by a
+        delete, or all of them with ``uploads``: people drop files there by hand.
+        """
+        with self._collect_lock:
+            report = Counter()
+            if sweep:
+                chunk_size = self.app.config.get('GC_DELETE_CHUNK_SIZE', 1000)
+                orphans = orphan_project_ids()
+                if orphans:
+                    report['rows'] = sum(delete_projects(orphans, chunk_size).values())
+                report['rows'] += delete_orphan_labels(chunk_size)
+            with self._lock:
+                queue, self._queue = self._queue, _empty_queue()
+
+            digests, filenames = queue['digests'], queue['filenames']
+            if sweep:
+                # Persisted /inference uploads live in their own backend, so every blob here is an image's
+                digests = itertools.chain(digests, storage.iter_digests())
+            if uploads:
+                filenames = itertools.chain(filenames, self._flat_uploads())
+            report['blobs'] = self._reclaim_blobs(digests)
+            report['uploads'] = self._reclaim_uploads(filenames)
+            report['cache_dirs'] = self._reclaim_cache_dirs(sweep)
+            report['model_files'] = self._reclaim_model_files(queue['projects'], queue['iterations'], sweep)
+            if sweep:
+                self._last_sweep = time.monotonic()
+            return dict(report)
+
+    def _run(self):
+        while not self._stop.is_set():
+            interval = self.app.config.get('GC_INTERVAL', 3600)
+            self._wake.wait(interval if self._sweeping and interval > 0 else None)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            sweep = self._sweeping and interval > 0 and time.monotonic() - self._last_sweep >= interval
+            try:
+                with self.app.app_context():
+                    report = self.collect(sweep=sweep)
+                    db.session.remove()
+                if any(report.values()):
+                    self.app.logger.info('Garbage collection removed %s', report)
+            except Exception:
+                self.app.logger.exception('Garbage collection failed')
+
+    def _old_enough(self, path):
+        if path is None:
+            return True
+        try:
+            return os.path.getmtime(path) < time.time() - self.app.config.get('GC_GRACE_SECONDS', 300)
+        except FileNotFoundError:
+            return False
+
+    def _reclaim_blobs(self, digests, chunk_size=500):
+        removed = 0
+        digests = iter(digests)
+        while chunk := list(itertools.islice(digests, chunk_size)):
+            # Content is deduplicated, so a blob lives on while any image still points at it
+            referenced = set(db.session.scalars(select(Image.digest).where(Image.digest.in_(chunk))))
+            for digest in set(chunk) - referenced:
+                if self._old_enough(storage.backend.local_path(digest)) and storage.backend.delete(digest):
+                    removed += 1
+        return removed
+
+    def _flat_uploads(self):
+        folder = storage.upload_folder
+        if not os.path.isdir(folder):
+            return
+        for entry in os.scandir(folder):
+            if entry.is_file() and is_image_filename(entry.name):
+                yield entry.name
+
+    def _reclaim_uploads(self, filenames, chunk_size=500):
+        # Images stored before content addressing share one flat folder by filename
+        removed = 0
+        filenames = iter(filenames)
+        while chunk := list(itertools.islice(filenames, chunk_size)):
+            referenced = set(db.session.scalars(
+                select(Image.filename).where(Image.digest.is_(None), Image.filename.in_(chunk))))
+            for filename in set(chunk) - referenced:
+                path = os.path.join(storage.upload_folder, os.path.basename(filename))
+                if self._old_enough(path):
+                    _unlink(path)
+                    removed += 1
+        return removed
+
+    def _reclaim_cache_dirs(self, sweep):
+        removed = 0
+        existing = set(db.session.scalars(select(Project.id))) if sweep else None
+        for root in (tensor_cache.root, feature_store.root):
+            trash = os.path.join(root, TRASH_DIR)
+            if os.path.isdir(trash):
+                for name in os.listdir(trash):
+                    shutil.rmtree(os.path.join(trash, name), ignore_errors=True)
+                    removed += 1
+            if not sweep or not os.path.isdir(root):
+                continue
+            for name in os.listdir(root):
+                # A project created after the snapshot may already be writing its directory
+                if name.isdigit() and int(name) not in existing and self._old_enough(os.path.join(root, name)):
+                    if root == tensor_cache.root:
+                        tensor_cache.forget(int(name))
+                    shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+                    removed += 1
+        return removed
+
+    def _reclaim_model_files(self, project_ids, iteration_ids, sweep):
+        folder = model_folder()
+        if not (sweep or project_ids or iteration_ids) or not os.path.isdir(folder):
+            return 0
+        candidates = []
+        for name in os.listdir(folder):
+            match = MODEL_FILE.match(name)
+            if match is None:
+                continue
+            iteration_id, project_id = (int(group) if group else None for group in match.groups())
+            if sweep or iteration_id in iteration_ids or project_id in project_ids:
+                candidates.append((name, iteration_id, project_id))
+        if not candidates:
+            return 0
+        # Ids can be reused, so only artifacts whose row is still missing are removed
+        live_iterations = set(db.session.scalars(select(Iteration.id).where(
+            Iteration.id.in_({i for _, i, _ in candidates if i is not None}))))
+        live_projects = set(db.session.scalars(select(Project.id).where(
+            Project.id.in_({p for _, _, p in candidates if p is not None}))))
+        removed = 0
+        for name, iteration_id, project_id in candidates:
+            if iteration_id in live_iterations or project_id in live_projects:
+                continue
+            path = os.path.join(folder, name)
+            if self._old_enough(path):
+                _unlink(path)
+                removed += 1
+        return removed
+
+
+garbage_collector = GarbageCollector()
@@ -0,0 +1,135 @@
+import base64
+import binascii
+import io
+import json
+
+import numpy as np
+from PIL import Image as PILImage
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import parse_form_data
+
+from ml import INPUT_SIZE, ImageTooLarge, load_image
+
+IMAGE_CONTENT_TYPES = ('image/png', 'image/jpeg')
+TENSOR_DTYPES = ('uint8', 'float32')
+
+
+class PayloadError(ValueError):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class InferencePayload:
+    """The body of one /inference request, read into memory but not decoded yet.
+
+    ``data`` are the bytes the prediction cache digests and, for encoded
+    images, what may be persisted; ``tensor`` is set for raw tensor bodies.
+    """
+
+    __slots__ = ('data', 'tensor')
+
+    def __init__(self, data, tensor=None):
+        self.data = data
+        self.tensor = tensor
+
+    @property
+    def is_image(self):
+        return self.tensor is None
+
+    def decode(self, target_size=INPUT_SIZE, max_pixels=40_000_000):
+        """``(H, W, 3)`` float32 pixels in [0, 255] at ``target_size``."""
+        if self.is_image:
+            try:
+                return load_image(io.BytesIO(self.data), target_size, max_pixels=max_pixels)
+            except ImageTooLarge as e:
+                raise PayloadError(str(e), 413)
+            except (OSError, ValueError) as e:
+                raise PayloadError(f'Could not decode image: {e}')
+        tensor = self.tensor
+        if tensor.shape[:2] != tuple(target_size):
+            if tensor.dtype != np.uint8:
+                raise PayloadError(f'float32 tensors must already be {target_size[0]}x{target_size[1]}')
+            tensor = np.asarray(PILImage.fromarray(tensor).resize((target_size[1], target_size[0]), PILImage.NEAREST))
+        return tensor.astype(np.float32)
+
+
+def read_payload(request, allowed_file, max_bytes=10 * 1024 * 1024):
+    """Read an /inference body entirely in memory.
+
+    Accepts multipart (``image`` field), JSON ``{"image": "<base64>"}``, a raw
+    ``image/png`` or ``image/jpeg`` body, an ``application/x-npy`` array, or
+    ``application/octet-stream`` with ``X-Tensor-Shape`` and ``X-Tensor-Dtype``
+    headers. Tensors are ``(H, W, 3)`` (or ``(1, H, W, 3)``) RGB values in
+    [0, 255]; uint8 tensors of another size are resized like images.
+    """
+    if request.content_length is not None and request.content_length > max_bytes:
+        raise PayloadError(f'Payload larger than {max_bytes} bytes', 413)
+    content_type = request.mimetype
+
+    if content_type == 'multipart/form-data':
+        # Parsed here rather than through request.files, which spools large parts to temp files
+        try:
+            _, _, files = parse_form_data(request.environ, stream_factory=_memory_stream,
+                                          max_content_length=max_bytes, silent=False)
+        except RequestEntityTooLarge:
+            raise PayloadError(f'Payload larger than {max_bytes} bytes', 413)
+        except ValueError as e:
+            raise PayloadError(f'Invalid multipart body: {e}')
+        file = files.get('image')
+        if file is None or not allowed_file(file.filename):
+            raise PayloadError('Invalid image format')
+        return InferencePayload(file.stream.getvalue())
+    body = _read_body(request, max_bytes)
+    if content_type == 'application/json':
+        try:
+            return InferencePayload(base64.b64decode(json.loads(body)['image'], validate=True))
+        except (ValueError, KeyError, TypeError, binascii.Error):
+            raise PayloadError('JSON bodies must be {"image": "<base64-encoded PNG or JPEG>"}')
+    if content_type in IMAGE_CONTENT_TYPES:
+        return InferencePayload(body)
+    if content_type == 'application/x-npy':
+        try:
+            tensor = np.load(io.BytesIO(body), allow_pickle=False)
+        except ValueError as e:
+            raise PayloadError(f'Invalid .npy body: {e}')
+        return _tensor_payload(tensor)
+    if content_type == 'application/octet-stream':
+        return _tensor_payload(_raw_tensor(body, request.headers))
+    raise PayloadError(f'Unsupported content type: {content_type or "none"}', 415)
+
+
+def _memory_stream(total_content_length, content_type, filename=None, content_length=None):
+    return io.BytesIO()
+
+
+def _read_body(request, max_bytes):
+    # Chunked bodies carry no Content-Length, so the limit is enforced while reading
+    body = request.stream.read(max_bytes + 1)
+    if len(body) > max_bytes:
+        raise PayloadError(f'Payload larger than {max_bytes} bytes', 413)
+    return body
+
+
+def _raw_tensor(body, headers):
+    dtype = headers.get('X-Tensor-Dtype', 'uint8')
+    if dtype not in TENSOR_DTYPES:
+        raise PayloadError(f'X-Tensor-Dtype must be one of {", ".join(TENSOR_DTYPES)}')
+    try:
+        shape = tuple(int(dim) for dim in headers['X-Tensor-Shape'].split(','))
+        return np.frombuffer(body, dtype=dtype).reshape(shape)
+    except (KeyError, ValueError) as e:
+        raise PayloadError(f'Raw tensors need X-Tensor-Shape (e.g. "224,224,3") matching the body: {e}')
+
+
+def _tensor_payload(tensor):
+    if tensor.ndim == 4 and tensor.shape[0] == 1:
+        tensor = tensor[0]
+    if tensor.ndim != 3 or tensor.shape[2] != 3:
+        raise PayloadError(f'Tensor must have shape (H, W, 3), got {tensor.shape}')
+    if tensor.dtype.name not in TENSOR_DTYPES:
+        raise PayloadError(f'Tensor dtype must be one of {", ".join(TENSOR_DTYPES)}')
+    tensor = np.ascontiguousarray(tensor)
+    # Shape and dtype are part of the digest so equal bytes of different layouts never share a cache entry
+    data = f'tensor:{tensor.dtype.name}:{tensor.shape}:'.encode() + tensor.tobytes()
+    return InferencePayload(data, tensor)
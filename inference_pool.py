@@ -0,0 +1,234 @@
+import itertools
+import logging
+import queue
+import signal
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# One shared-memory block of ``web_workers * slots_per_worker`` fixed-size
+# slots; web worker ``i`` owns slots ``[i * slots_per_worker, (i + 1) * slots_per_worker)``
+# and gets answers on ``responses[i]``.
+Channels = namedtuple('Channels', 'shm_name slots_per_worker slot_bytes requests responses ready')
+
+# Request-queue message asking an inference process to load a model ahead of its first request
+WARM = 'warm'
+
+
+class PoolBusy(Exception):
+    """Every slot of this web worker is in flight; the client should retry later."""
+
+
+def create_channels(ctx, web_workers, slots_per_worker, slot_bytes):
+    """Shared memory and queues for a pool; the caller owns (and must unlink) the returned block."""
+    shm = shared_memory.SharedMemory(create=True, size=web_workers * slots_per_worker * slot_bytes)
+    channels = Channels(shm.name, slots_per_worker, slot_bytes, ctx.Queue(),
+                        [ctx.Queue() for _ in range(web_workers)], ctx.Event())
+    return shm, channels
+
+
+def _slot_array(shm, channels, slot, shape):
+    return np.ndarray(shape, dtype=np.float32, buffer=shm.buf, offset=slot * channels.slot_bytes)
+
+
+class InferencePool:
+    """Sends preprocessed tensors from a web worker to the inference processes.
+
+    Inputs are written into one of this worker's shared-memory slots and
+    only the slot number travels over the request queue; answers come back
+    already formatted, so web workers never hold a deployed model. submit()
+    raises PoolBusy instead of queueing when every slot is in flight, while
+    predict_many() waits for slots and uses at most half of them, leaving
+    the rest to /inference. Disabled until connect() is called by the
+    serving launcher.
+    """
+
+    def __init__(self, app=None):
+        self.timeout = 30
+        self.rejected = 0
+        self._channels = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.timeout = app.config.get('INFERENCE_TIMEOUT', self.timeout)
+        app.extensions['inference_pool'] = self
+
+    @property
+    def enabled(self):
+        return self._channels is not None
+
+    def ready(self):
+        return self.enabled and self._channels.ready.is_set()
+
+    def connect(self, channels, worker_index):
+        self._shm = shared_memory.SharedMemory(name=channels.shm_name)
+        self._index = worker_index
+        self._responses = channels.responses[worker_index]
+        self._free = queue.SimpleQueue()
+        first = worker_index * channels.slots_per_worker
+        for slot in range(first, first + channels.slots_per_worker):
+            self._free.put(slot)
+        self._pending = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._batch_slots = threading.BoundedSemaphore(max(1, channels.slots_per_worker // 2))
+        self._channels = channels
+        self._dispatcher = threading.Thread(target=self._dispatch, name='inference-pool-responses', daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, model_spec, inputs, block=False):
+        """Queue ``inputs`` for the model ``model_spec`` (a registry ``(key, path)``, or None for the default model).
+
+        Returns a Future of the formatted top predictions, one list per input
+        row. With ``block`` a full pool is waited on for up to the timeout.
+        """
+        x = np.ascontiguousarray(inputs, dtype=np.float32)
+        if x.nbytes > self._channels.slot_bytes:
+            raise ValueError(f'Input of {x.nbytes} bytes does not fit a {self._channels.slot_bytes} byte slot')
+        try:
+            slot = self._free.get(timeout=self.timeout) if block else self._free.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                self.rejected += 1
+            raise PoolBusy('Inference queue is full')
+        _slot_array(self._shm, self._channels, slot, x.shape)[...] = x
+        future = Future()
+        with self._lock:
+            request_id = next(self._ids)
+            self._pending[request_id] = (future, slot)
+        self._channels.requests.put((self._index, request_id, slot, x.shape, model_spec))
+        return future
+
+    def predict(self, model_spec, inputs, timeout=None):
+        return self.submit(model_spec, inputs).result(timeout=timeout or self.timeout)
+
+    def predict_many(self, model_spec, inputs, timeout=None):
+        """Formatted top predictions for every row of ``inputs``, sent one row per slot."""
+        futures = []
+        for row in inputs:
+            if not self._batch_slots.acquire(timeout=self.timeout):
+                raise PoolBusy('Inference queue is full')
+            try:
+                future = self.submit(model_spec, row[np.newaxis], block=True)
+            except BaseException:
+                self._batch_slots.release()
+                raise
+            future.add_done_callback(lambda f: self._batch_slots.release())
+            futures.append(future)
+        return [future.result(timeout=timeout or self.timeout)[0] for future in futures]
+
+    def warm(self, model_spec):
+        """Have one inference process load ``model_spec`` now; the others load it on first use."""
+        self._channels.requests.put((WARM, model_spec))
+
+    def stats(self):
+        if not self.enabled:
+            return None
+        with self._lock:
+            return {
+                'in_flight': len(self._pending),
+                'slots': self._channels.slots_per_worker,
+                'rejected': self.rejected,
+                'ready': self._channels.ready.is_set(),
+            }
+
+    def close(self):
+        if not self.enabled:
+            return
+        self._responses.put(None)
+        self._dispatcher.join()
+        self._channels = None
+        self._shm.close()
+
+    def _dispatch(self):
+        while True:
+            message = self._responses.get()
+            if message is None:
+                return
+            request_id, result, error = message
+            with self._lock:
+                future, slot = self._pending.pop(request_id)
+            # The inference process copied the input out before answering
+            self._free.put(slot)
+            if error is not None:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(result)
+
+
+def serve_inference(channels, settings):
+    """Answer requests from ``channels`` until a None sentinel arrives, then drain and return.
+
+    Requests for the same model are merged by a MicroBatcher per model, as
+    in-process inference does.
+    """
+    from extensions import model_registry, inference_batchers
+    from ml import get_default_model, warm_default_model, format_predictions
+
+    model_registry.max_models = settings.get('max_models', model_registry.max_models)
+    model_registry.max_bytes = settings.get('max_bytes', model_registry.max_bytes)
+    inference_batchers.max_batch_size = settings.get('max_batch_size', inference_batchers.max_batch_size)
+    inference_batchers.max_wait_ms = settings.get('max_wait_ms', inference_batchers.max_wait_ms)
+    if settings.get('warm_default_model'):
+        try:
+            warm_default_model()
+        except Exception as e:
+            # Iteration models still work; the default model is retried on first use
+            logger.warning('Could not warm the default model: %s', e)
+    channels.ready.set()
+
+    shm = shared_memory.SharedMemory(name=channels.shm_name)
+
+    def predict_fn(model_spec):
+        if model_spec is None:
+            return lambda x: get_default_model().predict(x, verbose=0)
+        key, path = model_spec
+        return lambda x: model_registry.get(key, path).predict(x, verbose=0)
+
+    def warm(model_spec):
+        try:
+            if model_spec is None:
+                warm_default_model()
+            else:
+                model_registry.get(*model_spec, warm=True)
+        except Exception as e:
+            logger.warning('Could not warm %s: %s', model_spec[0] if model_spec else 'the default model', e)
+
+    def reply(responses, request_id, future):
+        try:
+            message = (request_id, format_predictions(future.result()), None)
+        except Exception as e:
+            message = (request_id, None, str(e) or type(e).__name__)
+        responses.put(message)
+
+    try:
+        while True:
+            message = channels.requests.get()
+            if message is None:
+                break
+            if message[0] == WARM:
+                # Loading can take seconds; requests keep flowing meanwhile
+                threading.Thread(target=warm, args=(message[1],), daemon=True).start()
+                continue
+            worker_index, request_id, slot, shape, model_spec = message
+            x = _slot_array(shm, channels, slot, shape).copy()
+            batcher = inference_batchers.get(model_spec[0] if model_spec else 'default', predict_fn(model_spec))
+            future = batcher.submit(x)
+            future.add_done_callback(lambda f, r=channels.responses[worker_index], i=request_id: reply(r, i, f))
+    finally:
+        # Closing waits for each batcher to finish what is already queued
+        inference_batchers.close_all()
+        shm.close()
+
+
+def run_inference_process(channels, settings):
+    # Shutdown is coordinated by the launcher through the request queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    serve_inference(channels, settings)
@@ -0,0 +1,144 @@
+import io
+import lzma
+import os
+import tarfile
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from sqlalchemy import insert
+from werkzeug.utils import secure_filename
+
+from extensions import storage, tensor_cache, embedding_index
+from models import db, Image
+from analytics import images_added
+from ml import INPUT_SIZE, load_image
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+# Raised by corrupt or truncated uploads; gzip and bz2 surface truncation as EOFError or OSError
+READ_ERRORS = (zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error, lzma.LZMAError, OSError)
+
+
+def is_image_filename(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in IMAGE_EXTENSIONS
+
+
+def iter_entries(files):
+    """Yield ``(name, stream)`` for every uploaded file, expanding zip and tar archives.
+
+    Archives are read one entry at a time; each stream is only valid until
+    the next entry is requested.
+    """
+    for file in files:
+        name = (file.filename or '').lower()
+        if name.endswith('.zip'):
+            with zipfile.ZipFile(file.stream) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir():
+                        with archive.open(info) as stream:
+                            yield info.filename, stream
+        elif name.endswith(TAR_SUFFIXES):
+            # Stream mode: never seeks, so the upload is read exactly once
+            with tarfile.open(fileobj=file.stream, mode='r|*') as archive:
+                for member in archive:
+                    if member.isfile():
+                        yield member.name, archive.extractfile(member)
+        else:
+            yield file.filename, file.stream
+
+
+def prepare_image(data, target_size):
+    # Decoding doubles as validation; only images that decode are stored
+    pixels = load_image(io.BytesIO(data), target_size, dtype='uint8')
+    digest, _, _ = storage.save_stream(io.BytesIO(data))
+    return digest, pixels
+
+
+def ingest_images(project_id, files, target_size=INPUT_SIZE, batch_size=500, workers=4,
+                  max_file_bytes=50 * 1024 * 1024):
+    """Store many uploaded images (or archives of them) and return a per-file report.
+
+    Entries are read sequentially and decoded, validated and stored on a
+    thread pool; valid images are inserted ``batch_size`` rows per
+    transaction and their resized tensors go straight into the tensor cache.
+    If an upload turns out to be corrupt or truncated, reading stops there:
+    everything read before it is still stored, and the report gets an
+    ``error`` naming the problem.
+    """
+    report = {'created': 0, 'failed': 0, 'skipped': 0, 'files': []}
+    window = workers * 4
+    pending = deque()
+    ready = []
+
+    def collect(entry, future):
+        try:
+            digest, pixels = future.result()
+        except Exception as e:
+            _fail(report, entry, f'not a valid image: {e}')
+            return
+        ready.append((entry, digest, pixels))
+        if len(ready) >= batch_size:
+            _insert_batch(project_id, ready, target_size, report)
+            ready.clear()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest') as executor:
+        try:
+            for name, stream in iter_entries(files):
+                entry = {'filename': name}
+                report['files'].append(entry)
+                basename = os.path.basename(name or '')
+                filename = secure_filename(basename)
+                if basename.startswith('.') or not is_image_filename(filename):
+                    entry['status'] = 'skipped'
+                    report['skipped'] += 1
+                    continue
+                entry['stored_as'] = filename
+                try:
+                    data = stream.read(max_file_bytes + 1)
+                except READ_ERRORS as e:
+                    _fail(report, entry, f'could not be read: {e}')
+                    raise
+                if len(data) > max_file_bytes:
+                    _fail(report, entry, f'larger than {max_file_bytes} bytes')
+                    continue
+                pending.append((entry, executor.submit(prepare_image, data, target_size)))
+                while len(pending) > window:
+                    collect(*pending.popleft())
+        except READ_ERRORS as e:
+            report['error'] = f'Could not read archive: {e}'
+        while pending:
+            collect(*pending.popleft())
+    if ready:
+        _insert_batch(project_id, ready, target_size, report)
+    return report
+
+
+def _insert_batch(project_id, ready, target_size, report):
+    # Bulk inserts skip the ORM listeners, so project stats are updated here
+    image_ids = db.session.scalars(
+        insert(Image).returning(Image.id, sort_by_parameter_order=True),
+        [{'filename': entry['stored_as'], 'digest': digest, 'project_id': project_id} for entry, digest, _ in ready]
+    ).all()
+    images_added(db.session.connection(), project_id, len(image_ids))
+    db.session.commit()
+
+    for (entry, _, pixels), image_id in zip(ready, image_ids):
+        entry.update(status='created', image_id=image_id)
+        try:
+            tensor_cache.put(project_id, image_id, pixels, target_size)
+        except Exception as e:
+            current_app.logger.warning('Could not cache tensor for image %s: %s', image_id, e)
+    if target_size == INPUT_SIZE:
+        try:
+            embedding_index.add(project_id, image_ids, [pixels for _, _, pixels in ready])
+        except Exception as e:
+            current_app.logger.warning('Could not index images of project %s: %s', project_id, e)
+    report['created'] += len(image_ids)
+
+
+def _fail(report, entry, error):
+    entry.update(status='failed', error=error)
+    report['failed'] += 1
@@ -0,0 +1,434 @@
+import datetime
+import importlib
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import sqlalchemy as sa
+
+from models import db, Iteration, Image, Label, TrainingConfig, Deployment
+from storage import storage_root
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (COMPLETED, FAILED, CANCELLED)
+
+# Deployment.status: a TFLite runtime is converted by a worker before the deployment goes live
+PENDING = 'pending'
+EXPORTING = 'exporting'
+READY = 'ready'
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class TrainingJob:
+    """Handed to the training function inside a worker process.
+
+    ``report()`` writes progress and metrics back to the Iteration row and
+    raises JobCancelled once cancellation has been requested.
+    """
+
+    def __init__(self, engine, iteration_id, project_id, config, samples, output_path, options):
+        self.engine = engine
+        self.iteration_id = iteration_id
+        self.project_id = project_id
+        self.config = config
+        self.samples = samples
+        self.output_path = output_path
+        self.options = options
+        self.metrics = {}
+
+    def report(self, progress=None, **metrics):
+        self.metrics.update(metrics)
+        values = {'metrics': json.dumps(self.metrics), 'heartbeat_at': _utcnow()}
+        if progress is not None:
+            values['progress'] = float(progress)
+        with self.engine.begin() as conn:
+            conn.execute(sa.update(Iteration.__table__).where(Iteration.__table__.c.id == self.iteration_id).values(**values))
+        self.check_cancelled()
+
+    def check_cancelled(self):
+        with self.engine.connect() as conn:
+            cancelled = conn.execute(
+                sa.select(Iteration.__table__.c.cancel_requested).where(Iteration.__table__.c.id == self.iteration_id)
+            ).scalar()
+        # A deleted iteration has no row left to report to
+        if cancelled or cancelled is None:
+            raise JobCancelled()
+
+
+def run_job(iteration_id, options):
+    """Entry point executed in a training worker process."""
+    engine = sa.create_engine(options['database_uri'])
+    table = Iteration.__table__
+    stop_heartbeat = threading.Event()
+
+    def heartbeat():
+        while not stop_heartbeat.wait(options['heartbeat_interval']):
+            with engine.begin() as conn:
+                conn.execute(sa.update(table).where(table.c.id == iteration_id).values(heartbeat_at=_utcnow()))
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    try:
+        job = _load_job(engine, iteration_id, options)
+        train_fn = _import_string(options['train_fn'])
+        result = train_fn(job) or {}
+        values = {'status': COMPLETED, 'progress': 1.0, 'result': json.dumps(result)}
+        if os.path.exists(job.output_path):
+            values['model_path'] = job.output_path
+    except JobCancelled:
+        values = {'status': CANCELLED, 'result': 'Cancelled'}
+    except Exception as e:
+        values = {'status': FAILED, 'result': f'{type(e).__name__}: {e}'}
+    finally:
+        stop_heartbeat.set()
+
+    values['finished_at'] = _utcnow()
+    with engine.begin() as conn:
+        conn.execute(sa.update(table).where(table.c.id == iteration_id).values(**values))
+    engine.dispose()
+    return values['status']
+
+
+def run_export(deployment_id, options):
+    """Entry point converting a pending deployment's model in a worker process.
+
+    Conversion samples calibration images through the app's storage and
+    tensor cache, so the worker builds an app of its own; its background
+    threads stay off, they belong to the parent.
+    """
+    from app import create_app
+    from runtimes import ensure_exported
+
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': options['database_uri'],
+        'UPLOAD_FOLDER': options['upload_folder'],
+        'STORAGE_BACKEND': options['storage_backend'],
+        'STORAGE_FOLDER': options['storage_folder'],
+        'TENSOR_CACHE_FOLDER': options['tensor_cache_folder'],
+        'FEATURE_STORE_FOLDER': options['feature_store_folder'],
+        'MODEL_FOLDER': options['model_folder'],
+        'TRAINING_AUTOSTART': False,
+        'GC_INTERVAL': 0,
+    })
+    with app.app_context():
+        deployment = db.session.get(Deployment, deployment_id)
+        if deployment is None:
+            return None
+        iteration = deployment.iteration if deployment.iteration_id else None
+        path, _ = ensure_exported(deployment.project_id, iteration, deployment.runtime, options['calibration_size'])
+        return path
+
+
+def _load_job(engine, iteration_id, options):
+    # Imported here so the worker only pays for what the job needs
+    from storage import BACKENDS
+    from extensions import tensor_cache, feature_store
+
+    tensor_cache.root = options['tensor_cache_folder']
+    feature_store.root = options['feature_store_folder']
+    backend = BACKENDS[options['storage_backend']](options['storage_folder'])
+
+    with engine.connect() as conn:
+        project_id = conn.execute(
+            sa.select(Iteration.__table__.c.project_id).where(Iteration.__table__.c.id == iteration_id)).scalar()
+        config = conn.execute(
+            sa.select(TrainingConfig.__table__.c.config)
+            .where(TrainingConfig.__table__.c.project_id == project_id)
+            .order_by(TrainingConfig.__table__.c.id.desc()).limit(1)
+        ).scalar()
+        rows = conn.execute(
+            sa.select(Image.__table__.c.id, Image.__table__.c.filename, Image.__table__.c.digest,
+                      Label.__table__.c.class_name)
+            .join(Label.__table__, Label.__table__.c.image_id == Image.__table__.c.id)
+            .where(Image.__table__.c.project_id == project_id)
+            .order_by(Image.__table__.c.id)
+        ).all()
+
+    samples = []
+    for image_id, filename, digest, label in rows:
+        source = backend.local_path(digest) if digest else os.path.join(options['upload_folder'], filename)
+        samples.append((image_id, source, label))
+
+    os.makedirs(options['model_folder'], exist_ok=True)
+    output_path = os.path.join(options['model_folder'], f'iteration_{iteration_id}.keras')
+    return TrainingJob(engine, iteration_id, project_id, json.loads(config) if config else {}, samples,
+                       output_path, options)
+
+
+class TrainingEngine:
+    """Runs queued Iterations on a bounded pool of worker processes.
+
+    The queue is the ``iteration`` table itself: a dispatcher thread claims
+    queued rows (respecting the per-user concurrency limit), hands them to the
+    pool and requeues running rows whose heartbeat went stale, e.g. because
+    the process that owned them was restarted. With ``TRAINING_DISPATCH``
+    off, start() does nothing and this process only writes queued rows for
+    the one that dispatches (serve.py's background process) to pick up.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._executor = None
+        self._futures = {}
+        self._exports = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['training_engine'] = self
+        if app.config.get('TRAINING_AUTOSTART', True):
+            with app.app_context():
+                pending = Iteration.query.filter(Iteration.status.in_((QUEUED, RUNNING))).count()
+                pending += Deployment.query.filter(Deployment.status.in_((PENDING, EXPORTING))).count()
+            if pending:
+                self.start()
+
+    @property
+    def max_workers(self):
+        return self.app.config.get('TRAINING_MAX_WORKERS', 2)
+
+    def enqueue(self, project_id, user_id):
+        iteration = Iteration(project_id=project_id, user_id=user_id, status=QUEUED, result='',
+                              progress=0.0, created_at=_utcnow())
+        db.session.add(iteration)
+        db.session.commit()
+        self.start()
+        return iteration
+
+    def cancel(self, iteration):
+        # Decided in the UPDATE itself, as the dispatcher may have claimed the row since it was loaded
+        cancelled = db.session.execute(
+            sa.update(Iteration).where(Iteration.id == iteration.id, Iteration.status == QUEUED)
+            .values(status=CANCELLED, result='Cancelled', finished_at=_utcnow())
+        ).rowcount
+        if not cancelled:
+            # The worker notices on its next progress report
+            db.session.execute(
+                sa.update(Iteration).where(Iteration.id == iteration.id, Iteration.status == RUNNING)
+                .values(cancel_requested=True)
+            )
+        db.session.commit()
+        db.session.refresh(iteration)
+        self._wake.set()
+
+    def start(self):
+        if not self.app.config.get('TRAINING_DISPATCH', True):
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='training-dispatcher', daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def shutdown(self, wait=True):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=not wait)
+
+    def running(self):
+        with self._lock:
+            return set(self._futures)
+
+    def _run(self):
+        interval = self.app.config.get('TRAINING_POLL_INTERVAL', 2.0)
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    self._recover_orphans()
+                    self._dispatch()
+                    db.session.remove()
+            except Exception:
+                self.app.logger.exception('Training dispatcher failed')
+            self._wake.wait(interval)
+            self._wake.clear()
+
+    def _dispatch(self):
+        with self._lock:
+            free = self.max_workers - len(self._futures) - len(self._exports)
+        if free <= 0:
+            return
+        free -= self._dispatch_exports(free)
+
+        per_user = self.app.config.get('TRAINING_MAX_JOBS_PER_USER', 1)
+        running = dict(db.session.execute(
+            sa.select(Iteration.user_id, sa.func.count(Iteration.id))
+            .where(Iteration.status == RUNNING).group_by(Iteration.user_id)
+        ).all())
+        queued = db.session.execute(
+            sa.select(Iteration.id, Iteration.user_id).where(Iteration.status == QUEUED).order_by(Iteration.id)
+        ).all()
+
+        for iteration_id, user_id in queued:
+            if free <= 0:
+                break
+            if running.get(user_id, 0) >= per_user:
+                continue
+            # Claim atomically so concurrent dispatchers never start a job twice
+            now = _utcnow()
+            claimed = db.session.execute(
+                sa.update(Iteration)
+                .where(Iteration.id == iteration_id, Iteration.status == QUEUED)
+                .values(status=RUNNING, started_at=now, heartbeat_at=now, attempts=Iteration.attempts + 1)
+            ).rowcount
+            db.session.commit()
+            if not claimed:
+                continue
+            running[user_id] = running.get(user_id, 0) + 1
+            free -= 1
+            self._submit(iteration_id)
+
+    def _dispatch_exports(self, free):
+        # Conversions share the worker pool with training; returns how many were started
+        pending = db.session.scalars(
+            sa.select(Deployment.id).where(Deployment.status == PENDING).order_by(Deployment.id).limit(free)
+        ).all()
+        started = 0
+        for deployment_id in pending:
+            claimed = db.session.execute(
+                sa.update(Deployment).where(Deployment.id == deployment_id, Deployment.status == PENDING)
+                .values(status=EXPORTING)
+            ).rowcount
+            db.session.commit()
+            if claimed:
+                started += 1
+                with self._lock:
+                    future = self._pool().submit(run_export, deployment_id, self._options())
+                    self._exports[deployment_id] = future
+                future.add_done_callback(
+                    lambda f, deployment_id=deployment_id: self._export_finished(deployment_id, f))
+        return started
+
+    def _pool(self):
+        # Called with self._lock held
+        if self._executor is None:
+            # spawn keeps TensorFlow state out of the parent process
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def _submit(self, iteration_id):
+        with self._lock:
+            future = self._pool().submit(run_job, iteration_id, self._options())
+            self._futures[iteration_id] = future
+        future.add_done_callback(lambda f, iteration_id=iteration_id: self._finished(iteration_id, f))
+
+    def _finished(self, iteration_id, future):
+        with self._lock:
+            self._futures.pop(iteration_id, None)
+        error = future.exception()
+        if error is not None:
+            # The worker process died before it could record an outcome
+            with self.app.app_context():
+                db.session.execute(
+                    sa.update(Iteration).where(Iteration.id == iteration_id, Iteration.status == RUNNING)
+                    .values(status=FAILED, result=f'Worker lost: {error}', finished_at=_utcnow())
+                )
+                db.session.commit()
+                db.session.remove()
+            if 'BrokenProcessPool' in type(error).__name__:
+                with self._lock:
+                    self._executor = None
+        self._wake.set()
+
+    def _export_finished(self, deployment_id, future):
+        with self._lock:
+            self._exports.pop(deployment_id, None)
+        error = future.exception()
+        with self.app.app_context():
+            deployment = db.session.get(Deployment, deployment_id)
+            if deployment is not None and deployment.status == EXPORTING:
+                if error is None:
+                    # Goes live only now; until here the previous deployment kept serving
+                    for previous in Deployment.query.filter(Deployment.project_id == deployment.project_id,
+                                                            Deployment.active.is_(True),
+                                                            Deployment.id != deployment_id).all():
+                        previous.active = False
+                    deployment.active = True
+                    deployment.status = READY
+                else:
+                    deployment.status = FAILED
+                    deployment.error = f'{type(error).__name__}: {error}'
+                db.session.commit()
+            db.session.remove()
+        if error is not None and 'BrokenProcessPool' in type(error).__name__:
+            with self._lock:
+                self._executor = None
+        self._wake.set()
+
+    def _recover_orphans(self):
+        timeout = self.app.config.get('TRAINING_HEARTBEAT_TIMEOUT', 60)
+        max_attempts = self.app.config.get('TRAINING_MAX_ATTEMPTS', 3)
+        cutoff = _utcnow() - datetime.timedelta(seconds=timeout)
+        owned = self.running()
+        stale = db.session.execute(
+            sa.select(Iteration.id, Iteration.attempts)
+            .where(Iteration.status == RUNNING,
+                   sa.or_(Iteration.heartbeat_at.is_(None), Iteration.heartbeat_at < cutoff))
+        ).all()
+        with self._lock:
+            exporting = set(self._exports)
+        # Only one engine dispatches, so a conversion it does not own was cut off by a restart
+        lost = db.session.execute(
+            sa.update(Deployment).where(Deployment.status == EXPORTING, Deployment.id.not_in(exporting))
+            .values(status=PENDING)
+        ).rowcount
+        if lost:
+            db.session.commit()
+        for iteration_id, attempts in stale:
+            if iteration_id in owned:
+                continue
+            if (attempts or 0) >= max_attempts:
+                values = {'status': FAILED, 'result': 'Worker lost too many times', 'finished_at': _utcnow()}
+            else:
+                values = {'status': QUEUED, 'progress': 0.0, 'result': 'Requeued after worker was lost'}
+            db.session.execute(
+                sa.update(Iteration).where(Iteration.id == iteration_id, Iteration.status == RUNNING).values(**values)
+            )
+        if stale:
+            db.session.commit()
+
+    def _options(self):
+        config = self.app.config
+        return {
+            'database_uri': db.engine.url.render_as_string(hide_password=False),
+            'train_fn': config.get('TRAINING_FUNCTION', 'training.train_classifier'),
+            'heartbeat_interval': max(1.0, config.get('TRAINING_HEARTBEAT_TIMEOUT', 60) / 4),
+            'upload_folder': os.path.abspath(config['UPLOAD_FOLDER']),
+            'storage_backend': config.get('STORAGE_BACKEND', 'local'),
+            'storage_folder': os.path.abspath(storage_root(config)),
+            'tensor_cache_folder': os.path.abspath(self.app.extensions['tensor_cache'].root),
+            'feature_store_folder': os.path.abspath(self.app.extensions['feature_store'].root),
+            'model_folder': config.get('MODEL_FOLDER') or os.path.join(self.app.instance_path, 'models'),
+            'calibration_size': config.get('RUNTIME_CALIBRATION_SIZE', 100),
+        }
+
+
+training_engine = TrainingEngine()
+
+
+def _import_string(path):
+    module, _, name = path.rpartition('.')
+    return getattr(importlib.import_module(module), name)
+
+
+def _utcnow():
+    return datetime.datetime.utcnow()
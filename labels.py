@@ -0,0 +1,252 @@
+import csv
+import io
+import json
+from collections import Counter
+
+from sqlalchemy import select, or_
+
+from models import db, Image, Label
+from analytics import labels_added
+
+CSV_COLUMNS = ('image_id', 'filename', 'class_name', 'x', 'y', 'width', 'height', 'confidence', 'source')
+SOURCES = ('manual', 'import', 'prediction')
+MAX_REPORTED_ERRORS = 100
+# Raised by the parsers on a malformed file; UnicodeDecodeError and JSONDecodeError are ValueErrors
+PARSE_ERRORS = (ValueError, csv.Error)
+
+
+def parse_csv(stream):
+    """Yield ``(reference, record)`` for each row of a label CSV.
+
+    Rows name their image by ``image_id`` or ``filename`` and their class by
+    ``class_name`` (or ``label``); ``x``, ``y``, ``width``, ``height``,
+    ``confidence`` and ``source`` are optional.
+    """
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8', newline=''))
+    for line, row in enumerate(reader, start=2):
+        bbox = [row.get(key) for key in ('x', 'y', 'width', 'height')]
+        yield f'line {line}', {
+            'image_id': row.get('image_id') or None,
+            'filename': row.get('filename') or None,
+            'class_name': row.get('class_name') or row.get('label'),
+            'bbox': bbox if any(bbox) else None,
+            'confidence': row.get('confidence') or None,
+            'source': row.get('source') or None,
+        }
+
+
+def parse_coco(stream, max_bytes=None):
+    """Yield ``(reference, record)`` for each annotation of a COCO-style document.
+
+    COCO image ids are local to the document, so images are matched to the
+    project by ``file_name``. The document is parsed whole, so one larger
+    than ``max_bytes`` is refused instead.
+    """
+    data = stream.read() if max_bytes is None else stream.read(max_bytes + 1)
+    if max_bytes is not None and len(data) > max_bytes:
+        raise ValueError(f'COCO documents are limited to {max_bytes} bytes; split it or import CSV')
+    document = json.loads(data)
+    filenames = {image['id']: image.get('file_name') for image in document.get('images', [])}
+    categories = {category['id']: category.get('name') for category in document.get('categories', [])}
+    for index, annotation in enumerate(document.get('annotations', [])):
+        yield f'annotation {index}', {
+            'filename': filenames.get(annotation.get('image_id')),
+            'class_name': categories.get(annotation.get('category_id')),
+            'bbox': annotation.get('bbox'),
+            'confidence': annotation.get('score'),
+            'source': annotation.get('source'),
+        }
+
+
+PARSERS = {
+    'csv': parse_csv,
+    'coco': parse_coco,
+}
+
+
+def import_labels(project_id, records, source='import', batch_size=5000):
+    """Insert labels in batches of plain INSERTs and return a report.
+
+    Rows skip the ORM, so project stats are updated once per batch instead of
+    by the per-row listeners in analytics.py. Batches are committed as they
+    fill, so if the file turns out to be malformed partway through, every
+    record before that point is still imported and the report gets an
+    ``error`` saying where parsing stopped.
+    """
+    report = {'imported': 0, 'skipped': 0, 'errors': []}
+    batch = []
+    records = iter(records)
+    reference = None
+    while True:
+        try:
+            reference, record = next(records)
+        except StopIteration:
+            break
+        except PARSE_ERRORS as e:
+            where = f' after {reference}' if reference else ''
+            report['error'] = f'Could not parse the file{where}: {e}'
+            break
+        try:
+            batch.append((reference, _clean(record, source)))
+        except (TypeError, ValueError) as e:
+            _skip(report, reference, e)
+        if len(batch) >= batch_size:
+            _insert_batch(project_id, batch, report)
+            batch = []
+    if batch:
+        _insert_batch(project_id, batch, report)
+    return report
+
+
+def _clean(record, source):
+    class_name = (record.get('class_name') or '').strip()
+    if not class_name:
+        raise ValueError('missing class_name')
+    if len(class_name) > 128:
+        raise ValueError('class_name is longer than 128 characters')
+    image_id = record.get('image_id')
+    filename = record.get('filename')
+    if image_id is None and not filename:
+        raise ValueError('missing image_id or filename')
+
+    bbox = record.get('bbox')
+    if bbox is not None:
+        bbox = [float(value) for value in bbox]
+        if len(bbox) != 4:
+            raise ValueError('bbox needs x, y, width and height')
+    confidence = record.get('confidence')
+    row_source = record.get('source') or source
+    if row_source not in SOURCES:
+        raise ValueError(f'unknown source {row_source!r}')
+
+    return {
+        'image_id': int(image_id) if image_id is not None else None,
+        'filename': filename,
+        'class_name': class_name,
+        'bbox': bbox,
+        'confidence': float(confidence) if confidence is not None else None,
+        'source': row_source,
+    }
+
+
+def _insert_batch(project_id, batch, report):
+    image_ids = {record['image_id'] for _, record in batch if record['image_id'] is not None}
+    filenames = {record['filename'] for _, record in batch if record['image_id'] is None}
+    known_ids = set()
+    by_filename = {}
+    for image_id, filename in db.session.execute(
+            select(Image.id, Image.filename)
+            .where(Image.project_id == project_id, or_(Image.id.in_(image_ids), Image.filename.in_(filenames)))
+            .order_by(Image.id)):
+        known_ids.add(image_id)
+        by_filename.setdefault(filename, image_id)
+
+    rows = []
+    for reference, record in batch:
+        image_id = record['image_id'] if record['image_id'] is not None else by_filename.get(record['filename'])
+        if image_id not in known_ids:
+            _skip(report, reference, 'image not found in project')
+            continue
+        bbox = record['bbox'] or [None] * 4
+        rows.append({
+            'image_id': image_id,
+            'project_id': project_id,
+            'label_data': record['class_name'],
+            'class_name': record['class_name'],
+            'bbox_x': bbox[0], 'bbox_y': bbox[1], 'bbox_width': bbox[2], 'bbox_height': bbox[3],
+            'source': record['source'],
+            'confidence': record['confidence'],
+        })
+    if rows:
+        db.session.execute(Label.__table__.insert(), rows)
+        labels_added(db.session.connection(), project_id, Counter(row['class_name'] for row in rows))
+        db.session.commit()
+        report['imported'] += len(rows)
+
+
+def _skip(report, reference, error):
+    report['skipped'] += 1
+    if len(report['errors']) < MAX_REPORTED_ERRORS:
+        report['errors'].append(f'{reference}: {error}')
+
+
+def iter_labels(project_id, class_name=None, chunk_size=5000):
+    """Yield a project's labels with their image filename, in id order, one chunk at a time."""
+    last_id = 0
+    while True:
+        query = (
+            select(Label.id, Label.image_id, Image.filename, Label.class_name, Label.bbox_x, Label.bbox_y,
+                   Label.bbox_width, Label.bbox_height, Label.confidence, Label.source)
+            .join(Image, Image.id == Label.image_id)
+            .where(Label.project_id == project_id, Label.id > last_id)
+        )
+        if class_name is not None:
+            query = query.where(Label.class_name == class_name)
+        rows = db.session.execute(query.order_by(Label.id).limit(chunk_size)).all()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1].id
+
+
+def export_csv(project_id, class_name=None, chunk_size=5000):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for count, row in enumerate(iter_labels(project_id, class_name, chunk_size), start=1):
+        writer.writerow([row.image_id, row.filename, row.class_name, row.bbox_x, row.bbox_y, row.bbox_width,
+                         row.bbox_height, row.confidence, row.source])
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_coco(project_id, class_name=None, chunk_size=5000):
+    """Stream a COCO-style document; images and annotations are written as they are read."""
+    query = select(Label.class_name).where(Label.project_id == project_id).distinct().order_by(Label.class_name)
+    if class_name is not None:
+        query = query.where(Label.class_name == class_name)
+    category_ids = {name: i for i, name in enumerate(db.session.scalars(query), start=1)}
+    categories = [{'id': i, 'name': name} for name, i in category_ids.items()]
+    yield '{"categories": ' + json.dumps(categories) + ', "images": ['
+
+    last_id = 0
+    first = True
+    while True:
+        rows = db.session.execute(
+            select(Image.id, Image.filename)
+            .where(Image.project_id == project_id, Image.id > last_id)
+            .order_by(Image.id).limit(chunk_size)
+        ).all()
+        if not rows:
+            break
+        yield ('' if first else ', ') + ', '.join(json.dumps({'id': i, 'file_name': f}) for i, f in rows)
+        first = False
+        last_id = rows[-1].id
+
+    yield '], "annotations": ['
+    annotations = []
+    first = True
+    for row in iter_labels(project_id, class_name, chunk_size):
+        annotation = {'id': row.id, 'image_id': row.image_id, 'category_id': category_ids[row.class_name],
+                      'source': row.source}
+        if row.bbox_x is not None:
+            annotation['bbox'] = [row.bbox_x, row.bbox_y, row.bbox_width, row.bbox_height]
+        if row.confidence is not None:
+            annotation['score'] = row.confidence
+        annotations.append(json.dumps(annotation))
+        if len(annotations) >= chunk_size:
+            yield ('' if first else ', ') + ', '.join(annotations)
+            first = False
+            annotations = []
+    if annotations:
+        yield ('' if first else ', ') + ', '.join(annotations)
+    yield ']}'
+
+
+EXPORTERS = {
+    'csv': (export_csv, 'text/csv'),
+    'coco': (export_coco, 'application/json'),
+}
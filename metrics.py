@@ -0,0 +1,231 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, has_request_context, request
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+
+class Histogram:
+    """Cumulative-bucket histogram rendered in the Prometheus text format."""
+
+    def __init__(self, name, documentation, labelnames, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted(self._series.items())
+        for labelvalues, (counts, total, count) in series:
+            labels = _labels(zip(self.labelnames, labelvalues))
+            for bound, bucket_count in zip(self.buckets, counts):
+                le = _labels(list(zip(self.labelnames, labelvalues)) + [('le', _format(bound))])
+                lines.append(f'{self.name}_bucket{le} {bucket_count}')
+            le = _labels(list(zip(self.labelnames, labelvalues)) + [('le', '+Inf')])
+            lines.append(f'{self.name}_bucket{le} {count}')
+            lines.append(f'{self.name}_sum{labels} {_format(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ('metrics', 'name', 'started')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record_stage(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class RequestTimings:
+    __slots__ = ('started', 'stages', 'queries', 'query_seconds')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = OrderedDict()
+        self.queries = 0
+        self.query_seconds = 0.0
+
+
+class Metrics:
+    """Per-request stage timings, SQL statement counts and durations, and model loads.
+
+    Disabled (``METRICS_ENABLED`` unset) it registers no request hooks or
+    engine listeners and stage() returns a shared no-op context manager.
+    Values are per process; scrape every worker.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.server_timing = False
+        self._caches = OrderedDict()
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('METRICS_ENABLED', False)
+        self.server_timing = app.config.get('METRICS_SERVER_TIMING', False)
+        self._reset()
+        app.extensions['metrics'] = self
+        if not self.enabled:
+            return
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        from sqlalchemy import event
+        with app.app_context():
+            engine = app.extensions['sqlalchemy'].engine
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def watch_cache(self, name, cache):
+        """Report ``cache.stats()`` hits, misses and size at scrape time."""
+        self._caches[name] = cache
+
+    def stage(self, name):
+        """Time a block of the current request as stage ``name``."""
+        if not self.enabled:
+            return NULL_STAGE
+        return _Stage(self, name)
+
+    def record_stage(self, name, seconds):
+        timings = _current_timings()
+        if timings is None:
+            return
+        timings.stages[name] = timings.stages.get(name, 0.0) + seconds
+        self.stage_seconds.observe(seconds, _endpoint(), name)
+
+    def observe_model_load(self, key, seconds):
+        if not self.enabled:
+            return
+        kind = str(key[0]) if isinstance(key, tuple) else str(key)
+        runtime = str(key[2]) if isinstance(key, tuple) and len(key) > 2 else 'keras'
+        self.model_load_seconds.observe(seconds, kind, runtime)
+        self.record_stage('model_load', seconds)
+
+    def render(self):
+        lines = []
+        for histogram in (self.request_seconds, self.stage_seconds, self.request_queries,
+                          self.query_seconds, self.model_load_seconds):
+            lines.extend(histogram.render())
+        for metric, kind, documentation in (('hits', 'counter', 'Cache hits'),
+                                            ('misses', 'counter', 'Cache misses'),
+                                            ('entries', 'gauge', 'Entries currently cached')):
+            name = f'diy_ml_cache_{metric}' + ('_total' if kind == 'counter' else '')
+            lines.extend([f'# HELP {name} {documentation}', f'# TYPE {name} {kind}'])
+            for cache_name, cache in self._caches.items():
+                stats = cache.stats()
+                value = stats.get(metric, stats.get('models')) if metric == 'entries' else stats.get(metric)
+                if value is not None:
+                    lines.append(f'{name}{_labels([("cache", cache_name)])} {_format(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def _reset(self):
+        self.request_seconds = Histogram('diy_ml_request_duration_seconds', 'Request duration',
+                                         ('endpoint', 'method', 'status'))
+        self.stage_seconds = Histogram('diy_ml_request_stage_seconds', 'Time spent in each request stage',
+                                       ('endpoint', 'stage'))
+        self.request_queries = Histogram('diy_ml_request_queries', 'SQL statements executed per request',
+                                         ('endpoint',), QUERY_COUNT_BUCKETS)
+        self.query_seconds = Histogram('diy_ml_query_duration_seconds', 'SQL statement duration', ('endpoint',))
+        self.model_load_seconds = Histogram('diy_ml_model_load_seconds', 'Time to load a model into the registry',
+                                            ('kind', 'runtime'), LATENCY_BUCKETS + (30.0, 60.0))
+
+    def _before_request(self):
+        g._metrics = RequestTimings()
+
+    def _after_request(self, response):
+        timings = g.pop('_metrics', None)
+        if timings is None:
+            return response
+        elapsed = time.perf_counter() - timings.started
+        endpoint = _endpoint()
+        self.request_seconds.observe(elapsed, endpoint, request.method, str(response.status_code))
+        self.request_queries.observe(timings.queries, endpoint)
+        if self.server_timing:
+            entries = [f'db;dur={timings.query_seconds * 1000:.2f};desc="{timings.queries} queries"']
+            entries.extend(f'{name};dur={seconds * 1000:.2f}' for name, seconds in timings.stages.items())
+            entries.append(f'total;dur={elapsed * 1000:.2f}')
+            response.headers['Server-Timing'] = ', '.join(entries)
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get('metrics_started')
+        if not started:
+            return
+        seconds = time.perf_counter() - started.pop()
+        timings = _current_timings()
+        if timings is not None:
+            timings.queries += 1
+            timings.query_seconds += seconds
+        self.query_seconds.observe(seconds, _endpoint())
+
+
+def _current_timings():
+    if not has_request_context():
+        return None
+    return g.get('_metrics')
+
+
+def _endpoint():
+    # Route names rather than paths keep label cardinality bounded
+    if not has_request_context():
+        return 'background'
+    return request.endpoint or 'unmatched'
+
+
+def _labels(pairs):
+    pairs = list(pairs)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(value):
+    if isinstance(value, bool):
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,28 @@
+"""add image digest
+
+Revision ID: 010271848460
+Revises: ee81cf021452
+Create Date: 2026-10-18 11:21:05.730912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '010271848460'
+down_revision = 'ee81cf021452'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('image', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('digest', sa.String(length=64), nullable=True))
+        batch_op.create_index(batch_op.f('ix_image_digest'), ['digest'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('image', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_image_digest'))
+        batch_op.drop_column('digest')
@@ -0,0 +1,56 @@
+"""add structured label columns
+
+Revision ID: 5b8e2c7d41a9
+Revises: aed4c57e0d0b
+Create Date: 2026-10-18 13:55:12.408117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b8e2c7d41a9'
+down_revision = 'aed4c57e0d0b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('label', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('project_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('class_name', sa.String(length=128), nullable=True))
+        batch_op.add_column(sa.Column('bbox_x', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('bbox_y', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('bbox_width', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('bbox_height', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('source', sa.String(length=20), nullable=False, server_default='manual'))
+        batch_op.add_column(sa.Column('confidence', sa.Float(), nullable=True))
+        batch_op.create_foreign_key('fk_label_project_id_project', 'project', ['project_id'], ['id'])
+
+    # Existing free-form labels become their own class name
+    op.execute('UPDATE label SET class_name = substr(label_data, 1, 128), '
+               'project_id = (SELECT image.project_id FROM image WHERE image.id = label.image_id)')
+
+    with op.batch_alter_table('label', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_label_project_id'), ['project_id'], unique=False)
+        batch_op.create_index('ix_label_project_class', ['project_id', 'class_name'], unique=False)
+
+    # Per-class counts were keyed by the raw label text
+    op.execute('DELETE FROM project_label_count')
+    op.execute('DELETE FROM project_stats')
+
+
+def downgrade():
+    with op.batch_alter_table('label', schema=None) as batch_op:
+        batch_op.drop_index('ix_label_project_class')
+        batch_op.drop_index(batch_op.f('ix_label_project_id'))
+        batch_op.drop_constraint('fk_label_project_id_project', type_='foreignkey')
+        batch_op.drop_column('confidence')
+        batch_op.drop_column('source')
+        batch_op.drop_column('bbox_height')
+        batch_op.drop_column('bbox_width')
+        batch_op.drop_column('bbox_y')
+        batch_op.drop_column('bbox_x')
+        batch_op.drop_column('class_name')
+        batch_op.drop_column('project_id')
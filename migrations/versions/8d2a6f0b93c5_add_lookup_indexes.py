@@ -0,0 +1,30 @@
+"""add lookup indexes
+
+Revision ID: 8d2a6f0b93c5
+Revises: c41f7a9e2d63
+Create Date: 2026-10-18 15:12:46.503218
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2a6f0b93c5'
+down_revision = 'c41f7a9e2d63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases created by db.create_all() may already have these
+    op.create_index('ix_deployment_api_key_active', 'deployment', ['api_key', 'active'], unique=False, if_not_exists=True)
+    op.create_index('ix_image_project_id', 'image', ['project_id'], unique=False, if_not_exists=True)
+    op.create_index('ix_label_image_id', 'label', ['image_id'], unique=False, if_not_exists=True)
+    op.create_index('ix_iteration_project_id', 'iteration', ['project_id'], unique=False, if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_iteration_project_id', table_name='iteration', if_exists=True)
+    op.drop_index('ix_label_image_id', table_name='label', if_exists=True)
+    op.drop_index('ix_image_project_id', table_name='image', if_exists=True)
+    op.drop_index('ix_deployment_api_key_active', table_name='deployment', if_exists=True)
@@ -0,0 +1,49 @@
+"""add training job columns to iteration
+
+Revision ID: aed4c57e0d0b
+Revises: 010271848460
+Create Date: 2026-10-18 12:40:52.908331
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'aed4c57e0d0b'
+down_revision = '010271848460'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('iteration', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('user_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('progress', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('metrics', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('cancel_requested', sa.Boolean(), nullable=False, server_default=sa.false()))
+        batch_op.add_column(sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('created_at', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('started_at', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('finished_at', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('heartbeat_at', sa.DateTime(), nullable=True))
+        batch_op.create_foreign_key('fk_iteration_user_id_user', 'user', ['user_id'], ['id'])
+
+    # Iterations left 'running' by the old simulated trainer never had a job
+    # behind them; without this the job engine would pick them up as orphans.
+    op.execute("UPDATE iteration SET status = 'failed', result = 'No training job was recorded' "
+               "WHERE status = 'running'")
+
+
+def downgrade():
+    with op.batch_alter_table('iteration', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_iteration_user_id_user', type_='foreignkey')
+        batch_op.drop_column('heartbeat_at')
+        batch_op.drop_column('finished_at')
+        batch_op.drop_column('started_at')
+        batch_op.drop_column('created_at')
+        batch_op.drop_column('attempts')
+        batch_op.drop_column('cancel_requested')
+        batch_op.drop_column('metrics')
+        batch_op.drop_column('progress')
+        batch_op.drop_column('user_id')
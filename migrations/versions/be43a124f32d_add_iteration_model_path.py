@@ -0,0 +1,26 @@
+"""add iteration model_path
+
+Revision ID: be43a124f32d
+Revises: 3d0e1929e611
+Create Date: 2026-10-18 09:12:40.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'be43a124f32d'
+down_revision = '3d0e1929e611'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('iteration', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('model_path', sa.String(length=256), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('iteration', schema=None) as batch_op:
+        batch_op.drop_column('model_path')
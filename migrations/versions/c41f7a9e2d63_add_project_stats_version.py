@@ -0,0 +1,26 @@
+"""add project_stats.version
+
+Revision ID: c41f7a9e2d63
+Revises: 5b8e2c7d41a9
+Create Date: 2026-10-18 14:38:27.114590
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41f7a9e2d63'
+down_revision = '5b8e2c7d41a9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('project_stats', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('project_stats', schema=None) as batch_op:
+        batch_op.drop_column('version')
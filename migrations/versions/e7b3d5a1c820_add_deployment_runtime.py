@@ -0,0 +1,26 @@
+"""add deployment.runtime
+
+Revision ID: e7b3d5a1c820
+Revises: 8d2a6f0b93c5
+Create Date: 2026-10-18 15:47:03.226951
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b3d5a1c820'
+down_revision = '8d2a6f0b93c5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('deployment', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('runtime', sa.String(length=20), nullable=False, server_default='keras'))
+
+
+def downgrade():
+    with op.batch_alter_table('deployment', schema=None) as batch_op:
+        batch_op.drop_column('runtime')
@@ -0,0 +1,44 @@
+"""add project stats summaries
+
+Revision ID: ee81cf021452
+Revises: be43a124f32d
+Create Date: 2026-10-18 10:03:27.554190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ee81cf021452'
+down_revision = 'be43a124f32d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('project_stats',
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('image_count', sa.Integer(), nullable=False),
+    sa.Column('label_count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['project_id'], ['project.id'], ),
+    sa.PrimaryKeyConstraint('project_id')
+    )
+    op.create_table('project_label_count',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('label', sa.Text(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['project_id'], ['project.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('project_label_count', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_project_label_count_project_id'), ['project_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('project_label_count', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_project_label_count_project_id'))
+
+    op.drop_table('project_label_count')
+    op.drop_table('project_stats')
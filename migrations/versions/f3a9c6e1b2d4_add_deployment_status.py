@@ -0,0 +1,28 @@
+"""add deployment.status and deployment.error
+
+Revision ID: f3a9c6e1b2d4
+Revises: e7b3d5a1c820
+Create Date: 2026-10-18 21:05:41.718302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a9c6e1b2d4'
+down_revision = 'e7b3d5a1c820'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('deployment', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('status', sa.String(length=20), nullable=False, server_default='ready'))
+        batch_op.add_column(sa.Column('error', sa.Text(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('deployment', schema=None) as batch_op:
+        batch_op.drop_column('error')
+        batch_op.drop_column('status')
@@ -0,0 +1,151 @@
+import threading
+
+import numpy as np
+from PIL import Image as PILImage
+
+from extensions import model_registry, tensor_cache, metrics
+
+# TensorFlow is imported lazily by the helpers below so that importing the
+# app (and serving non-ML routes) does not pay for it.
+
+INPUT_SIZE = (224, 224)
+
+_default_model = None
+_default_model_lock = threading.Lock()
+_default_model_ready = threading.Event()
+_warmup_thread = None
+_feature_extractor = None
+
+# Identifies the backbone weights and preprocessing behind stored features;
+# change it whenever either changes so old embeddings are not reused.
+BACKBONE_VERSION = 'mobilenet_v2-imagenet-224'
+
+
+def _build_default_model():
+    import tensorflow as tf
+    # Inference only, so the model is never compiled
+    return tf.keras.applications.MobileNetV2(weights='imagenet', include_top=True)
+
+
+def get_default_model():
+    global _default_model
+    if _default_model is None:
+        with _default_model_lock:
+            built = _default_model is None
+            if built:
+                _default_model = _build_default_model()
+        if built:
+            # Built lazily by a request, so warm it too; otherwise /ready would never report ready
+            start_warmup()
+    return _default_model
+
+
+def get_feature_extractor():
+    # Penultimate-layer (global average pooling) output of the default model
+    global _feature_extractor
+    if _feature_extractor is None:
+        model = get_default_model()
+        with _default_model_lock:
+            if _feature_extractor is None:
+                import tensorflow as tf
+                _feature_extractor = tf.keras.Model(model.inputs, model.layers[-2].output)
+    return _feature_extractor
+
+
+def warm_default_model():
+    model = get_default_model()
+    if not _default_model_ready.is_set():
+        model_registry.warm(model)
+        _default_model_ready.set()
+    return model
+
+
+def start_warmup():
+    global _warmup_thread
+    with _default_model_lock:
+        if _warmup_thread is None and not _default_model_ready.is_set():
+            _warmup_thread = threading.Thread(target=warm_default_model, name='default-model-warmup', daemon=True)
+            _warmup_thread.start()
+    return _warmup_thread
+
+
+def default_model_status():
+    if _default_model_ready.is_set():
+        return 'ready'
+    if _warmup_thread is not None and _warmup_thread.is_alive():
+        return 'warming'
+    if _default_model is not None:
+        return 'loaded'
+    return 'not_loaded'
+
+
+def load_model(path):
+    import tensorflow as tf
+    return tf.keras.models.load_model(path)
+
+
+def model_input_size(model):
+    input_shape = getattr(model, 'input_shape', None)
+    if input_shape and len(input_shape) == 4 and input_shape[1] and input_shape[2]:
+        return (int(input_shape[1]), int(input_shape[2]))
+    return INPUT_SIZE
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+def load_image(path, target_size=INPUT_SIZE, dtype='float32', max_pixels=None):
+    # Same decode and nearest-neighbour resize as keras' load_img
+    with PILImage.open(path) as img:
+        # Only the header has been read so far, so oversized images are refused before decoding
+        if max_pixels and img.width * img.height > max_pixels:
+            raise ImageTooLarge(f'Image is {img.width}x{img.height}; at most {max_pixels} pixels are decoded')
+        img = img.convert('RGB')
+        if img.size != (target_size[1], target_size[0]):
+            img = img.resize((target_size[1], target_size[0]), PILImage.NEAREST)
+        return np.asarray(img, dtype=dtype)
+
+
+def cache_image_tensor(project_id, image_id, path, target_size=INPUT_SIZE):
+    pixels = load_image(path, target_size, dtype='uint8')
+    tensor_cache.put(project_id, image_id, pixels, target_size)
+    return pixels
+
+
+def load_image_tensor(project_id, image_id, path, target_size=INPUT_SIZE):
+    # Read the resized pixels from the tensor cache, decoding only on a miss
+    with metrics.stage('decode'):
+        pixels = tensor_cache.get(project_id, image_id, target_size)
+        if pixels is None:
+            pixels = cache_image_tensor(project_id, image_id, path, target_size)
+    with metrics.stage('preprocess'):
+        return preprocess_input(pixels)
+
+
+def preprocess_signature(target_size=INPUT_SIZE):
+    # Identifies the decode/resize/scale pipeline in prediction cache keys
+    return f'{target_size[0]}x{target_size[1]}/nearest/mobilenet_v2'
+
+
+def preprocess_input(x):
+    # MobileNetV2 scaling: [0, 255] -> [-1, 1]
+    x = np.asarray(x, dtype='float32')
+    return x / 127.5 - 1.0
+
+
+def decode_predictions(predictions, top=3):
+    from tensorflow.keras.applications.mobilenet_v2 import decode_predictions as _decode
+    return _decode(predictions, top=top)
+
+
+def format_predictions(predictions, top=3):
+    if predictions.shape[-1] == 1000:
+        return [[{'label': label, 'description': description, 'score': float(score)}
+                 for label, description, score in row]
+                for row in decode_predictions(predictions, top=top)]
+    results = []
+    for row in predictions:
+        best = np.argsort(row)[::-1][:top]
+        results.append([{'label': int(i), 'score': float(row[i])} for i in best])
+    return results
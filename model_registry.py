@@ -0,0 +1,184 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def _load_model(path):
+    if path.endswith('.tflite'):
+        from runtimes import TFLiteModel
+        return TFLiteModel(path)
+    import tensorflow as tf
+    return tf.keras.models.load_model(path)
+
+
+class _Entry:
+    __slots__ = ('model', 'mtime', 'nbytes')
+
+    def __init__(self, model, mtime, nbytes):
+        self.model = model
+        self.mtime = mtime
+        self.nbytes = nbytes
+
+
+class ModelRegistry:
+    """Keeps loaded models resident, keyed by iteration and artifact mtime.
+
+    Entries are evicted least-recently-used first once either the model
+    count or the estimated memory budget is exceeded.
+    """
+
+    def __init__(self, app=None, loader=None):
+        self.loader = loader or _load_model
+        self.max_models = 4
+        self.max_bytes = 2 * 1024 ** 3
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0
+        self.load_seconds = 0.0
+        # Called as on_load(key, seconds) after each load, e.g. by metrics
+        self.on_load = None
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._key_locks = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_models = app.config.get('MODEL_REGISTRY_MAX_MODELS', self.max_models)
+        self.max_bytes = app.config.get('MODEL_REGISTRY_MAX_BYTES', self.max_bytes)
+        app.extensions['model_registry'] = self
+
+    @staticmethod
+    def iteration_key(iteration_id, runtime='keras'):
+        if runtime == 'keras':
+            return ('iteration', iteration_id)
+        return ('iteration', iteration_id, runtime)
+
+    @staticmethod
+    def default_key(project_id, runtime):
+        return ('default', project_id, runtime)
+
+    def get(self, key, path, warm=False):
+        mtime = os.path.getmtime(path)
+        model = self._lookup(key, mtime)
+        if model is not None:
+            return model
+
+        # Serialise loads per key so concurrent requests do not each pay
+        # for reading the same artifact.
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            model = self._lookup(key, mtime)
+            if model is not None:
+                return model
+            started = time.perf_counter()
+            model = self.loader(path)
+            self._record_load(key, time.perf_counter() - started)
+            if warm:
+                self.warm(model)
+            self._insert(key, _Entry(model, mtime, _estimate_nbytes(model, path)))
+            return model
+
+    def get_for_iteration(self, iteration, warm=False):
+        model_path = getattr(iteration, 'model_path', None)
+        if not model_path or not os.path.exists(model_path):
+            return None
+        return self.get(self.iteration_key(iteration.id), model_path, warm=warm)
+
+    def get_for_deployment(self, deployment, warm=False):
+        from runtimes import deployment_artifact
+        artifact = deployment_artifact(deployment)
+        if artifact is None or not os.path.exists(artifact[1]):
+            return None
+        return self.get(*artifact, warm=warm)
+
+    def invalidate(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            self._key_locks.pop(key, None)
+        return entry is not None
+
+    def invalidate_deployment(self, deployment):
+        from runtimes import deployment_key
+        key = deployment_key(deployment)
+        if key is not None:
+            self.invalidate(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._key_locks.clear()
+
+    def warm(self, model):
+        # One dummy forward pass builds the predict function up front so the
+        # first real request does not pay for tracing.
+        input_shape = getattr(model, 'input_shape', None)
+        if not input_shape or any(dim is None for dim in input_shape[1:]):
+            return
+        dummy = np.zeros((1,) + tuple(input_shape[1:]), dtype='float32')
+        model.predict(dummy, verbose=0)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'models': len(self._entries),
+                'bytes': sum(e.nbytes for e in self._entries.values()),
+                'max_models': self.max_models,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'loads': self.loads,
+                'load_seconds': self.load_seconds,
+            }
+
+    def _record_load(self, key, seconds):
+        with self._lock:
+            self.loads += 1
+            self.load_seconds += seconds
+        if self.on_load is not None:
+            self.on_load(key, seconds)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def _lookup(self, key, mtime):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.mtime == mtime:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.model
+            if entry is not None:
+                # Artifact was rewritten on disk since it was loaded.
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def _insert(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            total = sum(e.nbytes for e in self._entries.values())
+            while len(self._entries) > 1 and (len(self._entries) > self.max_models or total > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                total -= evicted.nbytes
+                self.evictions += 1
+
+
+def _estimate_nbytes(model, path=None):
+    count_params = getattr(model, 'count_params', None)
+    if count_params is not None:
+        try:
+            return int(count_params()) * 4
+        except Exception:
+            pass
+    if path and os.path.exists(path):
+        return os.path.getsize(path)
+    return 0
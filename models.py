@@ -1,7 +1,9 @@
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from extensions import db
+from sqlalchemy import event
+from extensions import db, model_registry, inference_batchers, tensor_cache, prediction_cache, feature_store, embedding_index, api_key_cache, user_cache
+from prediction_cache import iteration_model_id
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -25,13 +27,43 @@ class Project(db.Model):
 class Image(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(128), nullable=False)
-    project_id = db.Column(db.Integer, db.ForeignKey('project.id'))
-    labels = db.relationship('Label', backref='image', lazy=True)
+    digest = db.Column(db.String(64), nullable=True, index=True)  # SHA-256 of the stored content
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), index=True)
+    labels = db.relationship('Label', backref='image', lazy=True, cascade='all, delete-orphan')
 
 class Label(db.Model):
+    __table_args__ = (db.Index('ix_label_project_class', 'project_id', 'class_name'),)
+
     id = db.Column(db.Integer, primary_key=True)
-    image_id = db.Column(db.Integer, db.ForeignKey('image.id'))
-    label_data = db.Column(db.Text, nullable=False)
+    image_id = db.Column(db.Integer, db.ForeignKey('image.id'), index=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), index=True)  # Copied from the image
+    label_data = db.Column(db.Text, nullable=False)  # Free-form text, kept equal to class_name for new labels
+    class_name = db.Column(db.String(128))
+    bbox_x = db.Column(db.Float, nullable=True)  # Bounding box for object detection projects
+    bbox_y = db.Column(db.Float, nullable=True)
+    bbox_width = db.Column(db.Float, nullable=True)
+    bbox_height = db.Column(db.Float, nullable=True)
+    source = db.Column(db.String(20), nullable=False, default='manual')  # manual, import or prediction
+    confidence = db.Column(db.Float, nullable=True)
+
+    @property
+    def bbox(self):
+        if self.bbox_x is None:
+            return None
+        return [self.bbox_x, self.bbox_y, self.bbox_width, self.bbox_height]
+
+class ProjectStats(db.Model):
+    # Summary maintained incrementally by the listeners in analytics.py
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), primary_key=True)
+    image_count = db.Column(db.Integer, nullable=False, default=0)
+    label_count = db.Column(db.Integer, nullable=False, default=0)
+    version = db.Column(db.Integer, nullable=False, default=0)  # Bumped on every change; used for ETags
+
+class ProjectLabelCount(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False, index=True)
+    label = db.Column(db.Text, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
 
 class TrainingConfig(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -40,14 +72,72 @@ class TrainingConfig(db.Model):
 
 class Iteration(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    project_id = db.Column(db.Integer, db.ForeignKey('project.id'))
-    status = db.Column(db.String(20), nullable=False)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    status = db.Column(db.String(20), nullable=False)  # queued, running, completed, failed or cancelled
     result = db.Column(db.Text)
+    model_path = db.Column(db.String(256), nullable=True)
+    progress = db.Column(db.Float, default=0.0)
+    metrics = db.Column(db.Text)  # JSON reported by the training worker
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
 
 class Deployment(db.Model):
+    # Covers the per-request lookup by API key without touching the table
+    __table_args__ = (db.Index('ix_deployment_api_key_active', 'api_key', 'active'),)
+
     id = db.Column(db.Integer, primary_key=True)
     project_id = db.Column(db.Integer, db.ForeignKey('project.id'))
     iteration_id = db.Column(db.Integer, db.ForeignKey('iteration.id'))
     api_key = db.Column(db.String(128), unique=True, nullable=False)
     active = db.Column(db.Boolean, default=True)
+    runtime = db.Column(db.String(20), nullable=False, default='keras')  # keras, tflite-fp32, tflite-dynamic or tflite-int8
+    status = db.Column(db.String(20), nullable=False, default='ready')  # pending or exporting while its runtime is converted, ready or failed
+    error = db.Column(db.Text)
     iteration = db.relationship('Iteration', backref='deployment', uselist=False)
+
+@event.listens_for(Deployment.active, 'set')
+def _invalidate_deactivated_model(target, value, oldvalue, initiator):
+    api_key_cache.pop(target.api_key)
+    if not value:
+        model_registry.invalidate_deployment(target)
+        inference_batchers.close(target.id)
+        if target.iteration_id:
+            prediction_cache.invalidate_model(iteration_model_id(target.iteration_id))
+
+@event.listens_for(Deployment.iteration_id, 'set')
+def _invalidate_replaced_iteration(target, value, oldvalue, initiator):
+    api_key_cache.pop(target.api_key)
+    if isinstance(oldvalue, int) and oldvalue != value:
+        prediction_cache.invalidate_model(iteration_model_id(oldvalue))
+
+@event.listens_for(Deployment, 'after_insert')
+@event.listens_for(Deployment, 'after_delete')
+def _invalidate_api_key(mapper, connection, target):
+    # Unknown keys are cached too, so a new deployment must evict its key
+    api_key_cache.pop(target.api_key)
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_cached_user(mapper, connection, target):
+    user_cache.pop(target.id)
+
+@event.listens_for(Label, 'before_insert')
+def _fill_label_columns(mapper, connection, target):
+    if target.class_name is None:
+        target.class_name = target.label_data
+    if target.label_data is None:
+        target.label_data = target.class_name
+    if target.project_id is None and target.image_id is not None:
+        target.project_id = connection.execute(
+            db.select(Image.project_id).where(Image.id == target.image_id)).scalar()
+
+@event.listens_for(Image, 'after_delete')
+def _invalidate_cached_tensor(mapper, connection, target):
+    tensor_cache.invalidate(target.project_id, target.id)
+    feature_store.remove(target.project_id, [target.id])
+    embedding_index.remove(target.project_id, [target.id])
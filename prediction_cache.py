@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MODEL_ID = 'default:mobilenet_v2'
+
+
+def iteration_model_id(iteration_id):
+    return f'iteration:{iteration_id}'
+
+
+class PredictionCache:
+    """Prediction results keyed by image digest, model version and preprocessing.
+
+    A bounded in-memory LRU tier sits in front of an optional SQLite tier
+    which survives restarts and is shared between worker processes; a
+    ``max_entries`` of 0 turns the whole cache off. Model
+    versions look like ``iteration:12@1715044815.2`` so every version of a
+    model can be dropped at once by its id (the part before ``@``).
+    """
+
+    def __init__(self, app=None, max_entries=10000, sqlite_path=None):
+        self.max_entries = max_entries
+        self.sqlite_path = sqlite_path
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_entries = app.config.get('PREDICTION_CACHE_MAX_ENTRIES', self.max_entries)
+        self.sqlite_path = app.config.get('PREDICTION_CACHE_SQLITE', self.sqlite_path)
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.disk_hits = self.misses = 0
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        app.extensions['prediction_cache'] = self
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def model_version(model_id, stamp=None):
+        return model_id if stamp is None else f'{model_id}@{stamp}'
+
+    def get(self, digest, model_version, signature):
+        key = (digest, model_version, signature)
+        with self._lock:
+            if not self.max_entries:
+                self.misses += 1
+                return None
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result
+
+            conn = self._connection()
+            if conn is not None:
+                row = conn.execute(
+                    'SELECT result FROM prediction_cache WHERE digest = ? AND model_version = ? AND signature = ?',
+                    key).fetchone()
+                if row is not None:
+                    result = json.loads(row[0])
+                    self._remember(key, result)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return result
+            self.misses += 1
+            return None
+
+    def put(self, digest, model_version, signature, result):
+        key = (digest, model_version, signature)
+        with self._lock:
+            if not self.max_entries:
+                return
+            self._remember(key, result)
+            conn = self._connection()
+            if conn is not None:
+                conn.execute(
+                    'INSERT OR REPLACE INTO prediction_cache (digest, model_version, model_id, signature, result, created_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (digest, model_version, model_version.split('@', 1)[0], signature, json.dumps(result), time.time()))
+                conn.commit()
+
+    def invalidate_model(self, model_id):
+        with self._lock:
+            for key in [k for k in self._entries if k[1].split('@', 1)[0] == model_id]:
+                del self._entries[key]
+            conn = self._connection()
+            if conn is not None:
+                conn.execute('DELETE FROM prediction_cache WHERE model_id = ?', (model_id,))
+                conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            conn = self._connection()
+            if conn is not None:
+                conn.execute('DELETE FROM prediction_cache')
+                conn.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / lookups) if lookups else 0.0,
+                'sqlite': bool(self.sqlite_path),
+            }
+
+    def _remember(self, key, result):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _connection(self):
+        if not self.sqlite_path:
+            return None
+        if self._conn is None:
+            directory = os.path.dirname(self.sqlite_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Access is serialised by self._lock
+            self._conn = sqlite3.connect(self.sqlite_path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS prediction_cache ('
+                'digest TEXT NOT NULL, model_version TEXT NOT NULL, model_id TEXT NOT NULL, '
+                'signature TEXT NOT NULL, result TEXT NOT NULL, created_at REAL NOT NULL, '
+                'PRIMARY KEY (digest, model_version, signature))')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS ix_prediction_cache_model_id ON prediction_cache (model_id)')
+            self._conn.commit()
+        return self._conn
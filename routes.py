@@ -1,29 +1,166 @@
-from flask import Blueprint, request, jsonify, render_template, redirect, url_for, flash, current_app
+from flask import Blueprint, Response, request, jsonify, render_template, redirect, url_for, flash, current_app, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
+from sqlalchemy import select
 from models import db, User, Project, Image, Label, TrainingConfig, Iteration, Deployment
+from extensions import (model_registry, inference_batchers, inference_pool, prediction_cache, storage, api_key_cache, metrics,
+                        embedding_index)
+from prediction_cache import DEFAULT_MODEL_ID, iteration_model_id
+from analytics import analyze, project_summaries, project_version, user_projects_version
+from labels import PARSERS, EXPORTERS, import_labels
+from ingest import ingest_images, is_image_filename
+from batch_predict import iter_image_rows, decode_image, predict_stream
+from jobs import training_engine, PENDING, EXPORTING
+from garbage import delete_images, delete_projects, forget_iteration
+from inference_pool import PoolBusy
+from inference_input import PayloadError, read_payload
+from runtimes import RUNTIMES, deployment_artifact, artifact_path, default_model_path, needs_export, load_report
+from ml import (get_default_model, warm_default_model, default_model_status, load_model, preprocess_input,
+                format_predictions, model_input_size, cache_image_tensor, load_image_tensor, preprocess_signature, INPUT_SIZE)
+import hashlib
+from collections import namedtuple
 import os
 import json
-import tensorflow as tf
 import datetime
-from tensorflow.keras.preprocessing import image
-from tensorflow.keras.applications.mobilenet_v2 import preprocess_input, decode_predictions
-from tensorflow.keras.preprocessing.image import load_img, img_to_array
 import numpy as np
-from tensorflow.keras.layers import TFSMLayer
-from PIL import Image as PILImage
 
 
 main = Blueprint('main', __name__)
 
-# Load pre-trained MobileNetV2 model
-default_model = tf.keras.applications.MobileNetV2(weights='imagenet', include_top=True)
-default_model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
-
+# The pre-trained MobileNetV2 model is built on first use, see ml.get_default_model()
 user_model = None
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'png', 'jpg', 'jpeg'}
+    return is_image_filename(filename)
+
+def deployment_model(deployment):
+    # Custom iteration models and converted runtimes stay resident in the registry between requests
+    model = model_registry.get_for_deployment(deployment)
+    if model is None:
+        model = get_default_model()  # Fallback to default model if no custom model is loaded
+    return model
+
+def deployment_model_version(deployment):
+    # Changes whenever the served model artifact (or its runtime) changes
+    model_id = iteration_model_id(deployment.iteration_id) if deployment.iteration_id else DEFAULT_MODEL_ID
+    artifact = deployment_artifact(deployment)
+    if artifact is None or not os.path.exists(artifact[1]):
+        return prediction_cache.model_version(model_id)
+    stamp = os.path.getmtime(artifact[1])
+    runtime = deployment.runtime or 'keras'
+    return prediction_cache.model_version(model_id, stamp if runtime == 'keras' else f'{runtime}:{stamp}')
+
+def deployment_input_size(deployment):
+    # Under serve.py models live only in the inference processes, which expect INPUT_SIZE like /inference
+    if inference_pool.enabled:
+        return INPUT_SIZE
+    return model_input_size(deployment_model(deployment))
+
+def deployment_top_predictions(deployment, x):
+    # Formatted top predictions for each row of ``x``
+    if inference_pool.enabled:
+        return inference_pool.predict_many(deployment_artifact(deployment), x)
+    return format_predictions(deployment_model(deployment).predict(x))
+
+def deployment_predict_fn(deployment):
+    # Resolve the model on every batch so registry eviction is honoured
+    artifact = deployment_artifact(deployment)
+    if artifact is not None:
+        key, path = artifact
+        return lambda x: model_registry.get(key, path).predict(x, verbose=0)
+    return lambda x: get_default_model().predict(x, verbose=0)
+
+# What /inference needs from a deployment, cached per API key by resolve_api_key()
+ResolvedDeployment = namedtuple('ResolvedDeployment', 'id project_id iteration_id model_version predict_fn artifact')
+
+def resolve_api_key(api_key):
+    # Returns PENDING for a key whose model is still being converted
+    resolved = api_key_cache.get(api_key)
+    if resolved is None:
+        deployment = Deployment.query.filter_by(api_key=api_key).first()
+        # Unknown keys are cached as False so floods of bad keys skip the database too, but only
+        # briefly: a key just deployed through another worker must start working promptly
+        if deployment is None or not deployment.active:
+            resolved = PENDING if deployment is not None and deployment.status in (PENDING, EXPORTING) else False
+        else:
+            resolved = ResolvedDeployment(
+                deployment.id, deployment.project_id, deployment.iteration_id, deployment_model_version(deployment),
+                deployment_predict_fn(deployment), deployment_artifact(deployment))
+        api_key_cache.put(api_key, resolved, ttl=None if isinstance(resolved, ResolvedDeployment)
+                          else current_app.config.get('API_KEY_CACHE_MISS_TTL', 1.0))
+    return resolved or None
+
+def pending_deployment_response():
+    response = jsonify({'error': 'Deployment is still being prepared', 'status': PENDING})
+    response.headers['Retry-After'] = '5'
+    return response, 503
+
+IMAGE_FIELDS = {'id': Image.id, 'filename': Image.filename, 'digest': Image.digest}
+PROJECT_FIELDS = {'id': Project.id, 'name': Project.name, 'description': Project.description,
+                  'project_type': Project.project_type}
+
+def page_args():
+    # Keyset pagination: the cursor is the last id of the previous page
+    cursor = int(request.args.get('cursor', 0))
+    limit = int(request.args.get('limit', current_app.config.get('PAGE_SIZE', 1000)))
+    return cursor, max(1, min(limit, current_app.config.get('MAX_PAGE_SIZE', 10000)))
+
+def batch_predict_args(params):
+    # image_ids as a list or comma-separated string; batch_size is clamped to BATCH_PREDICT_MAX_BATCH_SIZE
+    image_ids = params.get('image_ids')
+    if isinstance(image_ids, str):
+        image_ids = [i for i in image_ids.split(',') if i.strip()]
+    if image_ids is not None:
+        if not isinstance(image_ids, list):
+            raise ValueError('image_ids must be a list of integers')
+        try:
+            image_ids = [int(i) for i in image_ids]
+        except (TypeError, ValueError):
+            raise ValueError('image_ids must be a list of integers')
+    config = current_app.config
+    try:
+        batch_size = int(params.get('batch_size', config.get('BATCH_PREDICT_BATCH_SIZE', 32)))
+    except (TypeError, ValueError):
+        raise ValueError('batch_size must be an integer')
+    if batch_size < 1:
+        raise ValueError('batch_size must be at least 1')
+    return image_ids, min(batch_size, config.get('BATCH_PREDICT_MAX_BATCH_SIZE', 256))
+
+def selected_fields(available, default):
+    fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()] or list(default)
+    unknown = [f for f in fields if f not in available]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+def listing_etag(version):
+    # Each page and projection of a listing gets its own tag
+    return hashlib.sha1(f'{version}?{request.query_string.decode()}'.encode()).hexdigest()
+
+def not_modified(etag):
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+    return None
+
+def keyset_page(available, fields, where, cursor, limit):
+    id_column = available['id']
+    columns = [id_column] + [available[f] for f in fields if f != 'id']
+    rows = db.session.execute(
+        select(*columns).where(where, id_column > cursor).order_by(id_column).limit(limit + 1)).all()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    return [{f: getattr(row, f) for f in fields} for row in rows[:limit]], next_cursor
+
+def paged_response(body, next_cursor, etag):
+    response = jsonify(body)
+    response.set_etag(etag, weak=True)
+    if next_cursor is not None:
+        args = request.args.to_dict()
+        args['cursor'] = next_cursor
+        response.headers['X-Next-Cursor'] = str(next_cursor)
+        response.headers['Link'] = f'<{url_for(request.endpoint, **request.view_args, **args)}>; rel="next"'
+    return response
 
 @main.route('/')
 def home():
@@ -32,6 +169,15 @@ def home():
         return redirect(url_for('main.dashboard'))
     return render_template('home.html')
 
+@main.route('/ready', methods=['GET'])
+def ready():
+    if inference_pool.enabled:
+        # Models live in the inference processes, not in this web worker
+        status = 'ready' if inference_pool.ready() else 'loading'
+        return jsonify({'ready': status == 'ready', 'inference_pool': status}), (200 if status == 'ready' else 503)
+    status = default_model_status()
+    return jsonify({'ready': status == 'ready', 'default_model': status}), (200 if status == 'ready' else 503)
+
 @main.route('/logout')
 @login_required
 def logout():
@@ -42,9 +188,11 @@ def logout():
 @login_required
 def dashboard():
     projects = Project.query.filter_by(user_id=current_user.id).all()
+    # Read the maintained summaries rather than scanning every project's images
+    summaries = project_summaries(project.id for project in projects)
     projects_details = []
     for project in projects:
-        analysis = analyze_project(project.id)
+        analysis = summaries[project.id]
         projects_details.append({
             'id': project.id,
             'name': project.name,
@@ -62,7 +210,7 @@ def upload_model():
         filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
         file.save(filepath)
         global user_model
-        user_model = tf.keras.models.load_model(filepath)
+        user_model = load_model(filepath)
         flash('Model uploaded successfully.')
     else:
         flash('Failed to upload model or file type not allowed.')
@@ -74,27 +222,33 @@ def predict(project_id):
     if request.method == 'POST':
         image_id = request.form.get('image_id')
         image_record = Image.query.get_or_404(image_id)  # Ensure the image ID exists in the database
-        img_path = os.path.join(current_app.config['UPLOAD_FOLDER'], image_record.filename)
 
         try:
-            img = load_img(img_path, target_size=(224, 224))
-            x = img_to_array(img)
-            x = np.expand_dims(x, axis=0)
-            x = preprocess_input(x)
-
             deployment = Deployment.query.filter_by(project_id=project_id, active=True).first()
             if not deployment:
                 flash('No active deployment found for this project.')
                 return redirect(url_for('main.manage_project', project_id=project_id))
 
-            model_path = deployment.iteration.model_path if deployment.iteration_id else 'path/to/default_model'
-            if model_path.endswith('.h5'):
-                model_to_use = tf.keras.models.load_model(model_path)
-            else:
-                model_to_use = default_model  # Fallback to default model if no custom model is loaded
-
-            predictions = model_to_use.predict(x)  # Use predict method
-            predicted_classes = decode_predictions(predictions, top=3)[0]  # Ensure to decode predictions
+            target_size = deployment_input_size(deployment)
+
+            # Identical image bytes under the same model skip decode and the forward pass
+            with metrics.stage('cache'):
+                digest = image_record.digest
+                if not digest:
+                    # Rows without a digest predate content addressing, so the source is a plain path
+                    with storage.image_source(image_record) as img_path, open(img_path, 'rb') as f:
+                        digest = prediction_cache.digest(f.read())
+                cache_key = (digest, deployment_model_version(deployment), preprocess_signature(target_size))
+                top = prediction_cache.get(*cache_key)
+            if top is None:
+                with storage.image_source(image_record) as source:
+                    x = load_image_tensor(image_record.project_id, image_record.id, source, target_size)
+                x = np.expand_dims(x, axis=0)
+
+                with metrics.stage('predict'):
+                    top = deployment_top_predictions(deployment, x)[0]
+                prediction_cache.put(*cache_key, top)
+            predicted_classes = [(p['label'], p.get('description', str(p['label'])), p['score']) for p in top]
             return render_template('results.html', predictions=predicted_classes, project_id=project_id)
         except Exception as e:
             flash(f'Error in prediction: {str(e)}')
@@ -106,6 +260,61 @@ def predict(project_id):
 
     return jsonify({'error': 'Method not supported'}), 405
 
+@main.route('/projects/<int:project_id>/predict_batch', methods=['POST'])
+@login_required
+def predict_batch(project_id):
+    project = Project.query.get_or_404(project_id)
+    if project.user_id != current_user.id:
+        return jsonify({'error': 'You do not have permission to access this project'}), 403
+    deployment = Deployment.query.filter_by(project_id=project_id, active=True).first()
+    if not deployment:
+        return jsonify({'error': 'No active deployment found for this project'}), 404
+
+    params = request.get_json(silent=True) or request.form
+    try:
+        image_ids, batch_size = batch_predict_args(params)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    persist = str(params.get('persist', '')).lower() in ('1', 'true', 'yes')
+    workers = current_app.config.get('BATCH_PREDICT_WORKERS', 4)
+    target_size = deployment_input_size(deployment)
+    # Each batch comes back as formatted top predictions, one list per image
+    if inference_pool.enabled:
+        artifact = deployment_artifact(deployment)
+        predict_fn = lambda x: inference_pool.predict_many(artifact, x)
+    else:
+        model_predict_fn = deployment_predict_fn(deployment)
+        predict_fn = lambda x: format_predictions(model_predict_fn(x))
+
+    def generate():
+        count = errors = 0
+        pending_labels = []
+        rows = iter_image_rows(project_id, image_ids)
+        results = predict_stream(rows, lambda row: decode_image(project_id, row, target_size),
+                                 predict_fn, batch_size=batch_size, workers=workers)
+        for row, top, error in results:
+            count += 1
+            if error is not None:
+                errors += 1
+                yield json.dumps({'image_id': row.id, 'filename': row.filename, 'error': str(error)}) + '\n'
+                continue
+            if persist:
+                pending_labels.append(Label(image_id=row.id, project_id=project_id, source='prediction',
+                                            class_name=str(top[0].get('description', top[0]['label'])),
+                                            confidence=top[0]['score']))
+                if len(pending_labels) >= batch_size:
+                    db.session.add_all(pending_labels)
+                    db.session.commit()
+                    pending_labels = []
+            yield json.dumps({'image_id': row.id, 'filename': row.filename, 'predictions': top}) + '\n'
+        if pending_labels:
+            db.session.add_all(pending_labels)
+            db.session.commit()
+        yield json.dumps({'done': True, 'count': count, 'errors': errors}) + '\n'
+
+    # Results are streamed line by line as each batch completes
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @main.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -163,21 +372,53 @@ def upload_image(project_id):
         file = request.files['image']
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
-            new_image = Image(filename=filename, project_id=project_id)
+            # Hashed while streamed to disk; identical content is stored once
+            digest, _, _ = storage.save_stream(file.stream)
+            new_image = Image(filename=filename, digest=digest, project_id=project_id)
             db.session.add(new_image)
             db.session.commit()
+            # Decode once now so predictions read the cached tensor instead
+            try:
+                with storage.image_source(new_image) as source:
+                    pixels = cache_image_tensor(project_id, new_image.id, source)
+                embedding_index.add(project_id, [new_image.id], [pixels])
+            except Exception as e:
+                current_app.logger.warning('Could not cache or index image %s: %s', new_image.id, e)
             flash('Image uploaded successfully')
         return redirect(url_for('main.manage_project', project_id=project_id))
     return render_template('upload_image.html', project=project, project_id=project_id)
 
+@main.route('/projects/<int:project_id>/upload_images', methods=['POST'])
+@login_required
+def upload_images(project_id):
+    project = Project.query.get_or_404(project_id)
+    if project.user_id != current_user.id:
+        return jsonify({'error': 'You do not have permission to access this project'}), 403
+    files = request.files.getlist('images')
+    if not files:
+        return jsonify({'error': 'No files provided'}), 400
+    config = current_app.config
+    report = ingest_images(project_id, files,
+                           batch_size=config.get('INGEST_BATCH_SIZE', 500),
+                           workers=config.get('INGEST_WORKERS', 4),
+                           max_file_bytes=config.get('INGEST_MAX_FILE_BYTES', 50 * 1024 * 1024))
+    # A damaged upload still reports the images stored before the damage
+    return jsonify(report), 400 if 'error' in report else 200
+
 
 @main.route('/projects/<int:user_id>', methods=['GET'])
 def get_projects(user_id):
-    projects = Project.query.filter_by(user_id=user_id).all()
-    projects_data = [{'id': p.id, 'name': p.name, 'description': p.description} for p in projects]
-    return jsonify(projects_data), 200
+    try:
+        cursor, limit = page_args()
+        fields = selected_fields(PROJECT_FIELDS, ('id', 'name', 'description'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    etag = listing_etag(f'user-{user_id}-{user_projects_version(user_id)}')
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    projects_data, next_cursor = keyset_page(PROJECT_FIELDS, fields, Project.user_id == user_id, cursor, limit)
+    return paged_response(projects_data, next_cursor, etag)
 
 @main.route('/projects/<int:project_id>', methods=['POST'])
 @login_required
@@ -188,8 +429,8 @@ def delete_project(project_id):
         return redirect(url_for('main.dashboard'))
 
     if request.form.get('_method') == 'DELETE':
-        db.session.delete(project)
-        db.session.commit()
+        # Set-based, so a large project is not loaded row by row; its files are collected in the background
+        delete_projects([project_id], current_app.config.get('GC_DELETE_CHUNK_SIZE', 1000))
         flash('Project deleted successfully')
         return redirect(url_for('main.dashboard'))
 
@@ -199,24 +440,127 @@ def delete_project(project_id):
 @main.route('/projects/<int:project_id>/images', methods=['GET'])
 @login_required
 def get_images(project_id):
-    images = Image.query.filter_by(project_id=project_id).all()
-    images_data = [{'id': img.id, 'filename': img.filename} for img in images]
-    return jsonify(images_data), 200
+    project = Project.query.get_or_404(project_id)
+    try:
+        cursor, limit = page_args()
+        fields = selected_fields(IMAGE_FIELDS, ('id', 'filename'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    etag = listing_etag(f'project-{project_id}-{project_version(project_id)}')
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    images_data, next_cursor = keyset_page(IMAGE_FIELDS, fields, Image.project_id == project_id, cursor, limit)
+    return paged_response(images_data, next_cursor, etag)
 
 @main.route('/projects/<int:project_id>/analyze', methods=['GET'])
 @login_required
 def analyze_project(project_id):
     project = Project.query.get_or_404(project_id)
-    images = Image.query.filter_by(project_id=project_id).all()
-    analysis_results = {'total_images': len(images), 'details': []}
-    for image in images:
-        labels = Label.query.filter_by(image_id=image.id).all()
-        analysis_results['details'].append({
-            'image_id': image.id,
-            'filename': image.filename,
-            'labels': [label.label_data for label in labels]
-        })
-    return analysis_results
+    try:
+        cursor, limit = page_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    etag = listing_etag(f'project-{project_id}-{project_version(project_id)}')
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    analysis = analyze(project_id, cursor, limit)
+    return paged_response(analysis, analysis['next_cursor'], etag)
+
+def image_filenames(image_ids, chunk_size=500):
+    filenames = {}
+    for start in range(0, len(image_ids), chunk_size):
+        filenames.update(db.session.execute(
+            select(Image.id, Image.filename).where(Image.id.in_(image_ids[start:start + chunk_size]))).all())
+    return filenames
+
+@main.route('/projects/<int:project_id>/similar', methods=['GET', 'POST'])
+@login_required
+def similar_images(project_id):
+    # GET ranks the project's images against one of them (?image_id=); POST against an uploaded image
+    project = Project.query.get_or_404(project_id)
+    if project.user_id != current_user.id:
+        return jsonify({'error': 'You do not have permission to access this project'}), 403
+    k = request.args.get('k', 10, type=int)
+    if not 1 <= k <= 1000:
+        return jsonify({'error': 'k must be between 1 and 1000'}), 400
+    config = current_app.config
+    try:
+        if request.method == 'POST':
+            try:
+                payload = read_payload(request, allowed_file, config.get('INFERENCE_MAX_PAYLOAD_BYTES', 10 * 1024 * 1024))
+                pixels = payload.decode(INPUT_SIZE, config.get('INFERENCE_MAX_IMAGE_PIXELS', 40_000_000))
+            except PayloadError as e:
+                return jsonify({'error': str(e)}), e.status
+            matches = embedding_index.similar(project_id, k, pixels=pixels)
+        else:
+            image_id = request.args.get('image_id', type=int)
+            if image_id is None:
+                return jsonify({'error': 'image_id is required'}), 400
+            matches = embedding_index.similar(project_id, k, image_id=image_id)
+    except KeyError:
+        return jsonify({'error': 'Image not found in this project'}), 404
+    except Exception as e:
+        return jsonify({'error': f'Similarity search failed: {str(e)}'}), 500
+    filenames = image_filenames([image_id for image_id, _ in matches])
+    return jsonify({'results': [{'image_id': image_id, 'filename': filenames.get(image_id), 'score': score}
+                                for image_id, score in matches]}), 200
+
+@main.route('/projects/<int:project_id>/duplicates', methods=['GET'])
+@login_required
+def duplicate_images(project_id):
+    project = Project.query.get_or_404(project_id)
+    if project.user_id != current_user.id:
+        return jsonify({'error': 'You do not have permission to access this project'}), 403
+    threshold = request.args.get('threshold', current_app.config.get('EMBEDDING_DUPLICATE_THRESHOLD', 0.95), type=float)
+    if not 0 < threshold <= 1:
+        return jsonify({'error': 'threshold must be in (0, 1]'}), 400
+    try:
+        groups, indexed = embedding_index.duplicates(project_id, threshold)
+    except Exception as e:
+        return jsonify({'error': f'Duplicate search failed: {str(e)}'}), 500
+    filenames = image_filenames([image_id for group in groups for image_id in group])
+    return jsonify({
+        'threshold': threshold,
+        'images': indexed,
+        'duplicate_images': sum(len(group) - 1 for group in groups),
+        'groups': [[{'image_id': image_id, 'filename': filenames.get(image_id)} for image_id in group]
+                   for group in groups],
+    }), 200
+
+@main.route('/projects/<int:project_id>/labels/import', methods=['POST'])
+@login_required
+def import_project_labels(project_id):
+    project = Project.query.get_or_404(project_id)
+    if project.user_id != current_user.id:
+        return jsonify({'error': 'You do not have permission to access this project'}), 403
+    file = request.files.get('file')
+    if not file:
+        return jsonify({'error': 'No file provided'}), 400
+    label_format = request.form.get('format') or ('coco' if file.filename.lower().endswith('.json') else 'csv')
+    if label_format not in PARSERS:
+        return jsonify({'error': f'Unsupported format: {label_format}'}), 400
+
+    batch_size = current_app.config.get('LABEL_IMPORT_BATCH_SIZE', 5000)
+    options = {'max_bytes': current_app.config.get('LABEL_IMPORT_MAX_COCO_BYTES')} if label_format == 'coco' else {}
+    report = import_labels(project_id, PARSERS[label_format](file.stream, **options), batch_size=batch_size)
+    # Like an upload report: what was imported before a parse error stays, and the report says how much
+    return jsonify(report), 400 if 'error' in report else 200
+
+@main.route('/projects/<int:project_id>/labels/export', methods=['GET'])
+@login_required
+def export_project_labels(project_id):
+    project = Project.query.get_or_404(project_id)
+    if project.user_id != current_user.id:
+        return jsonify({'error': 'You do not have permission to access this project'}), 403
+    label_format = request.args.get('format', 'csv')
+    if label_format not in EXPORTERS:
+        return jsonify({'error': f'Unsupported format: {label_format}'}), 400
+    exporter, mimetype = EXPORTERS[label_format]
+    extension = 'json' if label_format == 'coco' else label_format
+    return Response(stream_with_context(exporter(project_id, request.args.get('class_name'))), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=project_{project_id}_labels.{extension}'})
 
 @main.route('/projects/<int:project_id>/configure_training', methods=['GET', 'POST'])
 @login_required
@@ -241,22 +585,36 @@ def start_iteration(project_id):
         iterations = Iteration.query.filter_by(project_id=project_id).all()
         return render_template('start_iteration.html', project=project, iterations=iterations)
     elif request.method == 'POST':
-        # Simulate starting a new training iteration
-        iteration = Iteration(project_id=project_id, status='running', result='')
-        db.session.add(iteration)
-        db.session.commit()
-        
-        iteration.status = 'completed'
-        iteration.result = 'Training completed successfully'
-        db.session.commit()
-        
-        return jsonify({'message': 'Iteration started and completed', 'iteration_id': iteration.id}), 201
+        # Training runs on the background job engine; poll get_iteration for progress
+        iteration = training_engine.enqueue(project_id, current_user.id)
+        return jsonify({'message': 'Iteration queued', 'iteration_id': iteration.id, 'status': iteration.status}), 202
 
 @main.route('/projects/<int:project_id>/iterations/<int:iteration_id>', methods=['GET'])
 @login_required
 def get_iteration(project_id, iteration_id):
     iteration = Iteration.query.get_or_404(iteration_id)
-    return jsonify({'iteration_id': iteration.id, 'status': iteration.status, 'result': iteration.result}), 200
+    return jsonify({
+        'iteration_id': iteration.id,
+        'status': iteration.status,
+        'result': iteration.result,
+        'progress': iteration.progress,
+        'metrics': json.loads(iteration.metrics) if iteration.metrics else {},
+        'cancel_requested': iteration.cancel_requested,
+        'created_at': iteration.created_at.isoformat() if iteration.created_at else None,
+        'started_at': iteration.started_at.isoformat() if iteration.started_at else None,
+        'finished_at': iteration.finished_at.isoformat() if iteration.finished_at else None,
+    }), 200
+
+@main.route('/projects/<int:project_id>/iterations/<int:iteration_id>/cancel', methods=['POST'])
+@login_required
+def cancel_iteration(project_id, iteration_id):
+    project = Project.query.get_or_404(project_id)
+    iteration = Iteration.query.get_or_404(iteration_id)
+    if iteration.project_id != project_id or project.user_id != current_user.id:
+        return jsonify({'error': 'You do not have permission to cancel this iteration'}), 403
+    training_engine.cancel(iteration)
+    return jsonify({'iteration_id': iteration.id, 'status': iteration.status,
+                    'cancel_requested': iteration.cancel_requested}), 200
 
 @main.route('/projects/<int:project_id>/deploy_model', methods=['POST', 'GET'])
 @login_required
@@ -267,17 +625,58 @@ def deploy_model(project_id):
         return render_template('deploy_model.html', project=project, iterations=iterations, default_model_id=-1)
     elif request.method == 'POST':
         model_choice = request.form.get('model_choice')
-        if model_choice == 'default':
-            model_to_deploy = default_model
-        else:
+        runtime = request.form.get('runtime', 'keras')
+        if runtime not in RUNTIMES:
+            flash(f'Unknown runtime: {runtime}')
+            return redirect(url_for('main.deploy_model', project_id=project_id))
+        selected_iteration = None
+        if model_choice != 'default':
             selected_iteration = Iteration.query.get_or_404(model_choice)
-            model_to_deploy = tf.keras.models.load_model(selected_iteration.model_path)
+            if not selected_iteration.model_path or not os.path.exists(selected_iteration.model_path):
+                flash('Selected iteration has no trained model to deploy.')
+                return redirect(url_for('main.deploy_model', project_id=project_id))
 
         api_key = 'api_' + str(datetime.datetime.utcnow().timestamp()).replace('.', '')
-        deployment = Deployment(project_id=project_id, iteration_id=(None if model_choice == 'default' else model_choice), api_key=api_key, active=True)
+        if needs_export(project_id, selected_iteration, runtime):
+            # Converting takes minutes, so a training worker does it; the current deployment keeps
+            # serving until the engine activates this one
+            db.session.add(Deployment(project_id=project_id, iteration_id=(None if model_choice == 'default' else model_choice),
+                                      api_key=api_key, active=False, runtime=runtime, status=PENDING))
+            db.session.commit()
+            training_engine.start()
+            flash(f'Converting the model to {runtime}. API Key: {api_key} starts serving once it is ready.')
+            return redirect(url_for('main.predict', project_id=project_id))
+        runtime_report = None
+        if runtime != 'keras':
+            keras_path = default_model_path(project_id) if selected_iteration is None else selected_iteration.model_path
+            runtime_report = load_report(artifact_path(keras_path, runtime))
+
+        # Only one deployment per project is active at a time; deactivating
+        # the previous ones also drops their models from the registry.
+        previous_keys = []
+        for previous in Deployment.query.filter_by(project_id=project_id, active=True).all():
+            previous.active = False
+            previous_keys.append(previous.api_key)
+
+        deployment = Deployment(project_id=project_id, iteration_id=(None if model_choice == 'default' else model_choice), api_key=api_key, active=True, runtime=runtime)
+        deployment.iteration = selected_iteration
+
+        # Load and warm the model now so the first prediction is fast; under serve.py only
+        # the inference processes hold models, so one of them is asked to do it
+        if inference_pool.enabled:
+            inference_pool.warm(deployment_artifact(deployment))
+        elif model_registry.get_for_deployment(deployment, warm=True) is None:
+            warm_default_model()
+
         db.session.add(deployment)
         db.session.commit()
+        # Again after the commit, in case a request re-cached an old key meanwhile
+        for key in previous_keys + [api_key]:
+            api_key_cache.pop(key)
         flash('Model deployed successfully. API Key: ' + api_key)
+        if runtime_report and 'top1_agreement' in runtime_report:
+            flash(f"{runtime}: top-1 agreement with Keras {runtime_report['top1_agreement']:.1%} on "
+                  f"{runtime_report['samples']} images, {runtime_report.get('throughput_ratio', 0):.2f}x throughput")
 
         return redirect(url_for('main.predict', project_id=project_id))
 
@@ -286,19 +685,78 @@ def run_inference():
     api_key = request.headers.get('API-Key')
     if not api_key:
         return jsonify({'error': 'API Key required'}), 401
-    deployment = Deployment.query.filter_by(api_key=api_key, active=True).first()
+    deployment = resolve_api_key(api_key)
+    if deployment == PENDING:
+        return pending_deployment_response()
     if not deployment:
         return jsonify({'error': 'Invalid API Key'}), 404
-    # Simulate inference process
-    image_data = request.files['image']
-    if image_data and allowed_file(image_data.filename):
-        filename = secure_filename(image_data.filename)
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-        image_data.save(filepath)
-
-        # Here you might perform some actual inference using the deployed model
-        return jsonify({'result': 'inference result'}), 200
-    return jsonify({'error': 'Invalid image format'}), 400
+    # The body is read and decoded in memory; nothing touches the disk unless persisting is enabled
+    try:
+        payload = read_payload(request, allowed_file, current_app.config.get('INFERENCE_MAX_PAYLOAD_BYTES',
+                                                                             10 * 1024 * 1024))
+    except PayloadError as e:
+        return jsonify({'error': str(e)}), e.status
+    with metrics.stage('cache'):
+        cache_key = (prediction_cache.digest(payload.data), deployment.model_version, preprocess_signature(INPUT_SIZE))
+        cached = prediction_cache.get(*cache_key)
+    if cached is not None:
+        return jsonify({'result': cached}), 200
+
+    if payload.is_image and current_app.config.get('INFERENCE_PERSIST_UPLOADS'):
+        storage.save_later(payload.data)
+    try:
+        with metrics.stage('decode'):
+            pixels = payload.decode(INPUT_SIZE, current_app.config.get('INFERENCE_MAX_IMAGE_PIXELS', 40_000_000))
+    except PayloadError as e:
+        return jsonify({'error': str(e)}), e.status
+    with metrics.stage('preprocess'):
+        x = preprocess_input(np.expand_dims(pixels, axis=0))
+
+    try:
+        with metrics.stage('predict'):
+            if inference_pool.enabled:
+                result = inference_pool.predict(deployment.artifact, x)[0]
+            else:
+                # Concurrent requests for the same deployment share one forward pass
+                batcher = inference_batchers.get(deployment.id, deployment.predict_fn)
+                predictions = batcher.predict(x, timeout=current_app.config.get('INFERENCE_TIMEOUT', 30))
+                result = format_predictions(predictions)[0]
+    except PoolBusy as e:
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = '1'
+        return response, 429
+    except Exception as e:
+        return jsonify({'error': f'Inference failed: {str(e)}'}), 500
+    prediction_cache.put(*cache_key, result)
+    return jsonify({'result': result}), 200
+
+@main.route('/inference/stats', methods=['GET'])
+def inference_stats():
+    api_key = request.headers.get('API-Key')
+    if not api_key:
+        return jsonify({'error': 'API Key required'}), 401
+    deployment = resolve_api_key(api_key)
+    if deployment == PENDING:
+        return pending_deployment_response()
+    if not deployment:
+        return jsonify({'error': 'Invalid API Key'}), 404
+    row = db.session.get(Deployment, deployment.id)
+    if row is None:
+        # Deleted through another worker, whose cache eviction this process never saw
+        api_key_cache.pop(api_key)
+        return jsonify({'error': 'Invalid API Key'}), 404
+    stats = inference_batchers.stats(deployment.id)
+    artifact = deployment_artifact(row)
+    runtime_report = load_report(artifact[1]) if artifact and artifact[1].endswith('.tflite') else None
+    return jsonify({'deployment_id': deployment.id, 'batching': stats, 'runtime_report': runtime_report,
+                    'inference_pool': inference_pool.stats(),
+                    'prediction_cache': prediction_cache.stats(), 'api_key_cache': api_key_cache.stats()}), 200
+
+@main.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    if not metrics.enabled:
+        return jsonify({'error': 'Metrics are disabled'}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @main.route('/images/<int:image_id>/delete', methods=['POST'])
 @login_required
@@ -309,8 +767,7 @@ def delete_image(image_id):
         flash("You do not have permission to delete this image.")
         return redirect(url_for('main.manage_project', project_id=project.id))
 
-    db.session.delete(image)
-    db.session.commit()
+    delete_images([image_id])
     flash('Image deleted successfully')
     return redirect(url_for('main.manage_project', project_id=project.id))
 
@@ -325,5 +782,6 @@ def delete_iteration(project_id, iteration_id):
 
     db.session.delete(iteration)
     db.session.commit()
+    forget_iteration(iteration_id)
     flash('Iteration deleted successfully')
     return redirect(url_for('main.manage_project', project_id=project_id))
@@ -0,0 +1,231 @@
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import select, func
+
+from model_registry import ModelRegistry
+
+RUNTIMES = ('keras', 'tflite-fp32', 'tflite-dynamic', 'tflite-int8')
+
+
+def model_folder():
+    return current_app.config.get('MODEL_FOLDER') or os.path.join(current_app.instance_path, 'models')
+
+
+def default_model_path(project_id):
+    # Never written itself; conversions of the default model are calibrated per project
+    return os.path.join(model_folder(), f'project_{project_id}_default_mobilenet_v2.keras')
+
+
+def artifact_path(keras_path, runtime):
+    """Where the ``runtime`` conversion of the Keras artifact at ``keras_path`` is stored."""
+    if runtime == 'keras':
+        return keras_path
+    return f'{os.path.splitext(keras_path)[0]}.{runtime}.tflite'
+
+
+def report_path(path):
+    return path + '.json'
+
+
+def deployment_key(deployment):
+    """Model registry key of what a deployment serves, or None for the in-process default Keras model."""
+    runtime = deployment.runtime or 'keras'
+    if deployment.iteration_id:
+        return ModelRegistry.iteration_key(deployment.iteration_id, runtime)
+    return None if runtime == 'keras' else ModelRegistry.default_key(deployment.project_id, runtime)
+
+
+def deployment_artifact(deployment):
+    """``(registry key, path)`` served by a deployment, or None for the in-process default Keras model."""
+    key = deployment_key(deployment)
+    if key is None:
+        return None
+    runtime = deployment.runtime or 'keras'
+    if deployment.iteration_id:
+        keras_path = deployment.iteration.model_path if deployment.iteration else None
+        if not keras_path:
+            return None
+    else:
+        keras_path = default_model_path(deployment.project_id)
+    return key, artifact_path(keras_path, runtime)
+
+
+class TFLiteModel:
+    """Keras-style ``predict()`` over a TFLite interpreter.
+
+    The interpreter is not thread-safe, so calls are serialised; the input
+    tensor is only reallocated when the batch size changes.
+    """
+
+    def __init__(self, path, num_threads=None):
+        import tensorflow as tf
+        self.path = path
+        self._interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads or os.cpu_count())
+        self._input = self._interpreter.get_input_details()[0]['index']
+        self._output = self._interpreter.get_output_details()[0]['index']
+        shape = self._interpreter.get_input_details()[0]['shape']
+        self.input_shape = (None,) + tuple(int(dim) for dim in shape[1:])
+        self._batch_size = None
+        self._lock = threading.Lock()
+
+    def predict(self, x, verbose=0):
+        x = np.asarray(x, dtype=np.float32)
+        with self._lock:
+            if x.shape[0] != self._batch_size:
+                self._interpreter.resize_tensor_input(self._input, x.shape)
+                self._interpreter.allocate_tensors()
+                self._batch_size = x.shape[0]
+            self._interpreter.set_tensor(self._input, x)
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output).copy()
+
+
+def convert(model, runtime, calibration=None):
+    """TFLite flatbuffer bytes for a Keras model.
+
+    ``tflite-dynamic`` quantizes weights only; ``tflite-int8`` quantizes
+    weights and activations using ``calibration`` (preprocessed inputs) to
+    pick activation ranges, keeping float input and output tensors.
+    """
+    import tensorflow as tf
+
+    if runtime == 'tflite-int8' and (calibration is None or not len(calibration)):
+        raise ValueError('Full-integer quantization needs a calibration set')
+    export_dir = tempfile.mkdtemp()
+    try:
+        # Keras 3 models only convert reliably through a SavedModel export
+        model.export(export_dir, verbose=False)
+        converter = tf.lite.TFLiteConverter.from_saved_model(export_dir)
+        if runtime in ('tflite-dynamic', 'tflite-int8'):
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if runtime == 'tflite-int8':
+            converter.representative_dataset = lambda: ([calibration[i:i + 1]] for i in range(len(calibration)))
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        return converter.convert()
+    finally:
+        shutil.rmtree(export_dir, ignore_errors=True)
+
+
+def calibration_set(project_id, size, target_size):
+    """Preprocessed inputs for up to ``size`` images sampled at random from a project."""
+    from batch_predict import decode_image
+    from models import db, Image
+
+    rows = db.session.execute(
+        select(Image.id, Image.filename, Image.digest)
+        .where(Image.project_id == project_id).order_by(func.random()).limit(size)
+    ).all()
+    samples = []
+    for row in rows:
+        try:
+            samples.append(decode_image(project_id, row, target_size))
+        except Exception as e:
+            current_app.logger.warning('Skipping image %s in calibration set: %s', row.id, e)
+    if not samples:
+        return np.zeros((0,) + tuple(target_size) + (3,), dtype=np.float32)
+    return np.stack(samples).astype(np.float32)
+
+
+def compare(reference, candidate, samples, batch_size=32, single_runs=20):
+    """Top-1 agreement of ``candidate`` with ``reference`` plus latency and throughput of both."""
+    report = {'samples': int(len(samples))}
+    predictions = {}
+    for name, model in (('keras', reference), ('tflite', candidate)):
+        model.predict(samples[:1], verbose=0)
+        single = []
+        for i in range(min(single_runs, len(samples))):
+            started = time.perf_counter()
+            model.predict(samples[i:i + 1], verbose=0)
+            single.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        predictions[name] = np.concatenate([np.asarray(model.predict(samples[i:i + batch_size], verbose=0))
+                                            for i in range(0, len(samples), batch_size)])
+        elapsed = time.perf_counter() - started
+        report[name] = {
+            'latency_ms_p50': statistics.median(single),
+            'images_per_sec': len(samples) / elapsed if elapsed else 0.0,
+        }
+    report['top1_agreement'] = float(np.mean(predictions['keras'].argmax(axis=-1)
+                                             == predictions['tflite'].argmax(axis=-1)))
+    if report['tflite']['images_per_sec'] and report['keras']['images_per_sec']:
+        report['throughput_ratio'] = report['tflite']['images_per_sec'] / report['keras']['images_per_sec']
+    return report
+
+
+def export(keras_model, keras_path, runtime, project_id, calibration_size=100):
+    """Convert ``keras_model`` to ``runtime`` next to ``keras_path`` and return ``(path, report)``.
+
+    The report, written beside the artifact as JSON, compares the converted
+    model with the Keras one on images sampled from the project.
+    """
+    from ml import model_input_size
+
+    if runtime not in RUNTIMES or runtime == 'keras':
+        raise ValueError(f'Unknown TFLite runtime: {runtime}')
+    path = artifact_path(keras_path, runtime)
+    samples = calibration_set(project_id, calibration_size, model_input_size(keras_model))
+    data = convert(keras_model, runtime, samples)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+    report = {'runtime': runtime, 'size_bytes': len(data), 'exported_at': time.time()}
+    if len(samples):
+        report.update(compare(keras_model, TFLiteModel(path), samples))
+    with open(report_path(path), 'w') as f:
+        json.dump(report, f, indent=2)
+    return path, report
+
+
+def needs_export(project_id, iteration, runtime):
+    """True when deploying ``runtime`` would first have to convert the model."""
+    if runtime == 'keras':
+        return False
+    keras_path = default_model_path(project_id) if iteration is None else iteration.model_path
+    return is_stale(artifact_path(keras_path, runtime), keras_path)
+
+
+def ensure_exported(project_id, iteration, runtime, calibration_size=100, force=False):
+    """``(path, report)`` of ``runtime`` for an iteration, or the default model when it is None.
+
+    Converts only when the artifact is missing or older than its Keras model.
+    This takes minutes for MobileNetV2, so requests leave it to the training
+    engine (see jobs.run_export) or ``flask models export``.
+    """
+    from extensions import model_registry
+    from ml import get_default_model
+
+    keras_path = default_model_path(project_id) if iteration is None else iteration.model_path
+    path = artifact_path(keras_path, runtime)
+    if not force and not is_stale(path, keras_path):
+        return path, load_report(path)
+    keras_model = get_default_model() if iteration is None else model_registry.get_for_iteration(iteration)
+    if keras_model is None:
+        raise ValueError(f'Iteration {iteration.id} has no trained model')
+    return export(keras_model, keras_path, runtime, project_id, calibration_size)
+
+
+def load_report(path):
+    try:
+        with open(report_path(path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_stale(path, keras_path):
+    # Converted artifacts are rebuilt once the Keras model they came from changes
+    if not os.path.exists(path):
+        return True
+    return os.path.exists(keras_path) and os.path.getmtime(keras_path) > os.path.getmtime(path)
@@ -0,0 +1,178 @@
+"""Production launcher: web worker processes in front of a shared inference pool.
+
+    python serve.py
+
+Web workers are forked after the listening socket is bound and serve HTTP
+with threads; predictions and deployment warm-up go to the inference
+processes, so web workers never hold a deployed model (the similarity and
+duplicate endpoints still run the embedding backbone in-process).
+Inference processes are spawned fresh (TensorFlow is not fork-safe), own
+every deployed model and receive tensors through shared memory, so HTTP
+concurrency (SERVE_WEB_WORKERS) and model memory (SERVE_INFERENCE_WORKERS)
+scale independently. One forked background process dispatches training
+and export jobs and runs the periodic garbage collection sweeps; web
+workers only queue work for it. SIGTERM or SIGINT drains in-flight
+requests before exiting.
+"""
+import logging
+import multiprocessing
+import signal
+import socket
+import sys
+import threading
+
+from werkzeug.wsgi import ClosingIterator
+
+from config import ProductionConfig
+from inference_pool import create_channels, run_inference_process
+
+logger = logging.getLogger('serve')
+
+
+class InFlightTracker:
+    """WSGI middleware counting requests whose response has not been closed yet."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.count = 0
+        self._condition = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        with self._condition:
+            self.count += 1
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self._done()
+            raise
+        return ClosingIterator(iterable, self._done)
+
+    def wait_idle(self, timeout):
+        with self._condition:
+            return self._condition.wait_for(lambda: self.count == 0, timeout)
+
+    def _done(self):
+        with self._condition:
+            self.count -= 1
+            self._condition.notify_all()
+
+
+def run_web_worker(index, sock, channels, config_class):
+    from werkzeug.serving import make_server
+    from app import create_app
+    from extensions import inference_pool
+
+    # Ctrl-C reaches the whole process group; the launcher decides when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    app = create_app(config_class)
+    config = app.config
+    inference_pool.connect(channels, index)
+    tracker = InFlightTracker(app.wsgi_app)
+    app.wsgi_app = tracker
+    server = make_server(config['SERVE_HOST'], config['SERVE_PORT'], app, threaded=True, fd=sock.fileno())
+    # shutdown() blocks until serve_forever() returns, so it cannot run in the handler itself
+    signal.signal(signal.SIGTERM, lambda *args: threading.Thread(target=server.shutdown, daemon=True).start())
+    server.serve_forever()
+
+    if not tracker.wait_idle(config['SERVE_DRAIN_TIMEOUT']):
+        app.logger.warning('Web worker %s exiting with %s requests in flight', index, tracker.count)
+    inference_pool.close()
+
+
+def run_background_process(config_class):
+    from app import create_app
+    from jobs import training_engine
+    from garbage import garbage_collector
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stopping.set())
+    app = create_app(config_class)
+    # Polls the queue even when nothing was pending at startup
+    training_engine.start()
+    if app.config.get('GC_INTERVAL', 3600) > 0:
+        garbage_collector.start(sweep=True)
+    while not stopping.wait(1):
+        pass
+    # Running jobs are left to the heartbeat check of the next launch
+    training_engine.shutdown(wait=False)
+    garbage_collector.shutdown()
+
+
+def inference_settings(config_class):
+    return {
+        'max_models': config_class.MODEL_REGISTRY_MAX_MODELS,
+        'max_bytes': config_class.MODEL_REGISTRY_MAX_BYTES,
+        'max_batch_size': config_class.INFERENCE_MAX_BATCH_SIZE,
+        'max_wait_ms': config_class.INFERENCE_MAX_WAIT_MS,
+        'warm_default_model': config_class.EAGER_MODEL_WARMUP,
+    }
+
+
+def serve(config_class=ProductionConfig):
+    settings = inference_settings(config_class)
+    # Web workers must not build the default model; the inference processes warm it. Training,
+    # exports and sweeps run once, in the background process, not in every web worker.
+    web_config = type('WebWorkerConfig', (config_class,), {'EAGER_MODEL_WARMUP': False, 'TRAINING_DISPATCH': False})
+    background_config = type('BackgroundConfig', (config_class,), {'EAGER_MODEL_WARMUP': False})
+
+    sock = socket.create_server((config_class.SERVE_HOST, config_class.SERVE_PORT), backlog=1024)
+    spawn = multiprocessing.get_context('spawn')
+    fork = multiprocessing.get_context('fork')
+    web_workers = config_class.SERVE_WEB_WORKERS
+    shm, channels = create_channels(spawn, web_workers, config_class.SERVE_QUEUE_SLOTS, config_class.SERVE_SLOT_BYTES)
+
+    inference = [spawn.Process(target=run_inference_process, args=(channels, settings), name=f'inference-{i}')
+                 for i in range(config_class.SERVE_INFERENCE_WORKERS)]
+    for process in inference:
+        process.start()
+    web = [fork.Process(target=run_web_worker, args=(i, sock, channels, web_config), name=f'web-{i}')
+           for i in range(web_workers)]
+    for process in web:
+        process.start()
+    sock.close()
+    background = fork.Process(target=run_background_process, args=(background_config,), name='background')
+    background.start()
+    logger.info('Serving on %s:%s with %s web and %s inference workers', config_class.SERVE_HOST,
+                config_class.SERVE_PORT, len(web), len(inference))
+
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stopping.set())
+    failed = None
+    while not stopping.wait(1):
+        # A dead worker may hold slots forever, so fail fast and let the supervisor restart us
+        failed = next((p for p in web + inference + [background] if not p.is_alive()), None)
+        if failed is not None:
+            logger.error('%s exited with code %s; shutting down', failed.name, failed.exitcode)
+            break
+
+    drain_timeout = config_class.SERVE_DRAIN_TIMEOUT
+    for process in web:
+        if process.is_alive():
+            process.terminate()
+    _join(web, drain_timeout + 5)
+    if background.is_alive():
+        background.terminate()
+    _join([background], drain_timeout)
+    # Web workers are gone, so nothing new can be queued behind these sentinels
+    for _ in inference:
+        channels.requests.put(None)
+    _join(inference, drain_timeout)
+    shm.close()
+    shm.unlink()
+    return 1 if failed is not None else 0
+
+
+def _join(processes, timeout):
+    for process in processes:
+        process.join(timeout)
+        if process.is_alive():
+            logger.warning('%s did not stop within %ss; killing it', process.name, timeout)
+            process.kill()
+            process.join()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+    sys.exit(serve())
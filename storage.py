@@ -0,0 +1,208 @@
+import abc
+import contextlib
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Default blob folder inside UPLOAD_FOLDER, apart from flat files dropped there
+BLOB_DIR = 'blobs'
+# Persisted /inference uploads have no image row, so they live apart from image blobs
+INFERENCE_DIR = 'inference'
+
+
+def storage_root(config):
+    """Folder holding image blobs for ``config``."""
+    return config.get('STORAGE_FOLDER') or os.path.join(config['UPLOAD_FOLDER'], BLOB_DIR)
+
+
+class StorageBackend(abc.ABC):
+    """Interface for content-addressed blob storage.
+
+    Blobs are identified by the hex SHA-256 digest of their bytes, so saving
+    the same content twice stores it once.
+    """
+
+    @abc.abstractmethod
+    def save_stream(self, stream):
+        """Store ``stream`` and return ``(digest, size, created)``."""
+
+    @abc.abstractmethod
+    def open(self, digest):
+        """Binary file object for reading the blob."""
+
+    @abc.abstractmethod
+    def exists(self, digest):
+        """True if a blob with this digest is stored."""
+
+    @abc.abstractmethod
+    def delete(self, digest):
+        """Remove the blob; returns False if it did not exist."""
+
+    @abc.abstractmethod
+    def iter_digests(self):
+        """Yield the digest of every stored blob."""
+
+    def local_path(self, digest):
+        """Filesystem path of the blob, or None if the backend is not local."""
+        return None
+
+
+class LocalStorage(StorageBackend):
+    """Blobs under ``root/ab/cd/<sha256>``.
+
+    Two levels of 256-way sharding keep directories small even with millions
+    of files. Uploads are hashed while they are streamed to a temporary file
+    in the same filesystem, then renamed into place atomically.
+    """
+
+    def __init__(self, root, chunk_size=1024 * 1024):
+        self.root = root
+        self.chunk_size = chunk_size
+
+    def local_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def save_stream(self, stream):
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        hasher = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in iter(lambda: stream.read(self.chunk_size), b''):
+                    hasher.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+            digest = hasher.hexdigest()
+            path = self.local_path(digest)
+            if os.path.exists(path):
+                os.unlink(tmp_path)
+                # A fresh mtime keeps the garbage collector's grace period covering re-uploads too
+                os.utime(path)
+                return digest, size, False
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+            return digest, size, True
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def open(self, digest):
+        return open(self.local_path(digest), 'rb')
+
+    def exists(self, digest):
+        return os.path.exists(self.local_path(digest))
+
+    def delete(self, digest):
+        try:
+            os.unlink(self.local_path(digest))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def iter_digests(self):
+        for first in _hex_dirs(self.root, 2):
+            for second in _hex_dirs(os.path.join(self.root, first), 2):
+                directory = os.path.join(self.root, first, second)
+                for name in os.listdir(directory):
+                    if len(name) == 64 and name.startswith(first + second):
+                        yield name
+
+
+BACKENDS = {
+    'local': LocalStorage,
+}
+
+
+class Storage:
+    """Flask extension exposing the configured StorageBackend.
+
+    Persisted /inference uploads go to a second backend rooted at
+    ``<root>/inference``, so every blob in the main one belongs to an image.
+    """
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.inference_backend = None
+        self.upload_folder = None
+        self.async_workers = 2
+        self.async_max_pending = 256
+        self._executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config.get('STORAGE_BACKEND', 'local')
+        self.upload_folder = app.config['UPLOAD_FOLDER']
+        root = storage_root(app.config)
+        backend_class = BACKENDS[backend] if isinstance(backend, str) else backend
+        self.backend = backend_class(root)
+        self.inference_backend = backend_class(os.path.join(root, INFERENCE_DIR))
+        self.async_workers = app.config.get('STORAGE_ASYNC_WORKERS', self.async_workers)
+        self.async_max_pending = app.config.get('STORAGE_ASYNC_MAX_PENDING', self.async_max_pending)
+        app.extensions['storage'] = self
+
+    def save_later(self, data):
+        """Store ``data`` on a background thread; returns False (and drops it) when too many saves are pending.
+
+        Only /inference uploads are saved this way, into the inference backend.
+        """
+        backend = self.inference_backend
+        with self._lock:
+            if self._pending >= self.async_max_pending:
+                return False
+            self._pending += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.async_workers, thread_name_prefix='storage')
+        self._executor.submit(self._save, backend, data)
+        return True
+
+    def _save(self, backend, data):
+        try:
+            backend.save_stream(io.BytesIO(data))
+        except Exception:
+            logger.exception('Background save failed')
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    @contextlib.contextmanager
+    def image_source(self, image):
+        """Context manager giving the path (or, for non-local backends, an open file) of an Image's content.
+
+        Rows written before content addressing have no digest and still live
+        flat in the upload folder under their filename. A file opened here is
+        closed when the block exits.
+        """
+        if not image.digest:
+            yield os.path.join(self.upload_folder, image.filename)
+            return
+        path = self.backend.local_path(image.digest)
+        if path is not None:
+            yield path
+            return
+        with self.backend.open(image.digest) as f:
+            yield f
+
+    def __getattr__(self, name):
+        backend = self.__dict__.get('backend')
+        if backend is None:
+            raise RuntimeError('Storage is not initialised; call init_app() first')
+        return getattr(backend, name)
+
+
+def _hex_dirs(path, length):
+    if not os.path.isdir(path):
+        return []
+    return sorted(name for name in os.listdir(path)
+                  if len(name) == length and all(c in '0123456789abcdef' for c in name))
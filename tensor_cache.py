@@ -0,0 +1,223 @@
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+SLOTS_FILE = 'slots.bin'
+SLOT_BYTES = 8
+
+
+class TensorCache:
+    """Decoded, resized uint8 image tensors kept in memory-mapped .npy shards.
+
+    Each project has one directory per input size (e.g. ``224x224``) holding
+    fixed-capacity shards. Images get consecutive slots within their project,
+    recorded in an append-only ``slots.bin`` of int64 image ids, so a
+    project's tensors fill its shards densely whatever the global ids are.
+    Reads are zero-copy views into the mapped file, and a boolean mask file
+    next to each shard records which slots are filled. At most
+    ``max_open_shards`` shard maps are kept open, least recently used first
+    out.
+    """
+
+    def __init__(self, app=None, root=None, shard_size=1024, max_open_shards=64):
+        self.root = root
+        self.shard_size = shard_size
+        self.max_open_shards = max_open_shards
+        self._shards = OrderedDict()
+        self._slots = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.root = app.config.get('TENSOR_CACHE_FOLDER') or os.path.join(app.instance_path, 'tensor_cache')
+        self.shard_size = app.config.get('TENSOR_CACHE_SHARD_SIZE', self.shard_size)
+        self.max_open_shards = app.config.get('TENSOR_CACHE_MAX_OPEN_SHARDS', self.max_open_shards)
+        self._shards = OrderedDict()
+        self._slots = OrderedDict()
+        app.extensions['tensor_cache'] = self
+
+    def get(self, project_id, image_id, size):
+        slot = self._slot(project_id, size, image_id)
+        if slot is None:
+            return None
+        shard = self._shard(project_id, size, slot // self.shard_size, create=False)
+        if shard is None:
+            return None
+        data, mask = shard
+        slot %= self.shard_size
+        return data[slot] if mask[slot] else None
+
+    def put(self, project_id, image_id, pixels, size):
+        pixels = np.asarray(pixels)
+        if pixels.shape != (size[0], size[1], 3):
+            raise ValueError(f'Expected a {size[0]}x{size[1]}x3 tensor, got {pixels.shape}')
+        slot = self._slot(project_id, size, image_id)
+        if slot is None:
+            slot = self._allocate(project_id, size, image_id)
+        data, mask = self._shard(project_id, size, slot // self.shard_size, create=True)
+        slot %= self.shard_size
+        data[slot] = pixels
+        mask[slot] = True
+
+    def contains(self, project_id, image_id, size):
+        return self.get(project_id, image_id, size) is not None
+
+    def invalidate(self, project_id, image_id):
+        # Clear the slot for every input size the project has been cached at
+        for size in self.sizes(project_id):
+            slot = self._slot(project_id, size, image_id)
+            if slot is None:
+                continue
+            shard = self._shard(project_id, size, slot // self.shard_size, create=False)
+            if shard is not None:
+                shard[1][slot % self.shard_size] = False
+
+    def sizes(self, project_id):
+        project_dir = self._project_dir(project_id)
+        if not os.path.isdir(project_dir):
+            return []
+        sizes = []
+        for name in os.listdir(project_dir):
+            height, _, width = name.partition('x')
+            if height.isdigit() and width.isdigit():
+                sizes.append((int(height), int(width)))
+        return sizes
+
+    def prune_sizes(self, project_id, keep):
+        """Remove shards built for any input size other than ``keep``."""
+        removed = []
+        for size in self.sizes(project_id):
+            if tuple(size) != tuple(keep):
+                self._drop(project_id, size)
+                removed.append(size)
+        return removed
+
+    def drop_project(self, project_id):
+        for size in self.sizes(project_id):
+            self._drop(project_id, size)
+        shutil.rmtree(self._project_dir(project_id), ignore_errors=True)
+
+    def forget(self, project_id):
+        # Closes the project's open shard maps without touching the files
+        with self._lock:
+            for cache in (self._shards, self._slots):
+                for key in [k for k in cache if k[0] == project_id]:
+                    del cache[key]
+
+    def _project_dir(self, project_id):
+        return os.path.join(self.root, str(project_id))
+
+    def _size_dir(self, project_id, size):
+        return os.path.join(self._project_dir(project_id), f'{size[0]}x{size[1]}')
+
+    def _drop(self, project_id, size):
+        with self._lock:
+            self._slots.pop((project_id, tuple(size)), None)
+            for key in [k for k in self._shards if k[:2] == (project_id, tuple(size))]:
+                del self._shards[key]
+        shutil.rmtree(self._size_dir(project_id, size), ignore_errors=True)
+
+    def _slot(self, project_id, size, image_id):
+        key = (project_id, tuple(size))
+        with self._lock:
+            slots = self._slots.get(key)
+            if slots is None:
+                slots = self._slots[key] = [{}, 0]
+            self._slots.move_to_end(key)
+            self._evict(self._slots)
+            slot = slots[0].get(image_id)
+            if slot is None:
+                # Other processes may have appended since the file was last read
+                self._read_slots(project_id, size, slots)
+                slot = slots[0].get(image_id)
+            return slot
+
+    def _allocate(self, project_id, size, image_id):
+        size_dir = self._size_dir(project_id, size)
+        os.makedirs(size_dir, exist_ok=True)
+        # An O_APPEND write is atomic, so concurrent processes never get the same slot
+        fd = os.open(os.path.join(size_dir, SLOTS_FILE), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, np.int64(image_id).tobytes())
+            slot = os.lseek(fd, 0, os.SEEK_CUR) // SLOT_BYTES - 1
+        finally:
+            os.close(fd)
+        with self._lock:
+            slots = self._slots.get((project_id, tuple(size)))
+            if slots is not None:
+                slots[0][image_id] = slot
+        return slot
+
+    def _read_slots(self, project_id, size, slots):
+        size_dir = self._size_dir(project_id, size)
+        path = os.path.join(size_dir, SLOTS_FILE)
+        if not os.path.exists(path):
+            _remove_id_indexed_shards(size_dir)
+            return
+        with open(path, 'rb') as f:
+            f.seek(slots[1])
+            data = f.read()
+        data = data[:len(data) - len(data) % SLOT_BYTES]
+        first = slots[1] // SLOT_BYTES
+        # Later records win, matching what a re-put in another process would see
+        for offset, image_id in enumerate(np.frombuffer(data, dtype=np.int64).tolist()):
+            slots[0][image_id] = first + offset
+        slots[1] += len(data)
+
+    def _evict(self, cache):
+        while len(cache) > self.max_open_shards:
+            cache.popitem(last=False)
+
+    def _shard(self, project_id, size, index, create):
+        key = (project_id, tuple(size), index)
+        with self._lock:
+            shard = self._shards.get(key)
+            if shard is not None:
+                self._shards.move_to_end(key)
+                return shard
+            size_dir = self._size_dir(project_id, size)
+            data_path = os.path.join(size_dir, f'shard_{index:06d}.npy')
+            mask_path = os.path.join(size_dir, f'shard_{index:06d}.mask.npy')
+            if os.path.exists(data_path) and os.path.exists(mask_path):
+                data = np.load(data_path, mmap_mode='r+')
+                mask = np.load(mask_path, mmap_mode='r+')
+            elif create:
+                os.makedirs(size_dir, exist_ok=True)
+                data = _create_shard_file(data_path, np.uint8, (self.shard_size, size[0], size[1], 3))
+                mask = _create_shard_file(mask_path, np.bool_, (self.shard_size,))
+            else:
+                return None
+            self._shards[key] = (data, mask)
+            # Views already handed out keep their map alive after eviction
+            self._evict(self._shards)
+            return data, mask
+
+
+def _create_shard_file(path, dtype, shape):
+    # Other processes share the cache root: the file is built under a temporary name and
+    # linked into place, so one another process created first is opened, never truncated
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    try:
+        # open_memmap only writes the header, so unfilled slots stay sparse on disk
+        array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+        array.flush()
+        del array
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+    finally:
+        os.unlink(tmp_path)
+    return np.load(path, mmap_mode='r+')
+
+
+def _remove_id_indexed_shards(size_dir):
+    # Shards written before slots.bin existed were indexed by global image id
+    if os.path.isdir(size_dir) and any(name.startswith('shard_') for name in os.listdir(size_dir)):
+        shutil.rmtree(size_dir, ignore_errors=True)
@@ -1,12 +1,39 @@
 # test_app.py
+import base64
+import datetime
+import io
 import os
+import time
+import json
+import multiprocessing
 import tempfile
+import threading
+import tarfile
+import zipfile
 import pytest
+import numpy as np
 from flask import template_rendered
 from contextlib import contextmanager
 from werkzeug.security import generate_password_hash
 from app import create_app
-from models import db, User, Project, Image
+import ml
+from models import db, User, Project, Image, Label, Iteration, Deployment
+from extensions import model_registry, inference_batchers, inference_pool, embedding_index, api_key_cache
+from inference_pool import create_channels, serve_inference
+from runtimes import deployment_artifact
+from tensor_cache import TensorCache, _create_shard_file
+from feature_store import FeatureStore
+from ttl_cache import TTLCache
+from sqlalchemy import event as sa_event
+from prediction_cache import PredictionCache
+from storage import LocalStorage, Storage
+from jobs import training_engine
+from PIL import Image as PILImage
+from analytics import analyze, project_summaries
+from model_registry import ModelRegistry
+from batching import MicroBatcher
+from benchmarks.seed import seed_database
+from benchmarks.run import run_load, compare
 
 @pytest.fixture
 def client():
@@ -15,6 +42,8 @@ def client():
         'TESTING': True,
         'SQLALCHEMY_DATABASE_URI': f'sqlite:///{db_path}',
         'UPLOAD_FOLDER': tempfile.mkdtemp(),
+        'TENSOR_CACHE_FOLDER': tempfile.mkdtemp(),
+        'FEATURE_STORE_FOLDER': tempfile.mkdtemp(),
     })
 
     with app.test_client() as client:
@@ -95,3 +124,835 @@ def test_project_creation(client, auth):
     }, follow_redirects=True)
     assert b'Error: Name is required' in response.data 
 
+def test_ready_before_default_model_loaded(client):
+    # The default model is built lazily, so a fresh app is not ready yet
+    response = client.get('/ready')
+    assert response.status_code == 503
+    assert response.get_json() == {'ready': False, 'default_model': 'not_loaded'}
+
+def test_ready_after_lazy_default_model_load(client, monkeypatch):
+    monkeypatch.setattr(ml, '_build_default_model', FakeModel)
+    monkeypatch.setattr(ml, '_default_model', None)
+    monkeypatch.setattr(ml, '_default_model_ready', threading.Event())
+    monkeypatch.setattr(ml, '_warmup_thread', None)
+    model = ml.get_default_model()
+    ml._warmup_thread.join(timeout=10)
+    assert model.calls == 1
+    assert client.get('/ready').get_json() == {'ready': True, 'default_model': 'ready'}
+
+def test_project_stats_track_inserts_and_deletes(client):
+    with client.application.app_context():
+        project = Project(name='p', project_type='classification')
+        db.session.add(project)
+        db.session.commit()
+        cat = Image(filename='cat.png', project_id=project.id)
+        dog = Image(filename='dog.png', project_id=project.id)
+        db.session.add_all([cat, dog])
+        db.session.commit()
+        db.session.add_all([Label(image_id=cat.id, label_data='cat'), Label(image_id=dog.id, label_data='dog'),
+                            Label(image_id=dog.id, label_data='animal')])
+        db.session.commit()
+
+        summary = project_summaries([project.id])[project.id]
+        assert summary == {'total_images': 2, 'total_labels': 3,
+                           'label_distribution': {'cat': 1, 'dog': 1, 'animal': 1}}
+        analysis = analyze(project.id)
+        assert [d['labels'] for d in analysis['details']] == [['cat'], ['dog', 'animal']]
+
+        Label.query.filter_by(class_name='animal').one().class_name = 'cat'
+        db.session.commit()
+        summary = project_summaries([project.id])[project.id]
+        assert summary['label_distribution'] == {'cat': 2, 'dog': 1}
+
+        db.session.delete(dog)
+        db.session.commit()
+        summary = project_summaries([project.id])[project.id]
+        assert summary == {'total_images': 1, 'total_labels': 1, 'label_distribution': {'cat': 1}}
+
+class FakeModel:
+    input_shape = (None, 2)
+
+    def __init__(self):
+        self.calls = 0
+
+    def count_params(self):
+        return 10
+
+    def predict(self, x, verbose=0):
+        self.calls += 1
+        return x
+
+def test_model_registry_lru_eviction(tmp_path):
+    loads = []
+    registry = ModelRegistry(loader=lambda path: loads.append(path) or FakeModel())
+    registry.max_models = 2
+    paths = []
+    for name in ('a.h5', 'b.h5', 'c.h5'):
+        path = tmp_path / name
+        path.write_bytes(b'x')
+        paths.append(str(path))
+
+    first = registry.get('a', paths[0], warm=True)
+    assert first.calls == 1
+    assert registry.get('a', paths[0]) is first
+    registry.get('b', paths[1])
+    registry.get('c', paths[2])
+    assert 'a' not in registry and 'b' in registry and 'c' in registry
+    assert registry.stats()['evictions'] == 1
+
+    # Rewriting the artifact invalidates the resident copy
+    os.utime(paths[2], (0, 0))
+    registry.get('c', paths[2])
+    assert loads.count(paths[2]) == 2
+
+    registry.invalidate('b')
+    assert 'b' not in registry
+
+def test_micro_batcher_merges_concurrent_requests():
+    calls = []
+    def predict_fn(x):
+        calls.append(len(x))
+        return x * 2
+
+    batcher = MicroBatcher(predict_fn, max_batch_size=8, max_wait_ms=200)
+    futures = [batcher.submit(np.full((1, 2), i, dtype='float32')) for i in range(4)]
+    results = [f.result(timeout=5) for f in futures]
+    batcher.close()
+
+    assert calls == [4]
+    assert [r[0, 0] for r in results] == [0, 2, 4, 6]
+    stats = batcher.stats()
+    assert stats['batch_size_histogram'] == {'4': 1}
+    assert stats['requests'] == 4
+    with pytest.raises(RuntimeError):
+        batcher.submit(np.zeros((1, 2), dtype='float32'))
+
+class FakeClassifier:
+    input_shape = (None, 224, 224, 3)
+
+    def predict(self, x, verbose=0):
+        # Three "classes" scored by mean channel intensity
+        return x.mean(axis=(1, 2))
+
+@pytest.fixture
+def deployed_project(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(model_registry, 'loader', lambda path: FakeClassifier())
+    app = client.application
+    model_path = tmp_path / 'model.h5'
+    model_path.write_bytes(b'weights')
+    with app.app_context():
+        user = User(username='owner')
+        user.set_password('pw')
+        project = Project(name='p', project_type='classification', user=user)
+        db.session.add(project)
+        db.session.commit()
+        for i, color in enumerate([(255, 0, 0), (0, 255, 0), (0, 0, 255)]):
+            filename = f'img_{i}.png'
+            PILImage.new('RGB', (32, 32), color).save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            db.session.add(Image(filename=filename, project_id=project.id))
+        db.session.add(Image(filename='missing.png', project_id=project.id))
+        iteration = Iteration(project_id=project.id, status='completed', model_path=str(model_path))
+        db.session.add(iteration)
+        db.session.commit()
+        deployment = Deployment(project_id=project.id, iteration_id=iteration.id, api_key='api_test', active=True)
+        db.session.add(deployment)
+        db.session.commit()
+        project_id = project.id
+    login(client, 'owner', 'pw')
+    yield project_id
+    model_registry.clear()
+
+def test_predict_batch_streams_ndjson(client, deployed_project):
+    response = client.post(f'/projects/{deployed_project}/predict_batch',
+                           json={'persist': True, 'batch_size': 2})
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert lines[-1] == {'done': True, 'count': 4, 'errors': 1}
+    top = {line['filename']: line['predictions'][0]['label'] for line in lines[:-1] if 'predictions' in line}
+    assert top == {'img_0.png': 0, 'img_1.png': 1, 'img_2.png': 2}
+
+    with client.application.app_context():
+        assert sorted(label.label_data for label in Label.query.all()) == ['0', '1', '2']
+        assert {label.source for label in Label.query.all()} == {'prediction'}
+        image = Image.query.filter_by(filename='img_1.png').one()
+        cache = client.application.extensions['tensor_cache']
+        assert cache.get(deployed_project, image.id, (224, 224))[0, 0].tolist() == [0, 255, 0]
+
+    for params in ({'batch_size': 'x'}, {'batch_size': 0}, {'image_ids': 'a,b'}, {'image_ids': 5}):
+        assert client.post(f'/projects/{deployed_project}/predict_batch', json=params).status_code == 400
+
+def test_label_bulk_import_and_export(client, deployed_project):
+    csv_body = ('filename,class_name,x,y,width,height\n'
+                'img_0.png,cat,1,2,10,20\n'
+                'img_1.png,dog,,,,\n'
+                'nope.png,cat,,,,\n'
+                'img_2.png,,,,,\n')
+    response = client.post(f'/projects/{deployed_project}/labels/import', content_type='multipart/form-data',
+                           data={'file': (io.BytesIO(csv_body.encode()), 'labels.csv')})
+    report = response.get_json()
+    assert report['imported'] == 2 and report['skipped'] == 2
+    assert sorted(report['errors']) == ['line 4: image not found in project', 'line 5: missing class_name']
+
+    coco = {'images': [{'id': 7, 'file_name': 'img_2.png'}], 'categories': [{'id': 1, 'name': 'cat'}],
+            'annotations': [{'image_id': 7, 'category_id': 1, 'bbox': [0, 0, 5, 5], 'score': 0.5}]}
+    response = client.post(f'/projects/{deployed_project}/labels/import', content_type='multipart/form-data',
+                           data={'file': (io.BytesIO(json.dumps(coco).encode()), 'labels.json')})
+    assert response.get_json()['imported'] == 1
+
+    with client.application.app_context():
+        summary = project_summaries([deployed_project])[deployed_project]
+        assert summary['label_distribution'] == {'cat': 2, 'dog': 1}
+        assert Label.query.filter_by(class_name='cat').first().bbox == [1.0, 2.0, 10.0, 20.0]
+
+    exported = client.get(f'/projects/{deployed_project}/labels/export?class_name=cat').data.decode()
+    assert exported.splitlines()[1:] == ['1,img_0.png,cat,1.0,2.0,10.0,20.0,,import',
+                                         '3,img_2.png,cat,0.0,0.0,5.0,5.0,0.5,import']
+    document = json.loads(client.get(f'/projects/{deployed_project}/labels/export?format=coco').data)
+    assert document['categories'] == [{'id': 1, 'name': 'cat'}, {'id': 2, 'name': 'dog'}]
+    assert len(document['images']) == 4 and len(document['annotations']) == 3
+
+    # A malformed row partway through: the report says what was imported before it
+    client.application.config.update(LABEL_IMPORT_BATCH_SIZE=1, LABEL_IMPORT_MAX_COCO_BYTES=10)
+    broken = 'filename,class_name\nimg_0.png,cat\nimg_0.png,"' + 'x' * 200000 + '"\n'
+    response = client.post(f'/projects/{deployed_project}/labels/import', content_type='multipart/form-data',
+                           data={'file': (io.BytesIO(broken.encode()), 'labels.csv')})
+    report = response.get_json()
+    assert response.status_code == 400 and report['imported'] == 1
+    assert report['error'].startswith('Could not parse the file after line 2: field larger than field limit')
+    response = client.post(f'/projects/{deployed_project}/labels/import', content_type='multipart/form-data',
+                           data={'file': (io.BytesIO(json.dumps(coco).encode()), 'labels.json')})
+    assert response.status_code == 400 and response.get_json()['imported'] == 0
+    assert 'limited to 10 bytes' in response.get_json()['error']
+
+    with client.application.app_context():
+        assert project_summaries([deployed_project])[deployed_project]['label_distribution'] == {'cat': 3, 'dog': 1}
+
+def test_upload_images_accepts_files_and_archives(client, deployed_project):
+    def png(color):
+        buffer = io.BytesIO()
+        PILImage.new('RGB', (16, 16), color).save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    zipped = io.BytesIO()
+    with zipfile.ZipFile(zipped, 'w') as archive:
+        archive.writestr('train/a.png', png((1, 2, 3)))
+        archive.writestr('train/notes.txt', 'skip me')
+        archive.writestr('train/broken.jpg', b'not an image')
+    tarred = io.BytesIO()
+    with tarfile.open(fileobj=tarred, mode='w:gz') as archive:
+        data = png((4, 5, 6))
+        info = tarfile.TarInfo('b.png')
+        info.size = len(data)
+        archive.addfile(info, io.BytesIO(data))
+
+    client.application.config['INGEST_BATCH_SIZE'] = 2
+    response = client.post(f'/projects/{deployed_project}/upload_images', content_type='multipart/form-data',
+                           data={'images': [(io.BytesIO(png((7, 8, 9))), 'single.png'),
+                                            (io.BytesIO(zipped.getvalue()), 'set.zip'),
+                                            (io.BytesIO(tarred.getvalue()), 'set.tar.gz')]})
+    report = response.get_json()
+    assert (report['created'], report['failed'], report['skipped']) == (3, 1, 1)
+    assert [f['status'] for f in report['files']] == ['created', 'created', 'skipped', 'failed', 'created']
+
+    with client.application.app_context():
+        assert project_summaries([deployed_project])[deployed_project]['total_images'] == 7
+        image = db.session.get(Image, report['files'][4]['image_id'])
+        assert image.filename == 'b.png' and image.digest
+        cache = client.application.extensions['tensor_cache']
+        assert cache.get(deployed_project, image.id, (224, 224))[0, 0].tolist() == [4, 5, 6]
+
+    # A truncated archive keeps what was read before the damage and answers 400 with the report
+    response = client.post(f'/projects/{deployed_project}/upload_images', content_type='multipart/form-data',
+                           data={'images': [(io.BytesIO(png((1, 1, 1))), 'first.png'),
+                                            (io.BytesIO(tarred.getvalue()[:60]), 'cut.tar.gz')]})
+    assert response.status_code == 400
+    report = response.get_json()
+    assert report['created'] == 1 and report['files'][0]['status'] == 'created'
+    assert report['error'].startswith('Could not read archive')
+
+def test_listings_paginate_and_support_conditional_get(client, deployed_project):
+    first = client.get(f'/projects/{deployed_project}/images?limit=3&fields=filename')
+    assert first.get_json() == [{'filename': 'img_0.png'}, {'filename': 'img_1.png'}, {'filename': 'img_2.png'}]
+    second = client.get(f'/projects/{deployed_project}/images?limit=3&fields=filename&cursor={first.headers["X-Next-Cursor"]}')
+    assert second.get_json() == [{'filename': 'missing.png'}] and 'X-Next-Cursor' not in second.headers
+    assert client.get(f'/projects/{deployed_project}/images?fields=password').status_code == 400
+
+    etag = first.headers['ETag']
+    unchanged = client.get(f'/projects/{deployed_project}/images?limit=3&fields=filename',
+                           headers={'If-None-Match': etag})
+    assert unchanged.status_code == 304
+
+    analysis = client.get(f'/projects/{deployed_project}/analyze?limit=2')
+    assert analysis.get_json()['total_images'] == 4 and len(analysis.get_json()['details']) == 2
+    with client.application.app_context():
+        image = Image.query.filter_by(filename='img_0.png').one()
+        db.session.add(Label(image_id=image.id, label_data='cat'))
+        db.session.commit()
+        user_id = Project.query.get(deployed_project).user_id
+    changed = client.get(f'/projects/{deployed_project}/images?limit=3&fields=filename',
+                         headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
+
+    projects = client.get(f'/projects/{user_id}')
+    assert projects.get_json() == [{'id': deployed_project, 'name': 'p', 'description': None}]
+    assert client.get(f'/projects/{user_id}', headers={'If-None-Match': projects.headers['ETag']}).status_code == 304
+
+def test_api_key_cache_skips_deployment_lookup(client, deployed_project):
+    now = [0.0]
+    cache = TTLCache('TEST_CACHE', max_entries=2, ttl=10, clock=lambda: now[0])
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.put('c', 3)
+    assert cache.get('a') is None and cache.get('b') == 2
+    now[0] = 11
+    assert cache.get('b') is None
+    cache.put('miss', False, ttl=1)
+    now[0] = 12.5
+    assert cache.get('miss') is None
+
+    statements = []
+    engine_listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    with client.application.app_context():
+        sa_event.listen(db.engine, 'before_cursor_execute', engine_listener)
+    try:
+        with open(os.path.join(client.application.config['UPLOAD_FOLDER'], 'img_1.png'), 'rb') as f:
+            data = f.read()
+
+        def infer():
+            return client.post('/inference', headers={'API-Key': 'api_test'},
+                               data={'image': (io.BytesIO(data), 'upload.png')}, content_type='multipart/form-data')
+
+        assert infer().status_code == infer().status_code == 200
+        assert sum('FROM deployment' in s for s in statements) == 1
+
+        with client.application.app_context():
+            Deployment.query.filter_by(api_key='api_test').one().active = False
+            db.session.commit()
+        assert infer().status_code == 404
+    finally:
+        with client.application.app_context():
+            sa_event.remove(db.engine, 'before_cursor_execute', engine_listener)
+
+    # A row deleted by another worker leaves this one's cached key behind until the TTL runs out
+    with client.application.app_context():
+        db.session.add(Deployment(project_id=deployed_project, api_key='api_other', active=True))
+        db.session.commit()
+    assert client.get('/inference/stats', headers={'API-Key': 'api_other'}).status_code == 200
+    with client.application.app_context(), db.engine.begin() as conn:
+        conn.execute(Deployment.__table__.delete().where(Deployment.api_key == 'api_other'))
+    assert client.get('/inference/stats', headers={'API-Key': 'api_other'}).status_code == 404
+    assert api_key_cache.get('api_other') is None
+
+def test_deploy_tflite_runtime(client, deployed_project, tmp_path, monkeypatch):
+    tf = pytest.importorskip('tensorflow')
+    monkeypatch.setattr(model_registry, 'loader', ModelRegistry().loader)
+    inputs = tf.keras.Input((224, 224, 3))
+    outputs = tf.keras.layers.Dense(3, activation='softmax')(tf.keras.layers.GlobalAveragePooling2D()(inputs))
+    model = tf.keras.Model(inputs, outputs)
+    model.layers[-1].set_weights([np.eye(3, dtype='float32') * 10, np.zeros(3, dtype='float32')])
+    model_path = str(tmp_path / 'iteration.keras')
+    model.save(model_path)
+    with client.application.app_context():
+        iteration = Iteration(project_id=deployed_project, status='completed', model_path=model_path)
+        db.session.add(iteration)
+        db.session.commit()
+        iteration_id = iteration.id
+
+    app = client.application
+    app.config.update(TRAINING_POLL_INTERVAL=0.1, MODEL_FOLDER=str(tmp_path))
+    try:
+        # The conversion runs on the training engine; the previous deployment serves meanwhile
+        client.post(f'/projects/{deployed_project}/deploy_model', data={'model_choice': iteration_id,
+                                                                       'runtime': 'tflite-fp32'})
+        with app.app_context():
+            deployment = Deployment.query.filter_by(project_id=deployed_project, runtime='tflite-fp32').one()
+            assert deployment.status in ('pending', 'exporting') and not deployment.active
+            api_key = deployment.api_key
+        response = client.get('/inference/stats', headers={'API-Key': api_key})
+        assert response.status_code == 503 and response.headers['Retry-After']
+        assert client.get('/inference/stats', headers={'API-Key': 'api_test'}).status_code == 200
+
+        deadline = time.time() + 120
+        while time.time() < deadline:
+            with app.app_context():
+                deployment = db.session.get(Deployment, deployment.id)
+                if deployment.status not in ('pending', 'exporting'):
+                    break
+            time.sleep(0.2)
+        assert (deployment.status, deployment.active, deployment.error) == ('ready', True, None)
+    finally:
+        training_engine.shutdown()
+    assert os.path.exists(str(tmp_path / 'iteration.tflite-fp32.tflite'))
+    assert client.get('/inference/stats', headers={'API-Key': 'api_test'}).status_code == 404
+
+    with open(os.path.join(client.application.config['UPLOAD_FOLDER'], 'img_1.png'), 'rb') as f:
+        response = client.post('/inference', headers={'API-Key': api_key}, content_type='multipart/form-data',
+                               data={'image': (io.BytesIO(f.read()), 'upload.png')})
+    assert response.get_json()['result'][0]['label'] == 1
+    report = client.get('/inference/stats', headers={'API-Key': api_key}).get_json()['runtime_report']
+    assert report['runtime'] == 'tflite-fp32' and report['top1_agreement'] == 1.0
+
+def test_benchmark_seeds_and_measures_endpoints(client, tmp_path):
+    pytest.importorskip('tensorflow')
+    app = client.application
+    with app.app_context():
+        seeded = seed_database(users=2, projects_per_user=1, images_per_project=3, classes=3,
+                               model_folder=str(tmp_path))
+        assert Image.query.count() == 6 and Label.query.count() == 6
+    results = run_load(app, seeded, requests=4, concurrency=2, warmup=1)
+    assert set(results) == {'inference', 'predict', 'dashboard', 'analyze_project'}
+    assert all(stats['errors'] == 0 and stats['requests'] == 4 for stats in results.values())
+    assert results['dashboard']['queries_per_request']['mean'] > 0
+    # Predict cycles through the seeded images, so it runs uncached and measures the model
+    assert results['predict']['prediction_cache_hit_rate'] == 0.0
+    assert results['dashboard']['prediction_cache_hit_rate'] is None
+
+    baseline = {'endpoints': results}
+    slower = json.loads(json.dumps(baseline))
+    slower['endpoints']['dashboard']['latency_ms']['p95'] *= 2
+    slower['endpoints']['dashboard']['queries_per_request']['mean'] += 5
+    assert compare(baseline, baseline, threshold=0.1) == []
+    assert [r.split(':')[0] for r in compare(slower, baseline, threshold=0.1)] == ['dashboard', 'dashboard']
+    inference_batchers.close_all()
+    model_registry.clear()
+
+def test_metrics_endpoint_and_server_timing(client, tmp_path, monkeypatch):
+    # Disabled by default: no endpoint and no header
+    assert client.get('/metrics').status_code == 404
+    assert 'Server-Timing' not in client.get('/ready').headers
+
+    monkeypatch.setattr(model_registry, 'loader', lambda path: FakeClassifier())
+    db_fd, db_path = tempfile.mkstemp()
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': f'sqlite:///{db_path}',
+                      'UPLOAD_FOLDER': str(tmp_path), 'TENSOR_CACHE_FOLDER': str(tmp_path / 'tensors'),
+                      'METRICS_ENABLED': True, 'METRICS_SERVER_TIMING': True})
+    model_path = tmp_path / 'model.h5'
+    model_path.write_bytes(b'weights')
+    with app.app_context():
+        project = Project(name='p', project_type='classification')
+        db.session.add(project)
+        db.session.commit()
+        iteration = Iteration(project_id=project.id, status='completed', model_path=str(model_path))
+        db.session.add(iteration)
+        db.session.commit()
+        db.session.add(Deployment(project_id=project.id, iteration_id=iteration.id, api_key='metrics', active=True))
+        db.session.commit()
+
+    buffer = io.BytesIO()
+    PILImage.new('RGB', (8, 8), (0, 255, 0)).save(buffer, format='PNG')
+    metrics_client = app.test_client()
+    response = metrics_client.post('/inference', headers={'API-Key': 'metrics'}, content_type='multipart/form-data',
+                                   data={'image': (io.BytesIO(buffer.getvalue()), 'x.png')})
+    assert response.status_code == 200
+    timing = response.headers['Server-Timing']
+    for stage in ('db;', 'decode;', 'preprocess;', 'predict;', 'total;'):
+        assert stage in timing
+
+    body = metrics_client.get('/metrics').data.decode()
+    assert 'diy_ml_request_duration_seconds_count{endpoint="main.run_inference",method="POST",status="200"} 1' in body
+    assert 'diy_ml_request_stage_seconds_count{endpoint="main.run_inference",stage="predict"} 1' in body
+    assert 'diy_ml_model_load_seconds_count{kind="iteration",runtime="keras"} 1' in body
+    assert 'diy_ml_cache_misses_total{cache="prediction"} 1' in body
+    inference_batchers.close_all()
+    model_registry.clear()
+    os.close(db_fd)
+    os.unlink(db_path)
+
+def test_inference_pool_over_shared_memory(client, deployed_project):
+    shm, channels = create_channels(multiprocessing.get_context('spawn'), web_workers=1, slots_per_worker=1,
+                                    slot_bytes=224 * 224 * 3 * 4)
+    inference_pool.connect(channels, 0)
+    worker = threading.Thread(target=serve_inference, args=(channels, {}), daemon=True)
+    try:
+        with client.application.app_context():
+            spec = deployment_artifact(Deployment.query.filter_by(project_id=deployed_project).one())
+        # The only slot is taken until an inference process picks the request up
+        pending = inference_pool.submit(spec, np.zeros((1, 224, 224, 3), dtype='float32'))
+        assert client.get('/ready').status_code == 503
+        with open(os.path.join(client.application.config['UPLOAD_FOLDER'], 'img_1.png'), 'rb') as f:
+            data = f.read()
+        response = client.post('/inference', headers={'API-Key': 'api_test'}, content_type='multipart/form-data',
+                               data={'image': (io.BytesIO(data), 'upload.png')})
+        assert response.status_code == 429 and response.headers['Retry-After'] == '1'
+
+        worker.start()
+        assert len(pending.result(timeout=10)) == 1
+        assert client.get('/ready').get_json() == {'ready': True, 'inference_pool': 'ready'}
+        response = client.post('/inference', headers={'API-Key': 'api_test'}, content_type='multipart/form-data',
+                               data={'image': (io.BytesIO(data), 'upload.png')})
+        assert response.get_json()['result'][0]['label'] == 1
+        assert inference_pool.stats()['rejected'] == 1
+
+        # Batch predictions and deployment warm-up go to the pool as well
+        response = client.post(f'/projects/{deployed_project}/predict_batch', json={'batch_size': 2})
+        top = {line['filename']: line['predictions'][0]['label']
+               for line in map(json.loads, response.data.decode().splitlines()) if 'predictions' in line}
+        assert top == {'img_0.png': 0, 'img_1.png': 1, 'img_2.png': 2}
+        model_registry.clear()
+        inference_pool.warm(spec)
+        deadline = time.monotonic() + 10
+        while spec[0] not in model_registry and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert spec[0] in model_registry
+    finally:
+        inference_pool.close()
+        channels.requests.put(None)
+        if worker.is_alive():
+            worker.join(timeout=10)
+        shm.close()
+        shm.unlink()
+
+def test_inference_accepts_json_and_tensor_bodies_in_memory(client, deployed_project):
+    app = client.application
+    storage_root = app.extensions['storage'].backend.root
+    stored = lambda: sum(len(files) for _, _, files in os.walk(storage_root))
+    before = stored()
+    buffer = io.BytesIO()
+    PILImage.new('RGB', (40, 30), (0, 0, 255)).save(buffer, format='PNG')
+    headers = {'API-Key': 'api_test'}
+
+    response = client.post('/inference', headers=headers, json={'image': base64.b64encode(buffer.getvalue()).decode()})
+    assert response.get_json()['result'][0]['label'] == 2
+    response = client.post('/inference', headers=headers, data=buffer.getvalue(), content_type='image/png')
+    assert response.get_json()['result'][0]['label'] == 2
+
+    pixels = np.zeros((16, 16, 3), dtype='uint8')
+    pixels[..., 1] = 255
+    response = client.post('/inference', headers=dict(headers, **{'X-Tensor-Shape': '16,16,3'}),
+                           data=pixels.tobytes(), content_type='application/octet-stream')
+    assert response.get_json()['result'][0]['label'] == 1
+    npy = io.BytesIO()
+    np.save(npy, np.full((1, 224, 224, 3), [255, 0, 0], dtype='float32'))
+    response = client.post('/inference', headers=headers, data=npy.getvalue(), content_type='application/x-npy')
+    assert response.get_json()['result'][0]['label'] == 0
+    # Persisting uploads is opt-in
+    assert stored() == before
+
+    assert client.post('/inference', headers=headers, data=b'x', content_type='text/plain').status_code == 415
+    assert client.post('/inference', headers=headers, json={'image': 'not base64!'}).status_code == 400
+    app.config['INFERENCE_MAX_IMAGE_PIXELS'] = 100
+    response = client.post('/inference', headers=headers, json={'image': base64.b64encode(buffer.getvalue()).decode()})
+    assert response.status_code == 200  # served from the prediction cache without decoding
+    other = io.BytesIO()
+    PILImage.new('RGB', (40, 30), (0, 255, 0)).save(other, format='PNG')
+    assert client.post('/inference', headers=headers, data=other.getvalue(), content_type='image/png').status_code == 413
+    app.config['INFERENCE_MAX_PAYLOAD_BYTES'] = 10
+    response = client.post('/inference', headers=headers, content_type='multipart/form-data',
+                           data={'image': (io.BytesIO(other.getvalue()), 'x.png')})
+    assert response.status_code == 413
+
+    app.config.update(INFERENCE_MAX_PAYLOAD_BYTES=10 * 1024 * 1024, INFERENCE_MAX_IMAGE_PIXELS=40_000_000,
+                      INFERENCE_PERSIST_UPLOADS=True)
+    response = client.post('/inference', headers=headers, data=other.getvalue(), content_type='image/png')
+    assert response.get_json()['result'][0]['label'] == 1
+    deadline = time.time() + 5
+    while stored() == before and time.time() < deadline:
+        time.sleep(0.01)
+    # Kept apart from image blobs, so garbage collection can tell them from orphans
+    assert app.extensions['storage'].inference_backend.exists(PredictionCache.digest(other.getvalue()))
+    assert not app.extensions['storage'].exists(PredictionCache.digest(other.getvalue()))
+
+def test_embedding_index_similarity_and_duplicates(client, deployed_project, monkeypatch):
+    batches = []
+
+    def embed(x):
+        # Mean colour stands in for the backbone, so images are as similar as their colours
+        batches.append(len(x))
+        return np.concatenate([x.mean(axis=(1, 2)) + 1, np.ones((len(x), 1))], axis=1)
+
+    monkeypatch.setattr(embedding_index, 'embed_fn', embed)
+    app = client.application
+    with app.app_context():
+        red, green = (Image.query.filter_by(filename=name).one().id for name in ('img_0.png', 'img_1.png'))
+
+    def png(color):
+        buffer = io.BytesIO()
+        PILImage.new('RGB', (20, 20), color).save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    results = client.get(f'/projects/{deployed_project}/similar?image_id={red}&k=5').get_json()['results']
+    assert len(results) == 2 and all(abs(r['score'] - 0.2) < 1e-6 for r in results)  # missing.png is skipped
+    client.post(f'/projects/{deployed_project}/upload_image', content_type='multipart/form-data',
+                data={'image': (io.BytesIO(png((255, 0, 0))), 'red_copy.png')})
+    top = client.get(f'/projects/{deployed_project}/similar?image_id={red}&k=1').get_json()['results'][0]
+    assert top['filename'] == 'red_copy.png' and top['score'] > 0.999
+    response = client.post(f'/projects/{deployed_project}/similar?k=2', data=png((250, 0, 0)), content_type='image/png')
+    assert {r['filename'] for r in response.get_json()['results']} == {'img_0.png', 'red_copy.png'}
+    assert batches == [3, 1, 1]  # built once, then only the upload and the query image
+
+    report = client.get(f'/projects/{deployed_project}/duplicates').get_json()
+    assert (report['images'], report['duplicate_images']) == (4, 1)
+    assert [entry['filename'] for entry in report['groups'][0]] == ['img_0.png', 'red_copy.png']
+
+    client.post(f'/images/{top["image_id"]}/delete')
+    assert client.get(f'/projects/{deployed_project}/duplicates').get_json()['groups'] == []
+    # Rows written without going through this process's hooks are picked up before the next query
+    with app.app_context():
+        PILImage.new('RGB', (8, 8), (0, 250, 0)).save(os.path.join(app.config['UPLOAD_FOLDER'], 'green_copy.png'))
+        db.session.add(Image(filename='green_copy.png', project_id=deployed_project))
+        db.session.commit()
+    top = client.get(f'/projects/{deployed_project}/similar?image_id={green}&k=1').get_json()['results'][0]
+    assert top['filename'] == 'green_copy.png'
+    assert client.get(f'/projects/{deployed_project}/similar?image_id=999').status_code == 404
+
+def test_tensor_cache_shards(tmp_path):
+    cache = TensorCache(root=str(tmp_path), shard_size=4)
+    pixels = np.full((8, 8, 3), 7, dtype=np.uint8)
+    cache.put(1, 5, pixels, (8, 8))
+    assert cache.get(1, 5, (8, 8)).sum() == pixels.sum()
+    assert cache.get(1, 6, (8, 8)) is None
+    assert cache.get(1, 5, (16, 16)) is None
+
+    # A fresh instance reads the same shards back from disk
+    reopened = TensorCache(root=str(tmp_path), shard_size=4)
+    assert reopened.contains(1, 5, (8, 8))
+    reopened.invalidate(1, 5)
+    assert not reopened.contains(1, 5, (8, 8))
+
+    cache.put(1, 2, np.zeros((16, 16, 3), dtype=np.uint8), (16, 16))
+    assert cache.prune_sizes(1, (16, 16)) == [(8, 8)]
+    assert cache.sizes(1) == [(16, 16)]
+
+    # Slots are dense per project whatever the global ids, and open maps are bounded
+    cache = TensorCache(root=str(tmp_path), shard_size=4, max_open_shards=2)
+    for image_id in range(1000, 1024, 3):
+        cache.put(2, image_id, pixels, (8, 8))
+    assert sorted(os.listdir(tmp_path / '2' / '8x8')) == [
+        'shard_000000.mask.npy', 'shard_000000.npy', 'shard_000001.mask.npy', 'shard_000001.npy', 'slots.bin']
+    cache.put(3, 1, pixels, (8, 8))
+    assert len(cache._shards) == 2
+    assert all(TensorCache(root=str(tmp_path), shard_size=4).contains(2, i, (8, 8)) for i in range(1000, 1024, 3))
+
+    # A process that lost the race to create a shard opens the winner's file instead of truncating it
+    mask = _create_shard_file(str(tmp_path / '2' / '8x8' / 'shard_000000.mask.npy'), np.bool_, (4,))
+    assert mask.all() and not any(name.endswith('.tmp') for name in os.listdir(tmp_path / '2' / '8x8'))
+
+def test_feature_store_computes_only_new_images(tmp_path):
+    store = FeatureStore(root=str(tmp_path))
+    computed = []
+
+    def compute(image_ids):
+        computed.extend(image_ids)
+        return np.array([[image_id, image_id * 2] for image_id in image_ids], dtype=np.float32)
+
+    features = store.ensure(1, 'v1', [3, 1, 2], compute)
+    assert features[:, 0].tolist() == [3, 1, 2]
+    assert sorted(computed) == [1, 2, 3]
+
+    computed.clear()
+    assert store.ensure(1, 'v1', [4, 2], compute)[:, 1].tolist() == [8, 4]
+    assert computed == [4]
+
+    # Removed ids are recomputed if they come back, e.g. a reused SQLite rowid
+    computed.clear()
+    store.remove(1, [2])
+    assert store.load(1, 'v1')[0].tolist() == [1, 3, 4]
+    store.ensure(1, 'v1', [1, 2], compute)
+    assert computed == [2]
+    assert store.ensure(1, 'v2', [1], compute).shape == (1, 2)
+
+    # Removals from another process stay pending until a rewrite applies them; the re-added id survives it
+    FeatureStore(root=str(tmp_path)).remove(1, [3])
+    store.ensure(1, 'v1', [5], compute)
+    assert store.load(1, 'v1')[0].tolist() == [1, 2, 4, 5]
+    assert len([name for name in os.listdir(tmp_path / '1' / 'v1') if name.startswith('gen_')]) == 1
+
+def test_inference_uses_prediction_cache(client, deployed_project):
+    cache = client.application.extensions['prediction_cache']
+    with open(os.path.join(client.application.config['UPLOAD_FOLDER'], 'img_0.png'), 'rb') as f:
+        data = f.read()
+
+    def infer():
+        return client.post('/inference', headers={'API-Key': 'api_test'},
+                           data={'image': (io.BytesIO(data), 'upload.png')}, content_type='multipart/form-data')
+
+    first, second = infer(), infer()
+    assert first.status_code == second.status_code == 200
+    assert first.get_json() == second.get_json()
+    assert first.get_json()['result'][0]['label'] == 0
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_prediction_cache_sqlite_tier(tmp_path):
+    path = str(tmp_path / 'predictions.sqlite')
+    cache = PredictionCache(sqlite_path=path, max_entries=1)
+    digest = cache.digest(b'image bytes')
+    version = cache.model_version('iteration:1', 123.0)
+    cache.put(digest, version, '224x224', [{'label': 3, 'score': 0.9}])
+    cache.put(cache.digest(b'other'), version, '224x224', [])
+
+    # Evicted from memory but still served from disk, also by a new process
+    assert PredictionCache(sqlite_path=path).get(digest, version, '224x224') == [{'label': 3, 'score': 0.9}]
+    assert cache.get(digest, version, '224x224') == [{'label': 3, 'score': 0.9}]
+    assert cache.disk_hits == 1
+
+    cache.invalidate_model('iteration:1')
+    assert cache.get(digest, version, '224x224') is None
+
+def test_local_storage_deduplicates(tmp_path):
+    store = LocalStorage(str(tmp_path), chunk_size=4)
+    digest, size, created = store.save_stream(io.BytesIO(b'same bytes'))
+    assert (size, created) == (10, True)
+    assert store.local_path(digest) == str(tmp_path / digest[:2] / digest[2:4] / digest)
+    assert store.save_stream(io.BytesIO(b'same bytes')) == (digest, 10, False)
+    assert list(store.iter_digests()) == [digest]
+    assert os.listdir(tmp_path / 'tmp') == []
+
+    # Non-local backends hand out a file that is closed with the block
+    class RemoteStorage(LocalStorage):
+        def local_path(self, digest):
+            return None
+
+        def open(self, digest):
+            return open(LocalStorage.local_path(self, digest), 'rb')
+
+    storage = Storage()
+    storage.backend = RemoteStorage(str(tmp_path))
+    with storage.image_source(Image(filename='x.png', digest=digest)) as source:
+        assert source.read() == b'same bytes'
+    assert source.closed
+
+def test_storage_migrate_command(client, deployed_project):
+    app = client.application
+    # A blob written where older versions kept them, straight under the upload folder
+    legacy_digest, _, _ = LocalStorage(app.config['UPLOAD_FOLDER']).save_stream(io.BytesIO(b'legacy'))
+    result = app.test_cli_runner().invoke(args=['storage', 'migrate', '--delete-originals'])
+    assert 'Moved 1 blobs' in result.output
+    assert app.extensions['storage'].exists(legacy_digest)
+    assert 'Migrated 3 images' in result.output
+    assert 'missing.png' in result.output
+    with app.app_context():
+        image = Image.query.filter_by(filename='img_0.png').one()
+        assert image.digest and app.extensions['storage'].exists(image.digest)
+    assert not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], 'img_0.png'))
+
+def test_bulk_delete_and_garbage_collection(client, deployed_project, tmp_path):
+    app = client.application
+    app.config['MODEL_FOLDER'] = str(tmp_path / 'models')
+    upload_folder = app.config['UPLOAD_FOLDER']
+    buffer = io.BytesIO()
+    PILImage.new('RGB', (8, 8), (9, 9, 9)).save(buffer, format='PNG')
+    client.post(f'/projects/{deployed_project}/upload_image', content_type='multipart/form-data',
+                data={'image': (io.BytesIO(buffer.getvalue()), 'stored.png')})
+    with app.app_context():
+        images = {image.filename: image.id for image in Image.query.all()}
+        digest = Image.query.filter_by(filename='stored.png').one().digest
+        db.session.add_all([Label(image_id=images['img_0.png'], class_name='red'),
+                            Label(image_id=images['img_1.png'], class_name='green')])
+        # Rows and files left behind by an earlier, non-cascading delete
+        db.session.add(Image(filename='orphan.png', project_id=999))
+        db.session.commit()
+        iteration_id = Iteration.query.one().id
+    PILImage.new('RGB', (4, 4)).save(os.path.join(upload_folder, 'orphan.png'))
+    os.makedirs(app.config['MODEL_FOLDER'])
+    for name in (f'iteration_{iteration_id}.keras', f'iteration_{iteration_id}.tflite-int8.tflite', 'iteration_777.keras'):
+        (tmp_path / 'models' / name).write_bytes(b'model')
+
+    client.post(f'/images/{images["img_0.png"]}/delete')
+    with app.app_context():
+        summary = project_summaries([deployed_project])[deployed_project]
+        assert (summary['total_images'], summary['label_distribution']) == (4, {'green': 1})
+
+    client.post(f'/projects/{deployed_project}', data={'_method': 'DELETE'})
+    assert client.post('/inference', headers={'API-Key': 'api_test'}, content_type='multipart/form-data',
+                       data={'image': (io.BytesIO(buffer.getvalue()), 'x.png')}).status_code == 404
+    with app.app_context():
+        assert Project.query.count() == 0 and Iteration.query.count() == 0 and Deployment.query.count() == 0
+        assert Label.query.count() == 0 and [image.project_id for image in Image.query.all()] == [999]
+    assert not os.path.exists(os.path.join(app.extensions['tensor_cache'].root, str(deployed_project)))
+
+    # A label whose image went away on its own, and a just-created directory of a project the sweep cannot see yet
+    with app.app_context():
+        db.session.add(Label(image_id=99999, label_data='gone', class_name='gone'))
+        db.session.commit()
+    fresh_dir = os.path.join(app.extensions['feature_store'].root, '555')
+    os.makedirs(fresh_dir)
+    app.test_cli_runner().invoke(args=['gc', 'collect'])
+    assert os.path.isdir(fresh_dir)
+
+    # Persisting /inference uploads no longer stops image blobs from being swept
+    app.config['INFERENCE_PERSIST_UPLOADS'] = True
+    inference_digest, _, _ = app.extensions['storage'].inference_backend.save_stream(io.BytesIO(b'upload'))
+    result = app.test_cli_runner().invoke(args=['gc', 'collect', '--grace', '0'])
+    assert 'removed' in result.output
+    with app.app_context():
+        assert Image.query.count() == 0 and Label.query.count() == 0
+    assert not os.path.exists(fresh_dir)
+    assert not app.extensions['storage'].exists(digest)
+    assert app.extensions['storage'].inference_backend.exists(inference_digest)
+    # Flat files nobody queued are only swept on request
+    assert os.path.exists(os.path.join(upload_folder, 'orphan.png'))
+    app.test_cli_runner().invoke(args=['gc', 'collect', '--grace', '0', '--uploads'])
+    assert not any(name.endswith('.png') for name in os.listdir(upload_folder))
+    assert os.listdir(tmp_path / 'models') == []
+    assert os.listdir(os.path.join(app.extensions['tensor_cache'].root, '.trash')) == []
+
+def fake_training(job):
+    job.report(progress=0.5, epoch=1, loss=0.25, images_per_sec=100.0)
+    if job.config.get('wait_for_cancel'):
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            job.check_cancelled()
+            time.sleep(0.05)
+    return {'samples': len(job.samples)}
+
+def wait_for_status(client, project_id, iteration_id, statuses, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        data = client.get(f'/projects/{project_id}/iterations/{iteration_id}').get_json()
+        if data['status'] in statuses:
+            return data
+        time.sleep(0.1)
+    raise AssertionError(f'iteration {iteration_id} stuck in {data["status"]}')
+
+def test_training_jobs_run_in_background(client, deployed_project):
+    app = client.application
+    app.config.update(TRAINING_FUNCTION='tests.test_app.fake_training', TRAINING_POLL_INTERVAL=0.1)
+    try:
+        response = client.post(f'/projects/{deployed_project}/start_iteration')
+        assert response.status_code == 202
+        iteration_id = response.get_json()['iteration_id']
+        data = wait_for_status(client, deployed_project, iteration_id, {'completed', 'failed'})
+        assert data['status'] == 'completed', data['result']
+        assert data['progress'] == 1.0
+        assert data['metrics'] == {'epoch': 1, 'loss': 0.25, 'images_per_sec': 100.0}
+
+        client.post(f'/projects/{deployed_project}/configure_training', json={'wait_for_cancel': True})
+        iteration_id = client.post(f'/projects/{deployed_project}/start_iteration').get_json()['iteration_id']
+        wait_for_status(client, deployed_project, iteration_id, {'running'})
+        client.post(f'/projects/{deployed_project}/iterations/{iteration_id}/cancel')
+        data = wait_for_status(client, deployed_project, iteration_id, {'cancelled', 'completed', 'failed'})
+        assert data['status'] == 'cancelled'
+    finally:
+        training_engine.shutdown()
+
+def test_training_dispatch_off_only_queues(client, deployed_project):
+    client.application.config['TRAINING_DISPATCH'] = False
+    response = client.post(f'/projects/{deployed_project}/start_iteration')
+    assert response.status_code == 202
+    assert training_engine._thread is None or not training_engine._thread.is_alive()
+    with client.application.app_context():
+        assert db.session.get(Iteration, response.get_json()['iteration_id']).status == 'queued'
+
+def test_training_engine_requeues_orphans(client):
+    app = client.application
+    with app.app_context():
+        stale = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        orphan = Iteration(project_id=1, status='running', heartbeat_at=stale, attempts=1)
+        exhausted = Iteration(project_id=1, status='running', heartbeat_at=stale, attempts=3)
+        db.session.add_all([orphan, exhausted])
+        db.session.commit()
+        training_engine._recover_orphans()
+        assert db.session.get(Iteration, orphan.id).status == 'queued'
+        assert db.session.get(Iteration, exhausted.id).status == 'failed'
+
+def test_cancel_does_not_override_a_just_claimed_iteration(client):
+    app = client.application
+    with app.app_context():
+        iteration = Iteration(project_id=1, status='queued')
+        db.session.add(iteration)
+        db.session.commit()
+        # The dispatcher claims the row after the request loaded it
+        with db.engine.begin() as conn:
+            conn.execute(Iteration.__table__.update().values(status='running'))
+        training_engine.cancel(iteration)
+        assert (iteration.status, iteration.cancel_requested) == ('running', True)
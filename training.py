@@ -0,0 +1,72 @@
+import time
+
+import numpy as np
+
+from extensions import feature_store
+from ml import BACKBONE_VERSION, INPUT_SIZE, get_feature_extractor, load_image_tensor
+
+
+def extract_features(job, extractor):
+    """Backbone embeddings for every sample, computing only images not in the feature store."""
+    sources = {image_id: source for image_id, source, _ in job.samples}
+    computed = []
+
+    def compute(image_ids):
+        x = np.stack([load_image_tensor(job.project_id, image_id, sources[image_id], INPUT_SIZE)
+                      for image_id in image_ids])
+        computed.extend(image_ids)
+        return np.asarray(extractor.predict_on_batch(x))
+
+    features = feature_store.ensure(job.project_id, BACKBONE_VERSION,
+                                    [image_id for image_id, _, _ in job.samples], compute)
+    return features, len(computed)
+
+
+def train_classifier(job):
+    """Fit a classification head on cached MobileNetV2 features.
+
+    The frozen backbone runs once per image (see feature_store); each
+    iteration then only trains the Dense head and saves it stacked on the
+    backbone so the artifact takes images like any other model. Runs inside
+    a training worker process; see jobs.run_job().
+    """
+    import tensorflow as tf
+
+    classes = sorted({label for _, _, label in job.samples})
+    if len(classes) < 2:
+        raise ValueError('Training needs labelled images from at least two classes')
+    class_index = {name: i for i, name in enumerate(classes)}
+
+    epochs = int(job.config.get('epochs', 10))
+    batch_size = int(job.config.get('batch_size', 32))
+    learning_rate = float(job.config.get('learning_rate', 0.001))
+
+    started = time.perf_counter()
+    extractor = get_feature_extractor()
+    features, computed = extract_features(job, extractor)
+    labels = np.array([class_index[label] for _, _, label in job.samples])
+    job.report(progress=0.0, features_computed=computed, features_cached=len(features) - computed,
+               feature_seconds=time.perf_counter() - started)
+
+    head = tf.keras.Sequential([tf.keras.Input(shape=features.shape[1:]),
+                                tf.keras.layers.Dense(len(classes), activation='softmax')])
+    head.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate),
+                 loss=tf.keras.losses.SparseCategoricalCrossentropy(), metrics=['accuracy'])
+
+    def on_epoch_end(epoch, logs):
+        # Every epoch is one pass over all samples; ``started`` is when fit() began
+        seen, elapsed = (epoch + 1) * len(features), time.perf_counter() - started
+        job.report(progress=(epoch + 1) / epochs, epoch=epoch + 1, epochs=epochs,
+                   loss=float(logs['loss']), accuracy=float(logs['accuracy']),
+                   images_per_sec=seen / elapsed if elapsed else 0.0)
+
+    started = time.perf_counter()
+    history = head.fit(features, labels, epochs=epochs, batch_size=batch_size, verbose=0,
+                       callbacks=[tf.keras.callbacks.LambdaCallback(on_epoch_end=on_epoch_end)])
+    job.report(head_seconds=time.perf_counter() - started)
+
+    model = tf.keras.Model(extractor.inputs, head(extractor.outputs[0]))
+    model.save(job.output_path)
+    return {'classes': classes, 'loss': float(history.history['loss'][-1]),
+            'accuracy': float(history.history['accuracy'][-1]), 'samples': len(job.samples),
+            'backbone': BACKBONE_VERSION}
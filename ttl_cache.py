@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Bounded LRU mapping whose entries expire ``ttl`` seconds after insertion.
+
+    ``config_prefix`` names the ``<PREFIX>_TTL`` and ``<PREFIX>_MAX_ENTRIES``
+    config keys read by init_app(). Entries are dropped explicitly by
+    pop() in the process that made the change; other processes see the
+    change once the entry expires.
+    """
+
+    def __init__(self, config_prefix, app=None, max_entries=10000, ttl=30.0, clock=time.monotonic):
+        self.config_prefix = config_prefix
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_entries = app.config.get(f'{self.config_prefix}_MAX_ENTRIES', self.max_entries)
+        self.ttl = app.config.get(f'{self.config_prefix}_TTL', self.ttl)
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+        app.extensions[self.config_prefix.lower()] = self
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > self.clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, ttl=None):
+        """Store ``value``; ``ttl`` overrides the cache-wide lifetime for this entry."""
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self.clock() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[1] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / lookups) if lookups else 0.0,
+            }